@@ -48,6 +48,10 @@ CANCEL = chr(8)
 
 protocol_name = 'BitTorrent protocol'
 
+# size of the per-connection receive buffer; it only grows past this for a
+# single message that doesn't fit
+RECV_BUFFER_SIZE = 2 ** 15
+
 
 class Connection(object):
 
@@ -63,11 +67,18 @@ class Connection(object):
         self.next_upload = None
         self.upload = None
         self.download = None
-        self._buffer = []
-        self._buffer_len = 0
+        # Data is received straight into _rbuf with recv_into(). Bytes in
+        # _rbuf[_rstart:_rend] have arrived but aren't consumed yet, messages
+        # are handed out as memoryviews into the buffer and are only valid
+        # until the call they are passed to returns.
+        self._rbuf = bytearray(RECV_BUFFER_SIZE)
+        self._rview = memoryview(self._rbuf)
+        self._rstart = 0
+        self._rend = 0
         self._reader = self._read_messages()
         self._next_len = self._reader.next()
         self._partial_message = None
+        self._partial_len = 0
         self._outqueue = []
         self.choke_sent = True
         if self.locally_initiated:
@@ -123,14 +134,18 @@ class Connection(object):
             if s is None:
                 return 0
             index, begin, piece = s
-            self._partial_message = ''.join((tobinary(len(piece) + 9), PIECE,
-                                    tobinary(index), tobinary(begin), piece))
-        if bytes < len(self._partial_message):
-            self.connection.write(buffer(self._partial_message, 0, bytes))
-            self._partial_message = buffer(self._partial_message, bytes)
+            # header and payload are kept as separate buffers and handed to
+            # the socket as a vector, the payload is never copied
+            header = tobinary(len(piece) + 9) + PIECE + tobinary(index) + \
+                     tobinary(begin)
+            self._partial_message = [memoryview(header), memoryview(piece)]
+            self._partial_len = len(header) + len(piece)
+        if bytes < self._partial_len:
+            self.connection.writev(self._take_partial(bytes))
             return bytes
 
-        queue = [str(self._partial_message)]
+        queue = self._partial_message
+        sent = self._partial_len
         self._partial_message = None
         if self.choke_sent != self.upload.choked:
             if self.upload.choked:
@@ -139,16 +154,34 @@ class Connection(object):
             else:
                 self._outqueue.append(tobinary(1) + UNCHOKE)
             self.choke_sent = self.upload.choked
+        for s in self._outqueue:
+            sent += len(s)
         queue.extend(self._outqueue)
         self._outqueue = []
-        queue = ''.join(queue)
-        self.connection.write(queue)
-        return len(queue)
+        self.connection.writev(queue)
+        return sent
+
+    def _take_partial(self, bytes):
+        # returns views of the first bytes of the partial message
+        r = []
+        parts = self._partial_message
+        self._partial_len -= bytes
+        while bytes:
+            part = parts[0]
+            if len(part) <= bytes:
+                r.append(part)
+                bytes -= len(part)
+                del parts[0]
+            else:
+                r.append(part[:bytes])
+                parts[0] = part[bytes:]
+                bytes = 0
+        return r
 
     # yields the number of bytes it wants next, gets those in self._message
     def _read_messages(self):
         yield 1   # header length
-        if ord(self._message) != len(protocol_name):
+        if ord(self._message[0]) != len(protocol_name):
             return
 
         yield len(protocol_name)
@@ -160,7 +193,7 @@ class Connection(object):
         yield 20 # download id
         if self.encoder.download_id is None:  # incoming connection
             # modifies self.encoder if successful
-            self.encoder.select_torrent(self, self._message)
+            self.encoder.select_torrent(self, self._message.tobytes())
             if self.encoder.download_id is None:
                 return
         elif self._message != self.encoder.download_id:
@@ -171,7 +204,7 @@ class Connection(object):
 
         yield 20  # peer id
         if not self.id:
-            self.id = self._message
+            self.id = self._message.tobytes()
             if self.id == self.encoder.my_id:
                 return
             for v in self.encoder.connections.itervalues():
@@ -229,7 +262,7 @@ class Connection(object):
             self.download.got_have(i)
         elif t == BITFIELD:
             try:
-                b = Bitfield(self.encoder.numpieces, message[1:])
+                b = Bitfield(self.encoder.numpieces, message[1:].tobytes())
             except ValueError:
                 self.close()
                 return
@@ -262,9 +295,10 @@ class Connection(object):
             if i >= self.encoder.numpieces:
                 self.close()
                 return
-            if self.download.got_piece(i, toint(message[5:9]), message[9:]):
-                for co in self.encoder.complete_connections:
-                    co.send_have(i)
+            # the payload stays a view into the receive buffer, storage
+            # copies it out if it needs to keep it. HAVE is sent to
+            # everyone by the downloader once the piece passes its check.
+            self.download.got_piece(i, toint(message[5:9]), message[9:])
         else:
             self.close()
 
@@ -286,28 +320,47 @@ class Connection(object):
         else:
             self.connection.write(s)
 
-    def data_came_in(self, conn, s):
-        while True:
-            if self.closed:
-                return
-            i = self._next_len - self._buffer_len
-            if i > len(s):
-                self._buffer.append(s)
-                self._buffer_len += len(s)
-                return
-            m = s[:i]
-            if self._buffer_len > 0:
-                self._buffer.append(m)
-                m = ''.join(self._buffer)
-                self._buffer = []
-                self._buffer_len = 0
-            s = s[i:]
-            self._message = m
+    def get_read_buffer(self):
+        # called by RawServer, returns the free space to recv_into()
+        return self._rview[self._rend:]
+
+    def read_buffer_filled(self, conn, amount):
+        self._rend += amount
+        view = self._rview
+        while not self.closed:
+            end = self._rstart + self._next_len
+            if end > self._rend:
+                break
+            self._message = view[self._rstart:end]
+            self._rstart = end
             try:
                 self._next_len = self._reader.next()
             except StopIteration:
                 self.close()
                 return
+        if self.closed:
+            return
+        if self._rstart == self._rend:
+            self._rstart = self._rend = 0
+            if len(self._rbuf) > RECV_BUFFER_SIZE:
+                self._rbuf = bytearray(RECV_BUFFER_SIZE)
+                self._rview = memoryview(self._rbuf)
+        elif self._rstart + self._next_len > len(self._rbuf):
+            self._make_room()
+
+    def _make_room(self):
+        # move the start of an incomplete message to the front of the
+        # buffer, growing the buffer if the message is larger than it
+        pending = self._rend - self._rstart
+        if self._next_len > len(self._rbuf):
+            rbuf = bytearray(self._next_len)
+            rbuf[:pending] = self._rview[self._rstart:self._rend]
+            self._rbuf = rbuf
+            self._rview = memoryview(rbuf)
+        else:
+            self._rview[:pending] = self._rview[self._rstart:self._rend]
+        self._rstart = 0
+        self._rend = pending
 
     def connection_lost(self, conn):
         assert conn is self.connection
@@ -0,0 +1,144 @@
+# coding: utf-8
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+'''
+@note:
+磁盘读写线程池。在 Multitorrent 中创建，所有种子共用。每个 key（一般是一个
+Storage）有自己的先进先出队列，同一个 key 的任务按提交顺序依次执行，不同 key
+的任务可以在不同线程里同时执行。任务完成后的回调通过
+RawServer.external_add_task 回到网络线程执行。线程数为 0 时任务直接在调用者
+线程里执行。
+'''
+import sys
+import threading
+from collections import deque
+
+
+class DiskIO(object):
+
+    def __init__(self, num_threads, max_queued, add_task):
+        # add_task is RawServer.external_add_task
+        self.add_task = add_task
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.idle = threading.Condition(self.lock)
+        self.queues = {}          # key -> deque of jobs
+        self.runnable = deque()   # keys with jobs and no thread running them
+        self.queued_bytes = 0
+        self.drain_funcs = []
+        self.closed = False
+        self.stat_jobs = 0
+        self.threads = []
+        for i in xrange(num_threads):
+            t = threading.Thread(target = self._run)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, key, func, args = (), callback = None, context = None,
+               size = 0):
+        # func(*args) runs in a disk thread, callback(result) in the
+        # RawServer thread. Exceptions are passed to context.got_exception().
+        # size is the number of bytes the job holds in memory until it runs.
+        if not self.threads:
+            r = func(*args)
+            if callback is not None:
+                callback(r)
+            return
+        self.lock.acquire()
+        try:
+            q = self.queues.get(key)
+            if q is None:
+                q = self.queues[key] = deque()
+                self.runnable.append(key)
+                self.ready.notify()
+            q.append((func, args, callback, context, size))
+            self.queued_bytes += size
+        finally:
+            self.lock.release()
+
+    def is_backlogged(self):
+        return self.queued_bytes > self.max_queued
+
+    def notify_when_drained(self, func, context = None):
+        # func is called once the queued bytes are down to half the limit
+        self.lock.acquire()
+        try:
+            if self.queued_bytes > self.max_queued // 2:
+                self.drain_funcs.append((func, context))
+                return
+        finally:
+            self.lock.release()
+        self.add_task(func, 0, context)
+
+    def wait(self, key):
+        # blocks until every job queued for key has finished
+        if not self.threads:
+            return
+        self.lock.acquire()
+        try:
+            while key in self.queues:
+                self.idle.wait()
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        return {'threads': len(self.threads),
+                'queued_bytes': self.queued_bytes,
+                'queued_jobs': sum([len(q) for q in self.queues.values()]),
+                'jobs': self.stat_jobs}
+
+    def close(self):
+        self.lock.acquire()
+        self.closed = True
+        self.ready.notifyAll()
+        self.lock.release()
+
+    def _run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                while not self.runnable and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                key = self.runnable.popleft()
+                func, args, callback, context, size = self.queues[key][0]
+            finally:
+                self.lock.release()
+            try:
+                r = func(*args)
+            except:
+                def reraise(a = sys.exc_info()):
+                    raise a[0], a[1], a[2]
+                self.add_task(reraise, 0, context)
+            else:
+                if callback is not None:
+                    self.add_task(lambda f = callback, r = r: f(r), 0, context)
+            self.lock.acquire()
+            try:
+                self.stat_jobs += 1
+                q = self.queues[key]
+                q.popleft()
+                if q:
+                    self.runnable.append(key)
+                    self.ready.notify()
+                else:
+                    del self.queues[key]
+                    self.idle.notifyAll()
+                self.queued_bytes -= size
+                if self.drain_funcs and \
+                       self.queued_bytes <= self.max_queued // 2:
+                    for func, context in self.drain_funcs:
+                        self.add_task(func, 0, context)
+                    self.drain_funcs = []
+            finally:
+                self.lock.release()
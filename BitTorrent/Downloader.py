@@ -18,9 +18,11 @@
 '''
 from random import shuffle
 from time import time
+from collections import OrderedDict
 
 from BitTorrent.CurrentRateMeasure import Measure
 from BitTorrent.bitfield import Bitfield
+from BitTorrent.EndGame import EndGame
 
 
 class PerIPStats(object):
@@ -77,11 +79,14 @@ class SingleDownload(object):
         self.connection = connection
         self.choked = True
         self.interested = False
-        self.active_requests = []
+        # requests sent and not answered yet, in the order they were sent
+        self.active_requests = OrderedDict()
         self.measure = Measure(downloader.config['max_rate_period'])
         self.peermeasure = Measure(max(downloader.storage.piece_size / 10000,
                                        20))
         self.have = Bitfield(downloader.numpieces)
+        # counted by the picker as a seed rather than piece by piece
+        self.seed = False
         self.last = 0
         self.example_interest = None
         self.backlog = 2
@@ -97,9 +102,12 @@ class SingleDownload(object):
 
     def disconnected(self):
         self.downloader.lost_peer(self)
-        for i in xrange(len(self.have)):
-            if self.have[i]:
-                self.downloader.picker.lost_have(i)
+        if self.downloader.streamer is not None:
+            self.downloader.streamer.choked_changed()
+        if self.seed:
+            self.downloader.picker.lost_seed()
+        else:
+            self.downloader.picker.lost_have_bitfield(self.have)
         self._letgo()
         self.guard.download = None
 
@@ -107,14 +115,25 @@ class SingleDownload(object):
         if not self.active_requests:
             return
         if self.downloader.storage.endgame:
-            self.active_requests = []
+            self.downloader.endgame.lost(self, self.active_requests)
+            self.active_requests = OrderedDict()
+            # the blocks may go to peers they were capped for
+            for d in self.downloader.downloads:
+                if d is not self and not d.choked:
+                    d.fix_download_endgame()
             return
         lost = []
-        for index, begin, length in self.active_requests:
+        duplicates = self.downloader.duplicates
+        for request in self.active_requests:
+            if request in duplicates:
+                # the other peer asked for it may still send it
+                del duplicates[request]
+                continue
+            index, begin, length = request
             self.downloader.storage.request_lost(index, begin, length)
             if index not in lost:
                 lost.append(index)
-        self.active_requests = []
+        self.active_requests = OrderedDict()
         ds = [d for d in self.downloader.downloads if not d.choked]
         shuffle(ds)
         for d in ds:
@@ -130,63 +149,62 @@ class SingleDownload(object):
     def got_choke(self):
         if not self.choked:
             self.choked = True
+            if self.downloader.streamer is not None:
+                self.downloader.streamer.choked_changed()
             self._letgo()
 
     def got_unchoke(self):
         if self.choked:
             self.choked = False
+            if self.downloader.streamer is not None:
+                self.downloader.streamer.choked_changed()
             if self.interested:
                 self._request_more()
 
     def got_piece(self, index, begin, piece):
+        request = (index, begin, len(piece))
         try:
-            self.active_requests.remove((index, begin, len(piece)))
-        except ValueError:
+            del self.active_requests[request]
+        except KeyError:
             self.downloader.discarded_bytes += len(piece)
-            return False
+            return
+        if request in self.downloader.duplicates:
+            self.downloader.cancel_duplicate(self, request)
         if self.downloader.storage.endgame:
-            self.downloader.all_requests.remove((index, begin, len(piece)))
+            requesters = self.downloader.endgame.received(request)
         self.last = time()
         self.measure.update_rate(len(piece))
         self.downloader.measurefunc(len(piece))
         self.downloader.downmeasure.update_rate(len(piece))
+        # the hash check result comes later through Downloader.piece_checked
         if not self.downloader.storage.piece_came_in(index, begin, piece,
                                                      self.guard):
-            if self.downloader.storage.endgame:
-                while self.downloader.storage.do_I_have_requests(index):
-                    nb, nl = self.downloader.storage.new_request(index)
-                    self.downloader.all_requests.append((index, nb, nl))
-                for d in self.downloader.downloads:
-                    d.fix_download_endgame()
-                return False
-            ds = [d for d in self.downloader.downloads if not d.choked]
-            shuffle(ds)
-            for d in ds:
-                d._request_more([index])
-            return False
-        if self.downloader.storage.do_I_have(index):
-            self.downloader.picker.complete(index)
+            return
+        if self.connection.closed:
+            # closed as a seed when this piece completed the download
+            return
         if self.downloader.storage.endgame:
+            for d in requesters:
+                if d is not self:
+                    try:
+                        del d.active_requests[request]
+                    except KeyError:
+                        continue
+                    d.connection.send_cancel(index, begin, len(piece))
+                    d.fix_download_endgame()
             for d in self.downloader.downloads:
-                if d is not self and d.interested:
-                    if d.choked:
-                        d.fix_download_endgame()
-                    else:
-                        try:
-                            d.active_requests.remove((index, begin, len(piece)))
-                        except ValueError:
-                            continue
-                        d.connection.send_cancel(index, begin, len(piece))
-                        d.fix_download_endgame()
+                if d.choked and d.interested:
+                    d.fix_download_endgame()
         self._request_more()
-        if self.downloader.picker.am_I_complete():
-            for d in [i for i in self.downloader.downloads if i.have.numfalse == 0]:
-                d.connection.close()
-        return self.downloader.storage.do_I_have(index)
 
     def _want(self, index):
         return self.have[index] and self.downloader.storage.do_I_have_requests(index)
 
+    def _want_later(self, index):
+        # pieces in the streaming window are left to the fastest peers
+        return self._want(index) and \
+               not self.downloader.streamer.in_window(index)
+
     def _request_more(self, indices = None):
         assert not self.choked
         if len(self.active_requests) >= self._backlog():
@@ -194,10 +212,25 @@ class SingleDownload(object):
         if self.downloader.storage.endgame:
             self.fix_download_endgame()
             return
+        if self.downloader.storage.is_backlogged():
+            # don't ask for more than the disk can keep up with
+            self.downloader.wait_for_disk()
+            return
         lost_interests = []
+        streamer = self.downloader.streamer
         while len(self.active_requests) < self.backlog:
             if indices is None:
-                interest = self.downloader.picker.next(self._want, self.have.numfalse == 0)
+                interest = None
+                if streamer is not None:
+                    interest = streamer.next(self)
+                    if interest is None:
+                        interest = self.downloader.picker.next(
+                            self._want_later, self.have,
+                            self.have.numfalse == 0)
+                if interest is None:
+                    # not streaming, or only the window is left
+                    interest = self.downloader.picker.next(
+                        self._want, self.have, self.have.numfalse == 0)
             else:
                 interest = None
                 for i in indices:
@@ -213,11 +246,21 @@ class SingleDownload(object):
             self.downloader.picker.requested(interest, self.have.numfalse == 0)
             while len(self.active_requests) < (self.backlog-2) * 5 + 2:
                 begin, length = self.downloader.storage.new_request(interest)
-                self.active_requests.append((interest, begin, length))
+                self.active_requests[(interest, begin, length)] = None
                 self.connection.send_request(interest, begin, length)
                 if not self.downloader.storage.do_I_have_requests(interest):
                     lost_interests.append(interest)
                     break
+        if streamer is not None and indices is None and \
+               len(self.active_requests) < self.backlog:
+            for request in streamer.duplicates(self)[:self.backlog -
+                                                 len(self.active_requests)]:
+                if not self.interested:
+                    self.interested = True
+                    self.connection.send_interested()
+                self.downloader.duplicates[request] = None
+                self.active_requests[request] = None
+                self.connection.send_request(*request)
         if not self.active_requests and self.interested:
             self.interested = False
             self.connection.send_not_interested()
@@ -232,35 +275,32 @@ class SingleDownload(object):
                         break
                 else:
                     continue
-                interest = self.downloader.picker.next(d._want, d.have.numfalse == 0)
+                interest = self.downloader.picker.next(d._want, d.have,
+                                                       d.have.numfalse == 0)
                 if interest is None:
                     d.interested = False
                     d.connection.send_not_interested()
                 else:
                     d.example_interest = interest
         if self.downloader.storage.endgame:
-            self.downloader.all_requests = []
-            for d in self.downloader.downloads:
-                self.downloader.all_requests.extend(d.active_requests)
-            for d in self.downloader.downloads:
-                d.fix_download_endgame()
+            self.downloader.start_endgame()
 
     def fix_download_endgame(self):
-        want = [a for a in self.downloader.all_requests if self.have[a[0]] and a not in self.active_requests]
-        if self.interested and not self.active_requests and not want:
+        endgame = self.downloader.endgame
+        interesting = endgame.interesting(self)
+        if self.interested and not self.active_requests and not interesting:
             self.interested = False
             self.connection.send_not_interested()
             return
-        if not self.interested and want:
+        if not self.interested and interesting:
             self.interested = True
             self.connection.send_interested()
         if self.choked or len(self.active_requests) >= self._backlog():
             return
-        shuffle(want)
-        del want[self.backlog - len(self.active_requests):]
-        self.active_requests.extend(want)
-        for piece, begin, length in want:
-            self.connection.send_request(piece, begin, length)
+        want = endgame.wanted(self, self.backlog - len(self.active_requests))
+        for request in want:
+            self.active_requests[request] = None
+            self.connection.send_request(*request)
 
     def got_have(self, index):
         if self.have[index]:
@@ -287,20 +327,21 @@ class SingleDownload(object):
 
     def got_have_bitfield(self, have):
         self.have = have
-        for i in xrange(len(self.have)):
-            if self.have[i]:
-                self.downloader.picker.got_have(i)
+        if have.complete():
+            self.seed = True
+            self.downloader.picker.got_seed()
+        else:
+            self.downloader.picker.got_have_bitfield(have)
         if self.downloader.picker.am_I_complete() and self.have.numfalse == 0:
             self.connection.close()
             return
         if self.downloader.storage.endgame:
-            for piece, begin, length in self.downloader.all_requests:
-                if self.have[piece]:
-                    self.interested = True
-                    self.connection.send_interested()
-                    return
-        for i in xrange(len(self.have)):
-            if self.have[i] and self.downloader.storage.do_I_have_requests(i):
+            if self.downloader.endgame.interesting(self):
+                self.interested = True
+                self.connection.send_interested()
+            return
+        for i in have.andnot(self.downloader.storage.have).indices():
+            if self.downloader.storage.do_I_have_requests(i):
                 self.interested = True
                 self.connection.send_interested()
                 return
@@ -330,6 +371,91 @@ class Downloader(object):
         self.perip = {}
         self.bad_peers = {}
         self.discarded_bytes = 0
+        self.waiting_for_disk = False
+        # set when streaming, with the requests that went to two peers
+        self.streamer = None
+        self.duplicates = {}
+        # the outstanding blocks once everything has been requested
+        self.endgame = None
+        storage.checked_func = self.piece_checked
+
+    def start_endgame(self):
+        endgame = EndGame(self.config['max_endgame_requests'])
+        for d in self.downloads:
+            for request in d.active_requests:
+                endgame.add(request, d)
+        self.endgame = endgame
+        # endgame asks more than one peer anyway
+        self.duplicates = {}
+        for d in self.downloads:
+            d.fix_download_endgame()
+
+    def _add_to_endgame(self, indices):
+        # pieces to download again after endgame started
+        for index in indices:
+            while self.storage.do_I_have_requests(index):
+                nb, nl = self.storage.new_request(index)
+                self.endgame.add((index, nb, nl))
+        for d in self.downloads:
+            d.fix_download_endgame()
+
+    def piece_checked(self, index, ok):
+        if not ok:
+            if self.storage.endgame:
+                self._add_to_endgame([index])
+                return
+            ds = [d for d in self.downloads if not d.choked]
+            shuffle(ds)
+            for d in ds:
+                d._request_more([index])
+            return
+        self.picker.complete(index)
+        if self.streamer is not None:
+            self.streamer.piece_done()
+        for d in self.downloads:
+            d.connection.send_have(index)
+        if self.picker.am_I_complete():
+            for d in [i for i in self.downloads if i.have.numfalse == 0]:
+                d.connection.close()
+
+    def priorities_changed(self):
+        # peers may have pieces we want now, the rest find out we aren't
+        # interested when their requests run out
+        if self.storage.endgame:
+            # skipping files may have got us there
+            if self.endgame is None:
+                self.start_endgame()
+            else:
+                self._add_to_endgame(xrange(self.numpieces))
+            return
+        for d in self.downloads:
+            if d.interested or self.picker.next(d._want, d.have,
+                                                d.have.numfalse == 0) is None:
+                continue
+            if d.choked:
+                d.interested = True
+                d.connection.send_interested()
+            else:
+                d._request_more()
+
+    def cancel_duplicate(self, download, request):
+        # download sent it, the other peer doesn't need to
+        del self.duplicates[request]
+        for d in self.downloads:
+            if d is not download and request in d.active_requests:
+                del d.active_requests[request]
+                d.connection.send_cancel(*request)
+
+    def wait_for_disk(self):
+        if not self.waiting_for_disk:
+            self.waiting_for_disk = True
+            self.storage.notify_when_drained(self._disk_drained)
+
+    def _disk_drained(self):
+        self.waiting_for_disk = False
+        for d in self.downloads:
+            if not d.choked:
+                d._request_more()
 
     def make_download(self, connection):
         ip = connection.ip
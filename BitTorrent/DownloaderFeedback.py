@@ -113,6 +113,23 @@ class DownloaderFeedback(object):
         status['storage_active'] = len(self.storage.stat_active)
         status['storage_new'] = len(self.storage.stat_new)
         status['storage_numflunked'] = self.storage.stat_numflunked
+        status['storage_cache_hits'] = self.storage.stat_cache_hits
+        status['storage_cache_misses'] = self.storage.stat_cache_misses
+        status['storage_assembled'] = self.storage.stat_assembled
+        status['storage_evicted'] = self.storage.stat_evicted
+        status['storage_hashed_inline'] = self.storage.stat_hashed_inline
+        status['storage_hashed_reread'] = self.storage.stat_hashed_reread
+        filepool = self.storage.storage.filepool
+        status['filepool_open'] = len(filepool.handles)
+        status['filepool_opens'] = filepool.stat_opens
+        status['filepool_closes'] = filepool.stat_closes
+        status['filepool_evictions'] = filepool.stat_evictions
+        streamer = self.downloader.streamer
+        if streamer is not None:
+            # seconds until playback could start, None before that
+            status['stream_first_byte'] = streamer.first_byte
+            status['stream_stalls'] = streamer.stalls
+            status['stream_position'] = streamer.position
 
         if spewflag:
             status['spew'] = self.collect_spew()
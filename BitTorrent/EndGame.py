@@ -0,0 +1,129 @@
+# coding: utf-8
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+'''
+@note:
+终局模式的请求索引。定义于BitTorrent/EndGame.py中，所有块都已请求出去以后由
+Downloader 创建。把还没收到的块按 (块号, 起始位置) 记下，每块记着向哪些对方
+请求过，同一块最多同时向 max_endgame_requests 个对方请求。收到一块时直接找到
+要取消的对方，不用再扫描所有请求的列表。没到上限的块按请求过的对方数分桶，
+挑块时从对方数最少的桶取，不用扫描排序所有的块。
+'''
+
+
+class EndGame(object):
+
+    def __init__(self, max_requesters):
+        self.max_requesters = max_requesters
+        # {(index, begin): (length, {download: None})}
+        self.blocks = {}
+        # {index: {begin: None}} of the blocks above
+        self.pieces = {}
+        # the same for the blocks asked from n peers, for n under the cap
+        self.under = [{} for i in xrange(max_requesters)]
+        # {download: {index: number of blocks asked from it}}
+        self.asked = {}
+
+    def _move(self, index, begin, old, new):
+        # block went from old to new requesters
+        if old < self.max_requesters:
+            begins = self.under[old][index]
+            del begins[begin]
+            if not begins:
+                del self.under[old][index]
+        if new < self.max_requesters:
+            self.under[new].setdefault(index, {})[begin] = None
+
+    def _ask(self, download, index, begin):
+        requesters = self.blocks[(index, begin)][1]
+        self._move(index, begin, len(requesters), len(requesters) + 1)
+        requesters[download] = None
+        asked = self.asked.setdefault(download, {})
+        asked[index] = asked.get(index, 0) + 1
+
+    def _forget(self, download, index):
+        asked = self.asked[download]
+        asked[index] -= 1
+        if not asked[index]:
+            del asked[index]
+            if not asked:
+                del self.asked[download]
+
+    def add(self, request, download = None):
+        # an outstanding block, and a peer it was asked from
+        index, begin, length = request
+        block = self.blocks.get((index, begin))
+        if block is None:
+            block = self.blocks[(index, begin)] = (length, {})
+            self.pieces.setdefault(index, {})[begin] = None
+            self._move(index, begin, self.max_requesters, 0)
+        if download is not None and download not in block[1]:
+            self._ask(download, index, begin)
+
+    def received(self, request):
+        # returns the peers it was asked from
+        index, begin, length = request
+        block = self.blocks.pop((index, begin), None)
+        if block is None:
+            return {}
+        begins = self.pieces[index]
+        del begins[begin]
+        if not begins:
+            del self.pieces[index]
+        requesters = block[1]
+        self._move(index, begin, len(requesters), self.max_requesters)
+        for download in requesters:
+            self._forget(download, index)
+        return requesters
+
+    def lost(self, download, requests):
+        # download won't send these
+        for index, begin, length in requests:
+            block = self.blocks.get((index, begin))
+            if block is not None and download in block[1]:
+                requesters = block[1]
+                del requesters[download]
+                self._move(index, begin, len(requesters) + 1,
+                           len(requesters))
+                self._forget(download, index)
+
+    def interesting(self, download):
+        # whether there is a block download has that it wasn't asked for
+        asked = self.asked.get(download, {})
+        for index, begins in self.pieces.iteritems():
+            if download.have[index] and asked.get(index, 0) < len(begins):
+                return True
+        return False
+
+    def wanted(self, download, amount):
+        # up to amount blocks to ask download for, the ones asked from the
+        # fewest peers first, now counted as asked from download too
+        blocks = self.blocks
+        asked = self.asked.get(download, {})
+        r = []
+        for under in self.under:
+            for index, begins in under.iteritems():
+                if len(r) >= amount:
+                    break
+                # skip pieces download has all the blocks of
+                if not download.have[index] or \
+                       asked.get(index, 0) >= len(self.pieces[index]):
+                    continue
+                for begin in begins:
+                    if download not in blocks[(index, begin)][1]:
+                        r.append((index, begin))
+                        if len(r) >= amount:
+                            break
+            if len(r) >= amount:
+                break
+        for index, begin in r:
+            self._ask(download, index, begin)
+        return [(index, begin, blocks[(index, begin)][0])
+                for index, begin in r]
@@ -0,0 +1,189 @@
+# coding: utf-8
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+
+'''
+@note:
+启动时校验已有数据。把要校验的片按连续区段分给一个进程池，每个进程用大块顺序读
+取文件并计算SHA1，不受GIL限制。进程池由Multitorrent在启动其它线程之前创建，所有
+种子共用，只在POSIX上使用。每个种子排队的区段不超过进程数的两倍，停止时只等这些
+做完。进程数为0(默认)时在调用线程中校验。
+'''
+import os
+from bisect import bisect_left, bisect_right
+from binascii import b2a_hex
+from collections import deque
+from sha import sha
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+# bytes per read
+READ_SIZE = 2 ** 22
+# bytes of pieces handed to a worker at once
+JOB_SIZE = 2 ** 24
+
+
+def toint(s):
+    return int(b2a_hex(s), 16)
+
+
+def find_partial(data, mark, slice_size, numpieces):
+    """Look for the marks written into unfinished slices of a piece.
+    Returns (index, offsets of the finished slices) or None."""
+    index = None
+    missing = False
+    marklen = len(mark) + 4
+    for i in xrange(0, len(data) - marklen, slice_size):
+        if data[i:i+marklen-4] == mark:
+            ind = toint(data[i+marklen-4:i+marklen])
+            if index is None:
+                index = ind
+                parts = []
+            if ind >= numpieces or ind != index:
+                return None
+            parts.append(i)
+        else:
+            missing = True
+    if index is None or not missing:
+        return None
+    i += slice_size
+    if i < len(data):
+        parts.append(i)
+    return index, parts
+
+
+def _read(handles, ranges, begins, pos, amount):
+    r = []
+    stop = pos + amount
+    p = bisect_right(begins, pos) - 1
+    while p < len(ranges) and ranges[p][0] < stop:
+        begin, end, filename = ranges[p]
+        h = handles.get(filename)
+        if h is None:
+            h = handles[filename] = file(filename, 'rb')
+        h.seek(max(pos, begin) - begin)
+        length = min(end, stop) - max(pos, begin)
+        s = h.read(length)
+        if len(s) != length:
+            raise IOError('error reading data from ' + filename)
+        r.append(s)
+        p += 1
+    return ''.join(r)
+
+
+def hash_pieces(job):
+    """Hash the pieces at positions start to stop. Returns a list of
+    (position, digest, digest of the first lastlen bytes, partial)."""
+    (ranges, piece_size, total_length, start, stop, lastlen, mark,
+     slice_size, numpieces) = job
+    begins = [x[0] for x in ranges]
+    handles = {}
+    r = []
+    per_read = max(1, READ_SIZE // piece_size)
+    try:
+        for first in xrange(start, stop, per_read):
+            last = min(first + per_read, stop)
+            pos = first * piece_size
+            data = _read(handles, ranges, begins, pos,
+                         min(last * piece_size, total_length) - pos)
+            for i in xrange(first, last):
+                offset = (i - first) * piece_size
+                piece = data[offset:offset + piece_size]
+                sh = sha(buffer(piece, 0, lastlen))
+                sp = sh.digest()
+                sh.update(buffer(piece, lastlen))
+                r.append((i, sh.digest(), sp,
+                          find_partial(piece, mark, slice_size, numpieces)))
+    finally:
+        for h in handles.itervalues():
+            h.close()
+    return r
+
+
+def make_jobs(ranges, piece_size, total_length, positions, lastlen, mark,
+              slice_size, numpieces):
+    # each job carries only the files it reads from
+    begins = [x[0] for x in ranges]
+    def job(start, stop):
+        first = max(0, bisect_right(begins, start * piece_size) - 1)
+        last = bisect_left(begins, min(stop * piece_size, total_length))
+        return (ranges[first:last], piece_size, total_length, start, stop,
+                lastlen, mark, slice_size, numpieces)
+    jobs = []
+    per_job = max(1, JOB_SIZE // piece_size)
+    start = None
+    for i in positions:
+        if start is not None and (i != stop or stop - start >= per_job):
+            jobs.append(job(start, stop))
+            start = None
+        if start is None:
+            start = i
+        stop = i + 1
+    if start is not None:
+        jobs.append(job(start, stop))
+    return jobs
+
+
+class HashChecker(object):
+
+    def __init__(self, processes):
+        # -1 means one process per CPU. The workers are forked right away,
+        # before the caller starts other threads, and only on POSIX.
+        if multiprocessing is None or os.name != 'posix':
+            processes = 0
+        elif processes < 0:
+            try:
+                processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                processes = 1
+        self.processes = processes
+        self.pool = None
+        if processes:
+            self.pool = multiprocessing.Pool(processes)
+
+    def check(self, ranges, piece_size, total_length, positions, lastlen,
+              mark, slice_size, numpieces, flag, progress):
+        """Hash the pieces at positions, in worker processes if there are
+        any. Returns {position: (digest, lastlen digest, partial)}, stops
+        early if flag is set."""
+        jobs = make_jobs(ranges, piece_size, total_length, positions,
+                         lastlen, mark, slice_size, numpieces)
+        r = {}
+        def got(result):
+            for i, s, sp, partial in result:
+                r[i] = (s, sp, partial)
+            progress(len(r) / float(len(positions)))
+        if self.pool is None:
+            for job in jobs:
+                if flag.isSet():
+                    break
+                got(hash_pieces(job))
+            return r
+        # jobs are handed to the shared pool a few at a time, so stopping
+        # only waits for the ones already there
+        jobs = iter(jobs)
+        pending = deque()
+        while True:
+            while len(pending) < self.processes * 2 and not flag.isSet():
+                job = next(jobs, None)
+                if job is None:
+                    break
+                pending.append(self.pool.apply_async(hash_pieces, (job,)))
+            if not pending:
+                return r
+            got(pending.popleft().get())
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -0,0 +1,79 @@
+# coding: utf-8
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+'''
+@note:
+上传用的整块读缓存。在 Multitorrent 中创建，所有种子共用一个内存上限，
+超出上限时按 LRU 淘汰最久没有用到的块。WriteBudget 是下载时在内存中拼装
+整块所用内存的共用上限。
+'''
+from collections import OrderedDict
+
+
+class PieceCache(object):
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        # {(owner, index): data}, least recently used first
+        self.pieces = OrderedDict()
+
+    def get(self, owner, index):
+        # returns None on a miss
+        key = (owner, index)
+        data = self.pieces.pop(key, None)
+        if data is not None:
+            self.pieces[key] = data
+        return data
+
+    def add(self, owner, index, data):
+        if len(data) > self.max_size:
+            return
+        key = (owner, index)
+        old = self.pieces.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.pieces[key] = data
+        self.size += len(data)
+        self._shrink(self.max_size)
+
+    def remove_owner(self, owner):
+        for key in [k for k in self.pieces if k[0] is owner]:
+            self.size -= len(self.pieces.pop(key))
+
+    def set_max_size(self, max_size):
+        self.max_size = max_size
+        self._shrink(max_size)
+
+    def _shrink(self, max_size):
+        while self.size > max_size:
+            key, data = self.pieces.popitem(False)
+            self.size -= len(data)
+
+
+class WriteBudget(object):
+    # memory shared by the pieces StorageWrapper assembles before writing
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+
+    def reserve(self, amount):
+        if self.size + amount > self.max_size:
+            return False
+        self.size += amount
+        return True
+
+    def release(self, amount):
+        self.size -= amount
+
+    def set_max_size(self, max_size):
+        # pieces over the new limit are pushed to disk as blocks come in
+        self.max_size = max_size
@@ -15,63 +15,244 @@
 块选取器。定义于BitTorrent/PiecePicker.py中，进行“下一块下载哪块”这件事情的决策工作，
 与_SingleTorrent一一对应。 
 '''
-from random import randrange, shuffle, choice
+from random import randrange, choice
+
+from BitTorrent.bitfield import Bitfield
+
+# file and piece priorities
+SKIP = -1
+NORMAL = 0
+HIGH = 1
+
+# how many of the rarest pieces next() asks about before ANDing bitsets
+RAREST_SAMPLE = 32
+
+
+def piece_priorities(priorities, sizes, piece_size):
+    # a piece gets the highest priority of the files it has data from
+    total = sum(sizes)
+    r = [SKIP] * ((total + piece_size - 1) // piece_size)
+    pos = 0
+    for priority, size in zip(priorities, sizes):
+        if size:
+            for i in xrange(pos // piece_size,
+                            (pos + size - 1) // piece_size + 1):
+                if r[i] < priority:
+                    r[i] = priority
+        pos += size
+    return r
 
 
 class PiecePicker(object):
+    # How many peers have each piece is kept as bitsets, levels[i] holding
+    # the pieces no more than i peers have, as longs laid out like
+    # Bitfield.toint(). A whole bitfield moves its pieces up a level with
+    # a couple of operations per level, a piece's count is found by
+    # bisecting the levels, and next() ANDs a peer's bitfield with them
+    # instead of asking about every piece. Most peers have one of the
+    # rarest few pieces, so next() first asks about a sample of those,
+    # kept as lists per level.
 
     def __init__(self, numpieces, config):
         self.config = config
         self.numpieces = numpieces
-        self.interests = [range(numpieces)]
-        self.pos_in_interests = range(numpieces)
-        self.numinterests = [0] * numpieces
+        # bits in a bitfield's long, piece i is bit nbits - 1 - i
+        self.nbits = (numpieces + 7) // 8 * 8
+        self.all = ((1 << numpieces) - 1) << (self.nbits - numpieces)
+        # not counting seeds; the last level has every piece
+        self.levels = [self.all]
+        # all pieces we don't have
+        self.wanted = self.all
+        self.seeds = 0
         self.have = [False] * numpieces
-        self.crosscount = [numpieces]
         self.started = []
         self.seedstarted = []
+        # pieces which failed the hash check, picked last of their rarity
+        self.bumped = {}
+        # masks of the pieces to pick from, in order, None for all of them
+        self.selections = [None]
+        # Bitfield of the first selection, None for all pieces
+        self.first = None
         self.numgot = 0
-        self.scrambled = range(numpieces)
-        shuffle(self.scrambled)
+        # lists of the wanted pieces of the first selection at levels
+        # rarelevel on, every one of them but the last list's, None when
+        # they have to be found again
+        self.rarest = None
+        self.rarelevel = 0
+        self.rarecount = 0
 
-    def got_have(self, piece):
-        numint = self.numinterests[piece]
-        self.crosscount[numint + self.have[piece]] -= 1
-        self.numinterests[piece] += 1
-        try:
-            self.crosscount[numint + 1 + self.have[piece]] += 1
-        except IndexError:
-            self.crosscount.append(1)
-        if self.have[piece]:
+    def get_numinterests(self, piece):
+        # how many peers have piece, not counting seeds
+        k = self.nbits - 1 - piece
+        levels = self.levels
+        lo = 0
+        hi = len(levels) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if levels[mid] >> k & 1:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _get_crosscount(self):
+        # number of pieces by copies, ours included
+        wanted = self.wanted
+        got = self.all ^ wanted
+        crosscount = [0] * (len(self.levels) + 1)
+        below = 0
+        for i, level in enumerate(self.levels):
+            exact = level ^ below
+            crosscount[i] += bin(exact & wanted).count('1')
+            crosscount[i + 1] += bin(exact & got).count('1')
+            below = level
+        while len(crosscount) > 1 and not crosscount[-1]:
+            del crosscount[-1]
+        # seeds are left out of the levels, no piece has fewer copies
+        return [0] * self.seeds + crosscount
+    crosscount = property(_get_crosscount)
+
+    def set_priorities(self, priorities):
+        # HIGH pieces are picked before the rest, SKIP ones never
+        if priorities.count(NORMAL) == len(priorities):
+            self.selections = [None]
+            self.first = None
+            self.rarest = None
             return
-        if numint == len(self.interests) - 1:
-            self.interests.append([])
-        self._shift_over(piece, self.interests[numint], self.interests[numint + 1])
+        high = Bitfield(self.numpieces)
+        normal = Bitfield(self.numpieces)
+        for piece, priority in enumerate(priorities):
+            if priority == HIGH:
+                high[piece] = True
+            elif priority == NORMAL:
+                normal[piece] = True
+        # everything skipped leaves an empty one, nothing to pick
+        selections = [b for b in (high, normal) if b.count()] or [high]
+        self.selections = [b.toint() for b in selections]
+        self.first = selections[0]
+        self.rarest = None
+
+    def got_seed(self):
+        self.seeds += 1
+        self.rarest = None
+
+    def lost_seed(self):
+        self.seeds -= 1
+        self.rarest = None
+
+    def got_have_bitfield(self, have):
+        # every piece in have moves up a level
+        h = have.toint()
+        nh = ~h
+        levels = self.levels
+        levels.append(self.all)
+        for i in xrange(len(levels) - 2, 0, -1):
+            levels[i] = levels[i] & nh | levels[i - 1] & h
+        levels[0] &= nh
+        self._trim()
+        self.rarest = None
+
+    def lost_have_bitfield(self, have):
+        h = have.toint()
+        nh = ~h
+        levels = self.levels
+        for i in xrange(len(levels) - 1):
+            levels[i] = levels[i] & nh | levels[i + 1] & h
+        self._trim()
+        self.rarest = None
+
+    def _trim(self):
+        levels = self.levels
+        while len(levels) > 1 and levels[-2] == self.all:
+            del levels[-1]
+
+    def got_have(self, piece):
+        numint = self.get_numinterests(piece)
+        levels = self.levels
+        if numint == len(levels) - 1:
+            levels.append(self.all)
+        levels[numint] ^= 1 << (self.nbits - 1 - piece)
+        self._moved(piece, numint + 1)
 
     def lost_have(self, piece):
-        numint = self.numinterests[piece]
-        self.crosscount[numint + self.have[piece]] -= 1
-        self.numinterests[piece] -= 1
-        self.crosscount[numint - 1 + self.have[piece]] += 1
-        if self.have[piece]:
+        numint = self.get_numinterests(piece)
+        self.levels[numint - 1] |= 1 << (self.nbits - 1 - piece)
+        self._trim()
+        self._moved(piece, numint - 1)
+
+    def _moved(self, piece, numint):
+        # keep the rarest lists whole after piece went to level numint
+        if self.rarest is None or self.have[piece] or \
+               self.first is not None and not self.first[piece]:
             return
-        self._shift_over(piece, self.interests[numint], self.interests[numint - 1])
-
-    def _shift_over(self, piece, l1, l2):
-        p = self.pos_in_interests[piece]
-        l1[p] = l1[-1]
-        self.pos_in_interests[l1[-1]] = p
-        del l1[-1]
-        newp = randrange(len(l2) + 1)
-        if newp == len(l2):
-            self.pos_in_interests[piece] = len(l2)
-            l2.append(piece)
-        else:
-            old = l2[newp]
-            self.pos_in_interests[old] = len(l2)
-            l2.append(old)
-            l2[newp] = piece
-            self.pos_in_interests[piece] = newp
+        rarest = self.rarest
+        i = numint - self.rarelevel
+        if i < 0:
+            self.rarest = None
+            return
+        for pieces in rarest:
+            if piece in pieces:
+                pieces.remove(piece)
+                self.rarecount -= 1
+                break
+        if i < len(rarest) - 1:
+            rarest[i].append(piece)
+            self.rarecount += 1
+        elif not self.rarecount:
+            self.rarest = None
+
+    def _not_rarest(self, piece):
+        if self.rarest is None:
+            return
+        for pieces in self.rarest:
+            if piece in pieces:
+                pieces.remove(piece)
+                self.rarecount -= 1
+                if not self.rarecount:
+                    self.rarest = None
+                return
+
+    def _find_rarest(self):
+        # every wanted piece of the lowest levels with any, up to about
+        # RAREST_SAMPLE of them, the last level's from a random place on
+        w = self.wanted
+        if self.selections[0] is not None:
+            w &= self.selections[0]
+        levels = self.levels
+        below = 0
+        if not self.seeds:
+            below = levels[0] & w
+        r = []
+        n = 0
+        for i in xrange(not self.seeds, len(levels)):
+            c = levels[i] & w
+            if c != below or r:
+                if not r:
+                    self.rarelevel = i
+                pieces = self._sample(c ^ below, RAREST_SAMPLE - n)
+                r.append(pieces)
+                n += len(pieces)
+                if n >= RAREST_SAMPLE:
+                    break
+            below = c
+        self.rarest = r
+        self.rarecount = n
+
+    def _sample(self, c, n):
+        # up to n pieces in c from a random place on, wrapping around
+        if not c:
+            return []
+        s = bin(c)
+        # s[j] is piece j + offset
+        offset = self.nbits - len(s)
+        start = max(2, randrange(self.numpieces) - offset)
+        r = []
+        for begin, end in ((start, len(s)), (2, start)):
+            j = s.find('1', begin, end)
+            while j != -1 and len(r) < n:
+                r.append(j + offset)
+                j = s.find('1', j + 1, end)
+        return r
 
     def requested(self, piece, seed = False):
         if piece not in self.started:
@@ -82,24 +263,19 @@ class PiecePicker(object):
     def complete(self, piece):
         assert not self.have[piece]
         self.have[piece] = True
-        self.crosscount[self.numinterests[piece]] -= 1
-        try:
-            self.crosscount[self.numinterests[piece] + 1] += 1
-        except IndexError:
-            self.crosscount.append(1)
         self.numgot += 1
-        l = self.interests[self.numinterests[piece]]
-        p = self.pos_in_interests[piece]
-        l[p] = l[-1]
-        self.pos_in_interests[l[-1]] = p
-        del l[-1]
+        self.wanted ^= 1 << (self.nbits - 1 - piece)
+        self.bumped.pop(piece, None)
+        self._not_rarest(piece)
         try:
             self.started.remove(piece)
             self.seedstarted.remove(piece)
         except ValueError:
             pass
 
-    def next(self, havefunc, seed = False):
+    def next(self, havefunc, have, seed = False):
+        # have is the peer's Bitfield, havefunc says which of its pieces
+        # we can still ask for
         bests = None
         bestnum = 2 ** 30
         if seed:
@@ -108,34 +284,74 @@ class PiecePicker(object):
             s = self.started
         for i in s:
             if havefunc(i):
-                if self.numinterests[i] < bestnum:
+                numint = self.get_numinterests(i)
+                if numint < bestnum:
                     bests = [i]
-                    bestnum = self.numinterests[i]
-                elif self.numinterests[i] == bestnum:
+                    bestnum = numint
+                elif numint == bestnum:
                     bests.append(i)
         if bests:
             return choice(bests)
-        if self.numgot < self.config['rarest_first_cutoff']:
-            for i in self.scrambled:
-                if havefunc(i):
-                    return i
-            return None
-        for i in xrange(1, min(bestnum, len(self.interests))):
-            for j in self.interests[i]:
-                if havefunc(j):
-                    return j
+        at_random = self.numgot < self.config['rarest_first_cutoff']
+        if not at_random:
+            if self.rarest is None:
+                self._find_rarest()
+            for pieces in self.rarest:
+                bumped = False
+                for piece in pieces:
+                    if have[piece] and havefunc(piece):
+                        if piece not in self.bumped:
+                            return piece
+                        bumped = True
+                # a bumped piece may still beat the rest of the level
+                if bumped:
+                    break
+        peer = have.toint() & self.wanted
+        levels = self.levels
+        for select in self.selections:
+            if select is not None:
+                p = peer & select
+            else:
+                p = peer
+            if at_random:
+                piece = self._pick(p, havefunc)
+                if piece is not None:
+                    return piece
+                continue
+            # pieces no peer has are only worth looking at if seeds have them
+            below = 0
+            if not self.seeds:
+                below = levels[0] & p
+            for i in xrange(not self.seeds, len(levels)):
+                c = levels[i] & p
+                if c != below:
+                    piece = self._pick(c ^ below, havefunc)
+                    if piece is not None:
+                        return piece
+                below = c
         return None
 
+    def _pick(self, c, havefunc):
+        # the first piece in c from a random place on, wrapping around
+        nbits = self.nbits
+        start = randrange(self.numpieces or 1)
+        after = c & ((1 << (nbits - start)) - 1)
+        bumped = None
+        for c in (after, c ^ after):
+            while c:
+                piece = nbits - c.bit_length()
+                if havefunc(piece):
+                    if piece not in self.bumped:
+                        return piece
+                    bumped = piece
+                c ^= 1 << (nbits - 1 - piece)
+        return bumped
+
     def am_I_complete(self):
         return self.numgot == self.numpieces
 
     def bump(self, piece):
-        l = self.interests[self.numinterests[piece]]
-        pos = self.pos_in_interests[piece]
-        del l[pos]
-        l.append(piece)
-        for i in range(pos,len(l)):
-            self.pos_in_interests[l[i]] = i
+        self.bumped[piece] = None
         try:
             self.started.remove(piece)
             self.seedstarted.remove(piece)
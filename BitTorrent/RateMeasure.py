@@ -43,6 +43,10 @@ class RateMeasure(object):
     def data_rejected(self, amount):
         self.left += amount
 
+    def adjust_left(self, amount):
+        # files skipped (amount < 0) or wanted again (amount > 0)
+        self.left += amount
+
     def get_time_left(self):
         if not self.got_anything:
             return None
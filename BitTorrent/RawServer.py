@@ -18,24 +18,88 @@
 '''
 import os
 import sys
-from bisect import insort
 import socket
 from cStringIO import StringIO
 from traceback import print_exc
 from errno import EWOULDBLOCK, ENOBUFS
 from time import time, sleep
+from bisect import bisect_left
+from collections import deque
 from BitTorrent import CRITICAL
-
-try:
-    from select import poll, error, POLLIN, POLLOUT, POLLERR, POLLHUP
-    timemult = 1000
-except ImportError:
-    from BitTorrent.selectpoll import poll, error, POLLIN, POLLOUT, POLLERR, POLLHUP
-    timemult = 1
+from BitTorrent.pollers import get_poller, error, POLLIN, POLLOUT, POLLERR, POLLHUP
+from BitTorrent.Scheduler import Scheduler
 
 
 all = POLLIN | POLLOUT
 
+# bytes asked from recv() at once
+READ_SIZE = 100000
+# with edge-triggered polling a socket is read until it would block; to keep
+# one busy peer from starving the rest, stop after this many reads and come
+# back to it on the next loop iteration
+MAX_READS_PER_EVENT = 4
+
+# python 2 has neither socket.sendmsg nor the MSG_MORE constant; each queued
+# buffer is sent on its own and MSG_MORE lets the kernel coalesce a small
+# header with the payload that follows it
+if sys.platform.startswith('linux'):
+    MSG_MORE = getattr(socket, 'MSG_MORE', 0x8000)
+else:
+    MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+# upper bounds in seconds of the idle time histogram buckets, the last bucket
+# counts everything longer
+IDLE_BUCKETS = (0.1, 1, 10, 60, 300)
+
+
+class IdleList(object):
+    """Sockets ordered by last receive time, least recently used first.
+
+    A doubly linked list threaded through the SingleSocket objects, so
+    touching, removing and finding the oldest socket are all O(1).
+    """
+
+    def __init__(self):
+        self.idle_prev = self.idle_next = self
+        self.length = 0
+
+    def append(self, s):
+        last = self.idle_prev
+        s.idle_prev = last
+        s.idle_next = self
+        last.idle_next = s
+        self.idle_prev = s
+        self.length += 1
+
+    def remove(self, s):
+        if s.idle_next is None:
+            return
+        s.idle_prev.idle_next = s.idle_next
+        s.idle_next.idle_prev = s.idle_prev
+        s.idle_prev = s.idle_next = None
+        self.length -= 1
+
+    def touch(self, s):
+        if s.idle_next is not self:
+            self.remove(s)
+            self.append(s)
+
+    def oldest(self):
+        # returns None if the list is empty
+        if self.idle_next is self:
+            return None
+        return self.idle_next
+
+    def __iter__(self):
+        s = self.idle_next
+        while s is not self:
+            next = s.idle_next
+            yield s
+            s = next
+
+    def __len__(self):
+        return self.length
+
 
 class SingleSocket(object):
 
@@ -43,8 +107,11 @@ class SingleSocket(object):
         self.raw_server = raw_server
         self.socket = sock
         self.handler = handler
-        self.buffer = []
+        # memoryviews of the data still to be sent
+        self.buffer = deque()
         self.last_hit = time()
+        self.idle_prev = self.idle_next = None
+        self.idle_histogram = [0] * (len(IDLE_BUCKETS) + 1)
         self.fileno = sock.fileno()
         self.connected = False
         self.context = context
@@ -65,8 +132,9 @@ class SingleSocket(object):
     def close(self):
         sock = self.socket
         self.socket = None
-        self.buffer = []
+        self.buffer = deque()
         del self.raw_server.single_sockets[self.fileno]
+        self.raw_server.idle_sockets.remove(self)
         self.raw_server.poll.unregister(sock)
         sock.close()
 
@@ -78,29 +146,45 @@ class SingleSocket(object):
 
     def write(self, s):
         assert self.socket is not None
-        self.buffer.append(s)
+        self.buffer.append(memoryview(s))
         if len(self.buffer) == 1:
             self.try_write()
 
+    def writev(self, l):
+        # queue several strings/buffers to be sent back to back, without
+        # joining them first
+        assert self.socket is not None
+        was_empty = not self.buffer
+        for s in l:
+            self.buffer.append(memoryview(s))
+        if was_empty and self.buffer:
+            self.try_write()
+
     def try_write(self):
         if self.connected:
             try:
-                while self.buffer != []:
-                    amount = self.socket.send(self.buffer[0])
-                    if amount != len(self.buffer[0]):
-                        if amount != 0:
-                            self.buffer[0] = self.buffer[0][amount:]
-                        break
-                    del self.buffer[0]
+                self._try_send()
             except socket.error, e:
                 code, msg = e
                 if code != EWOULDBLOCK:
                     self.raw_server.dead_from_write.append(self)
                     return
-        if self.buffer == []:
-            self.raw_server.poll.register(self.socket, POLLIN)
-        else:
-            self.raw_server.poll.register(self.socket, all)
+        self.raw_server._set_interest(self.socket, len(self.buffer) > 0)
+
+    def _try_send(self):
+        buffer = self.buffer
+        while buffer:
+            buf = buffer[0]
+            if len(buffer) > 1:
+                amount = self.socket.send(buf, MSG_MORE)
+            else:
+                amount = self.socket.send(buf)
+            if amount != len(buf):
+                if amount != 0:
+                    # a view of the rest, nothing gets copied
+                    buffer[0] = buf[amount:]
+                break
+            buffer.popleft()
 
 def default_error_handler(x, y):
     print x
@@ -109,23 +193,28 @@ def default_error_handler(x, y):
 class RawServer(object):
 
     def __init__(self, doneflag, timeout_check_interval, timeout, noisy = True,
-            errorfunc = default_error_handler, bindaddr = '', tos = 0):
+            errorfunc = default_error_handler, bindaddr = '', tos = 0,
+            poller = None):
         self.timeout_check_interval = timeout_check_interval
         self.timeout = timeout
         self.bindaddr = bindaddr
         self.tos = tos
-        self.poll = poll()
+        if poller is None:
+            poller = get_poller()
+        self.poll = poller
         # {socket: SingleSocket}
         self.single_sockets = {}
+        self.idle_sockets = IdleList()
         self.dead_from_write = []
+        # edge-triggered sockets that still had data after MAX_READS_PER_EVENT
+        self.pending_reads = []
         self.doneflag = doneflag
         self.noisy = noisy
         self.errorfunc = errorfunc
-        self.funcs = []
+        self.tasks = Scheduler()
         self.externally_added_tasks = []
         self.listening_handlers = {}
         self.serversockets = {}
-        self.live_contexts = {None : True}
         self.add_task(self.scan_for_timeouts, timeout_check_interval)
         if sys.platform != 'win32':
             self.wakeupfds = os.pipe()
@@ -138,16 +227,28 @@ class RawServer(object):
                 self.add_task(wakeup, 1)
             wakeup()
 
+    def _set_interest(self, sock, want_write):
+        # Edge-triggered sockets stay registered for both directions, so
+        # their registration never changes after the first call.
+        if want_write or self.poll.edge_triggered:
+            self.poll.register(sock, all, True)
+        else:
+            self.poll.register(sock, POLLIN, True)
+
     def add_context(self, context):
-        self.live_contexts[context] = True
+        self.tasks.add_context(context)
 
     def remove_context(self, context):
-        del self.live_contexts[context]
-        self.funcs = [x for x in self.funcs if x[2] != context]
+        # tasks of the context are dropped lazily when they come due
+        self.tasks.remove_context(context)
 
     def add_task(self, func, delay, context = None):
-        if context in self.live_contexts:
-            insort(self.funcs, (time() + delay, func, context))
+        # returns a handle with a cancel() method, or None if the context
+        # isn't live
+        return self.tasks.add(func, delay, context)
+
+    def get_scheduler_stats(self):
+        return self.tasks.get_stats()
 
     def external_add_task(self, func, delay, context = None):
         self.externally_added_tasks.append((func, delay, context))
@@ -158,13 +259,49 @@ class RawServer(object):
     def scan_for_timeouts(self):
         self.add_task(self.scan_for_timeouts, self.timeout_check_interval)
         t = time() - self.timeout
-        tokill = []
-        for s in self.single_sockets.values():
-            if s.last_hit < t:
-                tokill.append(s)
-        for k in tokill:
-            if k.socket is not None:
-                self._close_socket(k)
+        # only the expired head of the list needs looking at
+        while True:
+            s = self.idle_sockets.oldest()
+            if s is None or s.last_hit >= t:
+                break
+            self._close_socket(s)
+
+    def _add_single_socket(self, s):
+        self.single_sockets[s.fileno] = s
+        self.idle_sockets.append(s)
+
+    def _touch(self, s):
+        now = time()
+        h = s.idle_histogram
+        h[bisect_left(IDLE_BUCKETS, now - s.last_hit)] += 1
+        s.last_hit = now
+        self.idle_sockets.touch(s)
+
+    def get_idle_stats(self, per_socket = False):
+        """Idle time statistics for the open sockets.
+
+        'histogram' counts the gaps between receives over all sockets,
+        bucketed by IDLE_BUCKETS. With per_socket the 'sockets' entry lists
+        (ip, seconds idle now, histogram) for each socket, most idle first.
+        """
+        now = time()
+        total = [0] * (len(IDLE_BUCKETS) + 1)
+        sockets = []
+        for s in self.idle_sockets:
+            for i, n in enumerate(s.idle_histogram):
+                total[i] += n
+            if per_socket:
+                sockets.append((s.ip, now - s.last_hit, list(s.idle_histogram)))
+        oldest = self.idle_sockets.oldest()
+        if oldest is None:
+            max_idle = 0
+        else:
+            max_idle = now - oldest.last_hit
+        r = {'buckets': IDLE_BUCKETS, 'histogram': total,
+             'numsockets': len(self.idle_sockets), 'max_idle': max_idle}
+        if per_socket:
+            r['sockets'] = sockets
+        return r
 
     def create_serversocket(port, bind='', reuse=False, tos=0):
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -210,16 +347,16 @@ class RawServer(object):
         except Exception, e:
             sock.close()
             raise socket.error(str(e))
-        self.poll.register(sock, POLLIN)
+        self._set_interest(sock, False)
         s = SingleSocket(self, sock, handler, context, dns[0])
-        self.single_sockets[sock.fileno()] = s
+        self._add_single_socket(s)
         return s
 
     def wrap_socket(self, sock, handler, context = None, ip = None):
         sock.setblocking(0)
-        self.poll.register(sock, POLLIN)
+        self._set_interest(sock, False)
         s = SingleSocket(self, sock, handler, context, ip)
-        self.single_sockets[sock.fileno()] = s
+        self._add_single_socket(s)
         return s
 
     def _handle_events(self, events):
@@ -236,8 +373,8 @@ class RawServer(object):
                         newsock, addr = s.accept()
                         newsock.setblocking(0)
                         nss = SingleSocket(self, newsock, handler, context)
-                        self.single_sockets[newsock.fileno()] = nss
-                        self.poll.register(newsock, POLLIN)
+                        self._add_single_socket(nss)
+                        self._set_interest(newsock, False)
                         self._make_wrapped_call(handler. \
                            external_connection_made, (nss,), context = context)
                     except socket.error:
@@ -254,26 +391,67 @@ class RawServer(object):
                     self._close_socket(s)
                     continue
                 if event & (POLLIN | POLLHUP):
-                    s.last_hit = time()
-                    try:
-                        data = s.socket.recv(100000)
-                    except socket.error, e:
-                        code, msg = e
-                        if code != EWOULDBLOCK:
-                            self._close_socket(s)
+                    if not self._read_socket(s):
                         continue
-                    if data == '':
-                        self._close_socket(s)
-                    else:
-                        self._make_wrapped_call(s.handler.data_came_in,
-                                                (s, data), s)
                 # data_came_in could have closed the socket (s.socket = None)
-                if event & POLLOUT and s.socket is not None:
+                # Edge-triggered sockets always have POLLOUT registered, so
+                # only a socket with queued data has anything to flush.
+                if event & POLLOUT and s.socket is not None and \
+                       not s.is_flushed():
                     s.try_write()
                     if s.is_flushed():
                         self._make_wrapped_call(s.handler.connection_flushed,
                                                 (s,), s)
 
+    def _read_socket(self, s):
+        # returns False if the socket was closed
+        self._touch(s)
+        reads = 0
+        while True:
+            # Handlers with a get_read_buffer() method own a preallocated
+            # buffer that is filled in place, others get a new string.
+            get_read_buffer = getattr(s.handler, 'get_read_buffer', None)
+            try:
+                if get_read_buffer is not None:
+                    buf = get_read_buffer()
+                    wanted = len(buf)
+                    amount = s.socket.recv_into(buf)
+                else:
+                    wanted = READ_SIZE
+                    data = s.socket.recv(READ_SIZE)
+                    amount = len(data)
+            except socket.error, e:
+                code, msg = e
+                if code != EWOULDBLOCK:
+                    self._close_socket(s)
+                    return False
+                return True
+            if amount == 0:
+                self._close_socket(s)
+                return False
+            if get_read_buffer is not None:
+                self._make_wrapped_call(s.handler.read_buffer_filled,
+                                        (s, amount), s)
+            else:
+                self._make_wrapped_call(s.handler.data_came_in, (s, data), s)
+            if s.socket is None:
+                return False
+            # A short read means the kernel buffer was drained, so the next
+            # edge will report any new data.
+            if not self.poll.edge_triggered or amount < wanted:
+                return True
+            reads += 1
+            if reads == MAX_READS_PER_EVENT:
+                self.pending_reads.append(s)
+                return True
+
+    def _handle_pending_reads(self):
+        pending = self.pending_reads
+        self.pending_reads = []
+        for s in pending:
+            if s.socket is not None:
+                self._read_socket(s)
+
     def _pop_externally_added(self):
         while self.externally_added_tasks:
             task = self.externally_added_tasks.pop(0)
@@ -283,19 +461,24 @@ class RawServer(object):
         while not self.doneflag.isSet():
             try:
                 self._pop_externally_added()
-                if len(self.funcs) == 0:
+                nexttime = self.tasks.next_time()
+                if nexttime is None:
                     period = 1e9
                 else:
-                    period = self.funcs[0][0] - time()
-                if period < 0:
+                    period = nexttime - time()
+                if period < 0 or self.pending_reads:
                     period = 0
-                events = self.poll.poll(period * timemult)
+                events = self.poll.poll(period)
                 if self.doneflag.isSet():
                     return
-                while len(self.funcs) > 0 and self.funcs[0][0] <= time():
-                    garbage, func, context = self.funcs.pop(0)
-                    self._make_wrapped_call(func, (), context = context)
+                while True:
+                    task = self.tasks.pop_due(time())
+                    if task is None:
+                        break
+                    self._make_wrapped_call(task.func, (),
+                                            context = task.context)
                 self._close_dead()
+                self._handle_pending_reads()
                 self._handle_events(events)
                 if self.doneflag.isSet():
                     return
@@ -354,8 +537,10 @@ class RawServer(object):
 
     def _close_socket(self, s):
         sock = s.socket.fileno()
-        s.socket.close()
+        # unregister before closing, epoll can't look up a closed fd
         self.poll.unregister(sock)
+        s.socket.close()
         del self.single_sockets[sock]
+        self.idle_sockets.remove(s)
         s.socket = None
         self._make_wrapped_call(s.handler.connection_lost, (s,), s)
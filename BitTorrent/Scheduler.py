@@ -0,0 +1,141 @@
+# coding: utf-8
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+'''
+@note:
+RawServer 的定时任务队列。用二叉堆保存任务，插入和取出都是 O(log n)。
+取消任务（单个取消或者整个 context 被移除）只做标记，任务在到期出堆时才被丢弃；
+失效的任务过多时整体重建一次堆。
+'''
+from heapq import heappush, heappop, heapify
+from time import time
+
+# rebuild the heap once this many entries are dead and they make up more
+# than half of it
+COMPACT_THRESHOLD = 256
+
+
+class Task(object):
+
+    __slots__ = ('scheduler', 'when', 'func', 'context', 'token', 'cancelled')
+
+    def __init__(self, scheduler, when, func, context, token):
+        self.scheduler = scheduler
+        self.when = when
+        self.func = func
+        self.context = context
+        self.token = token
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.scheduler._task_died(self)
+
+
+class Scheduler(object):
+
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+        # {context: token}, a context removed and added again gets a new
+        # token so its old tasks stay dead
+        self.live_contexts = {None: object()}
+        # number of queued live tasks per context
+        self.context_tasks = {}
+        self.numdead = 0
+        self.numrun = 0
+        self.total_lateness = 0.
+        self.max_lateness = 0.
+
+    def add_context(self, context):
+        self.live_contexts[context] = object()
+
+    def remove_context(self, context):
+        del self.live_contexts[context]
+        self.numdead += self.context_tasks.pop(context, 0)
+        self._maybe_compact()
+
+    def add(self, func, delay, context = None):
+        token = self.live_contexts.get(context)
+        if token is None:
+            return None
+        task = Task(self, time() + delay, func, context, token)
+        self.seq += 1
+        heappush(self.heap, (task.when, self.seq, task))
+        self.context_tasks[context] = self.context_tasks.get(context, 0) + 1
+        return task
+
+    def _alive(self, task):
+        return not task.cancelled and \
+               self.live_contexts.get(task.context) is task.token
+
+    def _task_died(self, task):
+        if self.live_contexts.get(task.context) is task.token:
+            self._forget(task)
+            self.numdead += 1
+            self._maybe_compact()
+
+    def _forget(self, task):
+        n = self.context_tasks[task.context] - 1
+        if n:
+            self.context_tasks[task.context] = n
+        else:
+            del self.context_tasks[task.context]
+
+    def _maybe_compact(self):
+        if self.numdead < COMPACT_THRESHOLD or \
+               self.numdead * 2 < len(self.heap):
+            return
+        self.heap = [x for x in self.heap if self._alive(x[2])]
+        heapify(self.heap)
+        self.numdead = 0
+
+    def _drop_dead(self):
+        heap = self.heap
+        while heap and not self._alive(heap[0][2]):
+            heappop(heap)
+            self.numdead -= 1
+
+    def next_time(self):
+        # returns None if nothing is scheduled
+        self._drop_dead()
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def pop_due(self, now):
+        # returns the first live task due at time now, or None
+        self._drop_dead()
+        heap = self.heap
+        if not heap or heap[0][0] > now:
+            return None
+        task = heappop(heap)[2]
+        self._forget(task)
+        # make a late cancel() a no-op
+        task.cancelled = True
+        lateness = now - task.when
+        self.numrun += 1
+        self.total_lateness += lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        return task
+
+    def __len__(self):
+        return len(self.heap) - self.numdead
+
+    def get_stats(self):
+        if self.numrun:
+            avg = self.total_lateness / self.numrun
+        else:
+            avg = 0.
+        return {'queued': len(self), 'dead': self.numdead,
+                'run': self.numrun, 'lateness_avg': avg,
+                'lateness_max': self.max_lateness}
@@ -16,44 +16,292 @@
 һ޶ֵڡ 
 '''
 import os
-from bisect import bisect_right
+import mmap
+import errno
+import threading
+from bisect import bisect_left, bisect_right
 from array import array
+from sha import sha
+from struct import pack, unpack
+from collections import OrderedDict
 
 from BitTorrent.obsoletepythonsupport import *
 
+from BitTorrent.bencode import bencode, bdecode
 from BitTorrent import BTFailure
 
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _posix_fallocate = getattr(_libc, 'posix_fallocate64', None) or \
+                       _libc.posix_fallocate
+    _posix_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                 ctypes.c_int64]
+except Exception:
+    _posix_fallocate = None
+
+try:
+    _libc_pread = getattr(_libc, 'pread64', None) or _libc.pread
+    _libc_pwrite = getattr(_libc, 'pwrite64', None) or _libc.pwrite
+    for f in (_libc_pread, _libc_pwrite):
+        f.restype = ctypes.c_ssize_t
+        f.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                      ctypes.c_int64]
+
+    class _Py_buffer(ctypes.Structure):
+        _fields_ = [('buf', ctypes.c_void_p), ('obj', ctypes.c_void_p),
+                    ('len', ctypes.c_ssize_t),
+                    ('itemsize', ctypes.c_ssize_t),
+                    ('readonly', ctypes.c_int), ('ndim', ctypes.c_int),
+                    ('format', ctypes.c_char_p),
+                    ('shape', ctypes.c_void_p),
+                    ('strides', ctypes.c_void_p),
+                    ('suboffsets', ctypes.c_void_p),
+                    ('smalltable', ctypes.c_ssize_t * 2),
+                    ('internal', ctypes.c_void_p)]
+
+    _get_buffer = ctypes.pythonapi.PyObject_GetBuffer
+    _get_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(_Py_buffer),
+                            ctypes.c_int]
+    _release_buffer = ctypes.pythonapi.PyBuffer_Release
+    _release_buffer.argtypes = [ctypes.POINTER(_Py_buffer)]
+    _release_buffer.restype = None
+except Exception:
+    _libc_pread = _libc_pwrite = None
+
+ALLOCATION_STRATEGIES = ('sparse', 'full', 'background')
+
+# reads and writes with pread()/pwrite() don't need the FilePool lock
+POSITIONAL_IO = _libc_pread is not None
+
+# largest part of a file MmapStorage maps at once
+MAP_WINDOW = 2 ** 26
+
+RESUME_V1 = 'BitTorrent resume state file, version 1\n'
+RESUME_V2 = 'BitTorrent resume state file, version 2\n'
+
+
+def _check(n):
+    if n < 0:
+        e = ctypes.get_errno()
+        if e != errno.EINTR:
+            raise IOError(e, os.strerror(e))
+        return 0
+    return n
+
+
+def _pread(h, buf, offset, amount, pos):
+    # reads into the bytearray buf from offset on, returns the bytes read
+    if not amount:
+        return 0
+    address = ctypes.addressof(ctypes.c_char.from_buffer(buf, offset))
+    done = 0
+    while done < amount:
+        n = _libc_pread(h.fileno(), address + done, amount - done,
+                        pos + done)
+        if n == 0:
+            break
+        done += _check(n)
+    return done
+
+
+def _pwrite(h, data, pos):
+    # data is anything with the buffer interface, written without copying
+    view = _Py_buffer()
+    _get_buffer(data, ctypes.byref(view), 0)
+    try:
+        done = 0
+        while done < view.len:
+            done += _check(_libc_pwrite(h.fileno(), view.buf + done,
+                                        view.len - done, pos + done))
+    finally:
+        _release_buffer(ctypes.byref(view))
+
+
+def pack_places(places):
+    return pack('!%di' % len(places), *places)
+
+
+def fastresume_places(resume, numpieces, typecode):
+    # version 1 stores the native array, version 2 big-endian 4-byte ints
+    s = resume['places']
+    try:
+        if resume['version'] == 1:
+            r = array(typecode)
+            r.fromstring(s[:r.itemsize * numpieces])
+            if len(r) != numpieces:
+                raise ValueError('not enough data')
+        else:
+            r = array(typecode, unpack('!%di' % numpieces, s))
+    except Exception, e:
+        raise BTFailure("Couldn't read fastresume data: " + str(e))
+    return r
+
 
 class FilePool(object):
+    # Open file handles of all torrents, least recently used first. Files
+    # are opened for reading and writing once, read-only ones read-only.
+    # When more are needed than max_files_open allows, a torrent holding
+    # more than its share of handles loses its oldest one first.
 
     def __init__(self, max_files_open):
         self.max_files_open = max_files_open
+        # {filename: torrent}
         self.allfiles = {}
-        self.handlebuffer = None
-        self.handles = {}
+        # {torrent: number of files}
+        self.torrents = {}
+        # {filename: handle}, least recently used first
+        self.handles = OrderedDict()
+        self.last = None
+        # filenames of the handles that can be written
         self.whandles = {}
+        # {torrent: OrderedDict of its filenames with handles}
+        self.owned = {}
+        # {filename: torrent} of the handles, kept after remove_files()
+        # until the handle is closed
+        self.owners = {}
+        # {filename: (start, stop, mmap)}, dropped along with the handle
+        self.maps = {}
+        # {handle: number of users} for handles used without the lock
+        self.pinned = {}
+        # pinned handles closed by the pool, really closed when released
+        self.unclosed = {}
+        # held while a handle is looked up, and while it's used unless
+        # it's pinned; handles are shared with the disk threads and may be
+        # closed to open another file
+        self.lock = threading.Lock()
+        self.stat_opens = 0
+        self.stat_closes = 0
+        self.stat_evictions = 0
+
+    def get_handle(self, filename, for_write):
+        # call with lock held
+        handles = self.handles
+        if filename == self.last and (not for_write or
+                                      filename in self.whandles):
+            # already the most recently used one
+            return handles[filename]
+        h = handles.pop(filename, None)
+        if h is not None:
+            handles[filename] = h
+            owned = self.owned[self.owners[filename]]
+            del owned[filename]
+            owned[filename] = None
+            if for_write and filename not in self.whandles:
+                # permissions changed since it was opened
+                self._close(filename)
+                h = None
+        if h is None:
+            owner = self.allfiles.get(filename)
+            if self.max_files_open and len(handles) >= self.max_files_open:
+                self._evict(owner)
+            try:
+                h = file(filename, 'rb+', 0)
+                self.whandles[filename] = None
+            except IOError, e:
+                if for_write or e.errno not in (errno.EACCES, errno.EROFS):
+                    raise
+                h = file(filename, 'rb', 0)
+            self.stat_opens += 1
+            handles[filename] = h
+            self.owners[filename] = owner
+            self.owned.setdefault(owner, OrderedDict())[filename] = None
+        self.last = filename
+        return h
+
+    def acquire(self, filename, for_write):
+        # a handle that stays open until release(), to be used without
+        # holding the lock
+        self.lock.acquire()
+        try:
+            h = self.get_handle(filename, for_write)
+            self.pinned[h] = self.pinned.get(h, 0) + 1
+        finally:
+            self.lock.release()
+        return h
+
+    def release(self, h):
+        self.lock.acquire()
+        try:
+            n = self.pinned.pop(h) - 1
+            if n:
+                self.pinned[h] = n
+            elif h in self.unclosed:
+                del self.unclosed[h]
+                h.close()
+        finally:
+            self.lock.release()
+
+    def _evict(self, owner):
+        share = max(1, self.max_files_open // max(1, len(self.torrents)))
+        owned = self.owned.get(owner)
+        if owned is not None and len(owned) >= share:
+            filename = next(iter(owned))
+        else:
+            filename = next(iter(self.handles))
+            if len(self.owned[self.owners[filename]]) <= share:
+                # the oldest one is within its share, take from the
+                # torrent holding the most
+                owned = max(self.owned.itervalues(), key=len)
+                filename = next(iter(owned))
+        self.stat_evictions += 1
+        self._close(filename)
+
+    def _close(self, filename):
+        h = self.handles.pop(filename)
+        self.whandles.pop(filename, None)
+        if filename == self.last:
+            self.last = None
+        self.maps.pop(filename, None)
+        owner = self.owners.pop(filename)
+        owned = self.owned[owner]
+        del owned[filename]
+        if not owned:
+            del self.owned[owner]
+        self.stat_closes += 1
+        if h in self.pinned:
+            self.unclosed[h] = None
+        else:
+            h.close()
+
+    def close_files(self, files):
+        # closes what's open of files, raises the last error after that
+        error = None
+        self.lock.acquire()
+        try:
+            for filename in files:
+                self.maps.pop(filename, None)
+                if filename in self.handles:
+                    try:
+                        self._close(filename)
+                    except Exception, e:
+                        error = e
+        finally:
+            self.lock.release()
+        if error is not None:
+            raise error
 
     def close_all(self):
         failures = {}
-        for filename, handle in self.handles.iteritems():
-            try:
-                handle.close()
-            except Exception, e:
-                failures[self.allfiles[filename]] = e
-        self.handles.clear()
-        self.whandles.clear()
-        if self.handlebuffer is not None:
-            del self.handlebuffer[:]
+        self.lock.acquire()
+        try:
+            for filename in self.handles.keys():
+                owner = self.owners[filename]
+                try:
+                    self._close(filename)
+                except Exception, e:
+                    failures[owner] = e
+            self.maps.clear()
+        finally:
+            self.lock.release()
         for torrent, e in failures.iteritems():
-            torrent.got_exception(e)
+            if torrent is not None:
+                torrent.got_exception(e)
 
     def set_max_files_open(self, max_files_open):
         self.max_files_open = max_files_open
         self.close_all()
-        if len(self.allfiles) > self.max_files_open:
-            self.handlebuffer = []
-        else:
-            self.handlebuffer = None
 
     def add_files(self, files, torrent):
         for filename in files:
@@ -62,16 +310,14 @@ class FilePool(object):
                                 'torrent')
         for filename in files:
             self.allfiles[filename] = torrent
-        if self.handlebuffer is None and \
-               len(self.allfiles) > self.max_files_open:
-            self.handlebuffer = self.handles.keys()
+        self.torrents[torrent] = self.torrents.get(torrent, 0) + len(files)
 
     def remove_files(self, files):
         for filename in files:
-            del self.allfiles[filename]
-        if self.handlebuffer is not None and \
-               len(self.allfiles) <= self.max_files_open:
-            self.handlebuffer = None
+            torrent = self.allfiles.pop(filename)
+            self.torrents[torrent] -= 1
+            if not self.torrents[torrent]:
+                del self.torrents[torrent]
 
 
 # Make this a separate function because having this code in Storage.__init__()
@@ -84,14 +330,28 @@ def bad_libc_workaround():
 
 class Storage(object):
 
-    def __init__(self, config, filepool, files, check_only=False):
+    # whether read_view() returns buffers of data that isn't copied
+    zero_copy = False
+
+    def __init__(self, config, filepool, files, check_only=False,
+                 skipped=()):
         self.filepool = filepool
         self.config = config
+        self.allocation = 'sparse'
+        if not check_only:
+            self.allocation = config['allocation']
+            if self.allocation not in ALLOCATION_STRATEGIES:
+                raise BTFailure('unknown allocation strategy ' +
+                                self.allocation)
         self.ranges = []
         self.myfiles = {}
         self.tops = {}
         self.undownloaded = {}
         self.unallocated = {}
+        # files nothing is wanted from, and the ones of them that aren't
+        # created until something is written to them
+        self.skipped = dict.fromkeys(skipped)
+        self.unmade = {}
         total = 0
         for filename, length in files:
             self.unallocated[filename] = length
@@ -111,23 +371,100 @@ class Storage(object):
                     h.close()
                     l = length
                 self.tops[filename] = l
+            elif filename in self.skipped:
+                self.unmade[filename] = None
             elif not check_only:
-                f = os.path.split(filename)[0]
-                if f != '' and not os.path.exists(f):
-                    os.makedirs(f)
-                file(filename, 'wb').close()
+                self._make(filename)
         self.begins = [i[0] for i in self.ranges]
         self.total_length = total
+        # set by index_pieces()
+        self.piece_size = None
+        self.first_range = None
+        self.plans = {}
+        # tops are the sizes found on startup, used to tell which pieces
+        # may have data; allocated_to is how far the files are allocated
+        self.allocated_to = dict(self.tops)
         if check_only:
             return
-        self.handles = filepool.handles
-        self.whandles = filepool.whandles
+        self.maps = filepool.maps
 
         # Rather implement this as an ugly hack here than change all the
         # individual calls. Affects all torrent instances using this module.
         if config['enable_bad_libc_workaround']:
             bad_libc_workaround()
 
+    def _make(self, filename):
+        # doesn't truncate a file another thread just made
+        f = os.path.split(filename)[0]
+        if f != '' and not os.path.exists(f):
+            os.makedirs(f)
+        file(filename, 'ab').close()
+        self.unmade.pop(filename, None)
+
+    def _make_unmade(self, pos, amount):
+        # a write reaching into a skipped file that isn't there yet
+        self.filepool.lock.acquire()
+        try:
+            for filename, begin, end in self._intervals(pos, amount):
+                if filename in self.unmade:
+                    self._make(filename)
+        finally:
+            self.filepool.lock.release()
+
+    def set_skipped(self, filenames):
+        self.skipped = dict.fromkeys(filenames)
+        self.filepool.lock.acquire()
+        try:
+            for filename in self.unmade.keys():
+                if filename not in self.skipped:
+                    self._make(filename)
+        finally:
+            self.filepool.lock.release()
+
+    def preallocate(self, amount = None):
+        # Reserves disk space for the next amount bytes of the files that
+        # aren't allocated yet, all of them if amount is None. Returns
+        # whether there is more left. Skipped files are left alone.
+        for begin, end, filename in self.ranges:
+            done = self.allocated_to.get(filename, 0)
+            n = end - begin - done
+            if n <= 0 or filename in self.skipped:
+                continue
+            if amount is not None:
+                if amount == 0:
+                    return True
+                n = min(n, amount)
+                amount -= n
+            self.filepool.lock.acquire()
+            try:
+                if filename in self.unmade:
+                    self._make(filename)
+                h = self.filepool.get_handle(filename, True)
+                self._fallocate(h, done, n)
+            finally:
+                self.filepool.lock.release()
+            self.allocated_to[filename] = done + n
+            if done + n < end - begin:
+                return True
+        return False
+
+    def _fallocate(self, h, pos, length):
+        if _posix_fallocate is not None:
+            e = _posix_fallocate(h.fileno(), pos, length)
+            if e == 0:
+                return
+            if e not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+                raise IOError(e, os.strerror(e))
+        # no fallocate here, write zeros past the end of what is written
+        h.seek(0, 2)
+        end = pos + length
+        pos = max(pos, h.tell())
+        h.seek(pos)
+        zeros = chr(0) * min(2 ** 20, length)
+        while pos < end:
+            h.write(buffer(zeros, 0, min(len(zeros), end - pos)))
+            pos += len(zeros)
+
     def was_preallocated(self, pos, length):
         for filename, begin, end in self._intervals(pos, length):
             if self.tops.get(filename, 0) < end:
@@ -137,127 +474,223 @@ class Storage(object):
     def get_total_length(self):
         return self.total_length
 
+    def index_pieces(self, piece_size):
+        # first_range[i] is the range the start of piece i is in, so blocks
+        # inside one file need no search at all. Pieces over several files
+        # get their spans worked out once, in plans.
+        first_range = array('l')
+        p = 0
+        for pos in xrange(0, self.total_length, piece_size):
+            while self.ranges[p][1] <= pos:
+                p += 1
+            first_range.append(p)
+        self.piece_size = piece_size
+        self.first_range = first_range
+        self.plans = {}
+
+    def _plan(self, index):
+        # ([offset in the piece], [(filename, begin, end)]) of each file
+        pos = index * self.piece_size
+        stop = min(pos + self.piece_size, self.total_length)
+        offsets = []
+        spans = []
+        p = self.first_range[index]
+        while p < len(self.ranges) and self.ranges[p][0] < stop:
+            begin, end, filename = self.ranges[p]
+            offsets.append(max(pos, begin) - pos)
+            spans.append((filename, max(pos, begin) - begin,
+                          min(end, stop) - begin))
+            p += 1
+        return offsets, spans
+
     def _intervals(self, pos, amount):
-        r = []
         stop = pos + amount
+        ranges = self.ranges
+        if self.first_range is not None and pos < self.total_length:
+            i = pos // self.piece_size
+            begin, end, filename = ranges[self.first_range[i]]
+            if stop <= end:
+                return [(filename, pos - begin, stop - begin)]
+            start = i * self.piece_size
+            if stop <= start + self.piece_size:
+                plan = self.plans.get(i)
+                if plan is None:
+                    plan = self.plans[i] = self._plan(i)
+                offsets, spans = plan
+                pos -= start
+                stop -= start
+                a = bisect_right(offsets, pos) - 1
+                b = bisect_left(offsets, stop)
+                r = spans[a:b]
+                if pos > offsets[a]:
+                    filename, begin, end = r[0]
+                    r[0] = (filename, begin + pos - offsets[a], end)
+                filename, begin, end = spans[b - 1]
+                over = offsets[b - 1] + end - begin - stop
+                if over > 0:
+                    filename, begin, end = r[-1]
+                    r[-1] = (filename, begin, end - over)
+                return r
         p = bisect_right(self.begins, pos) - 1
-        while p < len(self.ranges) and self.ranges[p][0] < stop:
-            begin, end, filename = self.ranges[p]
+        r = []
+        while p < len(ranges) and ranges[p][0] < stop:
+            begin, end, filename = ranges[p]
             r.append((filename, max(pos, begin) - begin, min(end, stop) - begin))
             p += 1
         return r
 
-    def _get_file_handle(self, filename, for_write):
-        handlebuffer = self.filepool.handlebuffer
-        if filename in self.handles:
-            if for_write and filename not in self.whandles:
-                self.handles[filename].close()
-                self.handles[filename] = file(filename, 'rb+', 0)
-                self.whandles[filename] = None
-            if handlebuffer is not None and handlebuffer[-1] != filename:
-                handlebuffer.remove(filename)
-                handlebuffer.append(filename)
+    def _read(self, pos, amount):
+        # the files' data straight into one bytearray
+        buf = bytearray(amount)
+        done = 0
+        filepool = self.filepool
+        if POSITIONAL_IO:
+            for filename, begin, end in self._intervals(pos, amount):
+                h = filepool.acquire(filename, False)
+                try:
+                    n = _pread(h, buf, done, end - begin, begin)
+                finally:
+                    filepool.release(h)
+                done += n
         else:
-            if for_write:
-                self.handles[filename] = file(filename, 'rb+', 0)
-                self.whandles[filename] = None
-            else:
-                self.handles[filename] = file(filename, 'rb', 0)
-            if handlebuffer is not None:
-                if len(handlebuffer) >= self.filepool.max_files_open:
-                    oldfile = handlebuffer.pop(0)
-                    if oldfile in self.whandles:   # .pop() in python 2.3
-                        del self.whandles[oldfile]
-                    self.handles[oldfile].close()
-                    del self.handles[oldfile]
-                handlebuffer.append(filename)
-        return self.handles[filename]
+            view = memoryview(buf)
+            filepool.lock.acquire()
+            try:
+                for filename, begin, end in self._intervals(pos, amount):
+                    h = filepool.get_handle(filename, False)
+                    h.seek(begin)
+                    done += h.readinto(view[done:done + end - begin])
+            finally:
+                filepool.lock.release()
+        if done != amount:
+            raise BTFailure('Short read - something truncated files?')
+        return buf
 
     def read(self, pos, amount):
-        r = []
-        for filename, pos, end in self._intervals(pos, amount):
-            h = self._get_file_handle(filename, False)
-            h.seek(pos)
-            r.append(h.read(end - pos))
-        r = ''.join(r)
-        if len(r) != amount:
-            raise BTFailure('Short read - something truncated files?')
-        return r
+        return str(self._read(pos, amount))
+
+    def read_view(self, pos, amount):
+        # for data that is only passed on, a buffer over the bytearray read
+        # into saves copying it into a string
+        return buffer(self._read(pos, amount))
 
     def write(self, pos, s):
         # might raise an IOError
+        if self.unmade:
+            self._make_unmade(pos, len(s))
         total = 0
-        for filename, begin, end in self._intervals(pos, len(s)):
-            h = self._get_file_handle(filename, True)
-            h.seek(begin)
-            h.write(s[total: total + end - begin])
-            total += end - begin
+        filepool = self.filepool
+        if POSITIONAL_IO:
+            for filename, begin, end in self._intervals(pos, len(s)):
+                h = filepool.acquire(filename, True)
+                try:
+                    _pwrite(h, s[total: total + end - begin], begin)
+                finally:
+                    filepool.release(h)
+                total += end - begin
+            return
+        filepool.lock.acquire()
+        try:
+            for filename, begin, end in self._intervals(pos, len(s)):
+                h = filepool.get_handle(filename, True)
+                h.seek(begin)
+                h.write(s[total: total + end - begin])
+                total += end - begin
+        finally:
+            filepool.lock.release()
 
     def close(self):
-        error = None
-        for filename in self.handles.keys():
-            if filename in self.myfiles:
-                try:
-                    self.handles[filename].close()
-                except Exception, e:
-                    error = e
-                del self.handles[filename]
-                if filename in self.whandles:
-                    del self.whandles[filename]
-        handlebuffer = self.filepool.handlebuffer
-        if handlebuffer is not None:
-            handlebuffer = [f for f in handlebuffer if f not in self.myfiles]
-            self.filepool.handlebuffer = handlebuffer
-        if error is not None:
-            raise error
+        self.filepool.close_files(self.myfiles)
 
-    def write_fastresume(self, resumefile, amount_done):
-        resumefile.write('BitTorrent resume state file, version 1\n')
-        resumefile.write(str(amount_done) + '\n')
+    def write_fastresume(self, resumefile, amount_done, state):
+        # state comes from StorageWrapper.get_fastresume(). Stats every
+        # file, so it's called from a disk thread.
+        d = dict(state)
+        d['amount done'] = amount_done
+        d['allocation'] = self.allocation
+        files = []
         for _, _, filename in self.ranges:
-            resumefile.write(str(os.path.getsize(filename)) + ' ' +
-                             str(os.path.getmtime(filename)) + '\n')
+            if filename in self.unmade:
+                files.append([0, 0])
+            else:
+                files.append([os.path.getsize(filename),
+                              int(os.path.getmtime(filename))])
+        d['files'] = files
+        body = bencode(d)
+        resumefile.write(RESUME_V2)
+        resumefile.write(sha(body).hexdigest() + '\n')
+        resumefile.write(body)
 
-    def check_fastresume(self, resumefile, return_filelist=False,
-                         piece_size=None, numpieces=None, allfiles=None):
-        filenames = [name for _, _, name in self.ranges]
-        if resumefile is not None:
-            version = resumefile.readline()
-            if version != 'BitTorrent resume state file, version 1\n':
+    def read_fastresume(self, resumefile):
+        # Version 2 is a bencoded dict after a line with its SHA1:
+        # {'amount done': int, 'files': [[size, mtime]],
+        #  'places': piece at each position as 4-byte big-endian ints,
+        #  'block size': int, 'partial': [[position, piece, bitmap of the
+        #  blocks on disk]], 'clean': 0 for checkpoints taken while running,
+        #  'allocation': strategy, files are full size unless 'sparse'}
+        # Version 1 is the text header and a native array of places.
+        version = resumefile.readline()
+        try:
+            if version == RESUME_V2:
+                checksum = resumefile.readline().rstrip('\n')
+                body = resumefile.read()
+                if sha(body).hexdigest() != checksum:
+                    raise BTFailure('Fastresume data is corrupt')
+                r = bdecode(body)
+                r['version'] = 2
+                return r
+            if version != RESUME_V1:
                 raise BTFailure('Unsupported fastresume file format, '
                       'maybe from another client version')
-            amount_done = int(resumefile.readline())
-        else:
-            amount_done = size = mtime = 0
-        for filename in filenames:
-            if resumefile is not None:
+            r = {'version': 1}
+            r['amount done'] = int(resumefile.readline())
+            files = []
+            for _ in self.ranges:
                 line = resumefile.readline()
                 size, mtime = line.split()[:2] # allow adding extra fields
-                size = int(size)
-                mtime = int(mtime)
+                files.append([int(size), int(float(mtime))])
+            r['files'] = files
+            r['places'] = resumefile.read()
+            return r
+        except ValueError, e:
+            raise BTFailure("Couldn't read fastresume data: " + str(e))
+
+    def check_fastresume(self, resume, return_filelist=False,
+                         piece_size=None, numpieces=None, allfiles=None):
+        # resume comes from read_fastresume() or is None
+        filenames = [name for _, _, name in self.ranges]
+        # files keep being written after a checkpoint taken while running
+        clean = True
+        if resume is not None:
+            amount_done = resume['amount done']
+            clean = resume.get('clean', 1)
+            if len(resume['files']) != len(filenames):
+                raise BTFailure("Fastresume data doesn't match the files")
+        else:
+            amount_done = size = mtime = 0
+        for i, filename in enumerate(filenames):
+            if resume is not None:
+                size, mtime = resume['files'][i]
             if os.path.exists(filename):
                 fsize = os.path.getsize(filename)
             else:
                 fsize = 0
-            if fsize > 0 and mtime != os.path.getmtime(filename):
+            if clean and fsize > 0 and \
+                   mtime != int(os.path.getmtime(filename)):
                 raise BTFailure("Fastresume info doesn't match file "
                                 "modification time")
-            if size != fsize:
+            if size != fsize and (clean or size > fsize):
                 raise BTFailure("Fastresume data doesn't match actual "
                                 "filesize")
         if not return_filelist:
             return amount_done
-        if resumefile is None:
+        if resume is None:
             return None
         if numpieces < 32768:
             typecode = 'h'
         else:
             typecode = 'l'
-        try:
-            r = array(typecode)
-            r.fromfile(resumefile, numpieces)
-        except Exception, e:
-            raise BTFailure("Couldn't read fastresume data: " + str(e))
+        r = fastresume_places(resume, numpieces, typecode)
         for i in range(numpieces):
             if r[i] >= 0:
                 # last piece goes "past the end", doesn't matter
@@ -276,3 +709,45 @@ class Storage(object):
     def downloaded(self, pos, length):
         for filename, begin, end in self._intervals(pos, length):
             self.undownloaded[filename] -= end - begin
+
+
+class MmapStorage(Storage):
+    # Serves read_view() as buffers into read-only mappings of the files,
+    # so data uploaded goes from the page cache to the socket without
+    # being copied. Mappings are never closed explicitly: a buffer still
+    # waiting to be sent keeps its mapping alive, FilePool only drops its
+    # reference when the file's handle is closed.
+
+    zero_copy = True
+
+    def _get_map(self, filename, begin, end):
+        h = self.filepool.get_handle(filename, False)
+        m = self.maps.get(filename)
+        if m is not None and m[0] <= begin and end <= m[1]:
+            return m
+        # the file may still be growing, map only what is there
+        size = os.fstat(h.fileno()).st_size
+        if end > size:
+            raise BTFailure('Short read - something truncated files?')
+        start = begin - begin % mmap.ALLOCATIONGRANULARITY
+        stop = min(size, max(end, start + MAP_WINDOW))
+        m = (start, stop, mmap.mmap(h.fileno(), stop - start,
+                                    access=mmap.ACCESS_READ, offset=start))
+        self.maps[filename] = m
+        return m
+
+    def read_view(self, pos, amount):
+        intervals = self._intervals(pos, amount)
+        if len(intervals) != 1:
+            # spans files, has to be joined anyway
+            return self.read(pos, amount)
+        filename, begin, end = intervals[0]
+        self.filepool.lock.acquire()
+        try:
+            start, stop, m = self._get_map(filename, begin, end)
+        finally:
+            self.filepool.lock.release()
+        return buffer(m, begin - start, end - begin)
+
+
+STORAGE_BACKENDS = {'file': Storage, 'mmap': MmapStorage}
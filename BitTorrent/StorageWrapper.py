@@ -21,11 +21,15 @@
 '''
 from __future__ import division
 
+import threading
 from sha import sha
 from array import array
 from binascii import b2a_hex
+from collections import OrderedDict
 
 from BitTorrent.bitfield import Bitfield
+from BitTorrent.Storage import fastresume_places, pack_places
+from BitTorrent.HashChecker import HashChecker, find_partial
 from BitTorrent import BTFailure, INFO, WARNING, ERROR, CRITICAL
 
 def toint(s):
@@ -41,18 +45,46 @@ ALLOCATED = -1
 UNALLOCATED = -2
 FASTRESUME_PARTIAL = -3
 
+# block states of pieces being downloaded
+UNREQUESTED = 0
+REQUESTED = 1
+RECEIVED = 2
+WRITTEN = 3
+
 class StorageWrapper(object):
 
     def __init__(self, storage, config, hashes, piece_size, finished,
-            statusfunc, flag, data_flunked, infohash, errorfunc, resumefile):
+            statusfunc, flag, data_flunked, infohash, errorfunc, resume,
+            readcache = None, diskio = None, context = None,
+            writebudget = None, hashchecker = None):
         self.numpieces = len(hashes)
         self.storage = storage
+        storage.index_pieces(piece_size)
         self.config = config
         check_hashes = config['check_hashes']
         self.hashes = hashes
         self.piece_size = piece_size
         self.data_flunked = data_flunked
         self.errorfunc = errorfunc
+        self.readcache = readcache
+        # disk writes, piece hash checks and upload prefetches go through
+        # diskio when it has threads; results come back in the RawServer
+        # thread, hash check results through checked_func(index, ok)
+        self.diskio = diskio
+        self.context = context
+        self.checked_func = None
+        self.lock = threading.Lock()
+        self.pending_writes = {}
+        self.prefetching = {}
+        self.moving = {}
+        # pieces put together in memory before they are written, hashed as
+        # the blocks arrive: {index: [sha, hashed length, {begin: data}]}
+        # least recently used first. Memory is taken from writebudget.
+        self.writebudget = writebudget
+        self.assembling = OrderedDict()
+        # running hashes of pieces written block by block, advanced while
+        # the blocks come in order: {index: [sha, hashed length]}
+        self.hashing = {}
         self.total_length = storage.get_total_length()
         self.amount_left = self.total_length
         self.partial_mark = "BitTorrent - this part has not been "+\
@@ -64,7 +96,15 @@ class StorageWrapper(object):
             raise BTFailure, 'bad data in responsefile - total too big'
         self.finished = finished
         self.numactive = array('H', [0] * self.numpieces)
-        self.inactive_requests = [1] * self.numpieces
+        # blocks not requested yet; the states of the blocks of pieces
+        # started, and where to look for the next one to request
+        size = config['download_slice_size']
+        self.numinactive = array('H', [(piece_size + size - 1) // size]) * \
+                           self.numpieces
+        if self.numpieces:
+            self.numinactive[-1] = self._numblocks(self.numpieces - 1)
+        self.blockstates = {}
+        self.nextblock = {}
         self.amount_inactive = self.total_length
         self.endgame = False
         self.have = Bitfield(self.numpieces)
@@ -74,11 +114,14 @@ class StorageWrapper(object):
         else:
             typecode = 'l'
         self.places = array(typecode, [NO_PLACE] * self.numpieces)
+        # unfinished pieces with their blocks recorded in the resume data:
+        # {position: (piece, bitmap)}
+        self.resume_blocks = {}
         if not check_hashes:
             self.rplaces = array(typecode, range(self.numpieces))
             fastresume = True
         else:
-            self.rplaces = self._load_fastresume(resumefile, typecode)
+            self.rplaces = self._load_fastresume(resume, typecode)
             if self.rplaces is not None:
                 fastresume = True
             else:
@@ -91,21 +134,57 @@ class StorageWrapper(object):
         self.stat_active = {}
         self.stat_new = {}
         self.stat_dirty = {}
+        self.stat_cache_hits = 0
+        self.stat_cache_misses = 0
+        self.stat_assembled = 0
+        self.stat_evicted = 0
+        self.stat_hashed_inline = 0
+        self.stat_hashed_reread = 0
         self.download_history = {}
         self.failed_pieces = {}
+        # pieces that failed since their download_history was started, old
+        # blocks on disk may still be bad
+        self.flunked_pieces = {}
+        # pieces only of skipped files, never requested
+        self.skipped = {}
 
         if self.numpieces == 0:
             return
         targets = {}
-        total = 0
+        check = []
+        # files that were preallocated are full size without having data
+        preallocated = resume is not None and \
+                       resume.get('allocation', 'sparse') != 'sparse'
         if not fastresume:
             for i in xrange(self.numpieces):
                 if self._waspre(i):
                     self.rplaces[i] = ALLOCATED
-                    total += 1
+                    check.append(i)
                 else:
                     targets[hashes[i]] = i
-        if total and check_hashes:
+        elif resume is not None and not resume.get('clean', 1):
+            # A checkpoint taken while running. Pieces in their own place
+            # are never moved or overwritten, everything else may have
+            # changed since and is checked.
+            for i in xrange(self.numpieces):
+                t = self.rplaces[i]
+                if not self._waspre(i):
+                    targets[hashes[i]] = i
+                elif t == i or (t == FASTRESUME_PARTIAL and
+                                self.resume_blocks.get(i, (None,))[0] == i):
+                    continue
+                elif preallocated and t in (UNALLOCATED, ALLOCATED) and \
+                         config['direct_placement']:
+                    # whatever was written here since is downloaded again,
+                    # reading all unfinished space would cost more
+                    self.rplaces[i] = ALLOCATED
+                else:
+                    if t >= 0:
+                        targets[hashes[t]] = t
+                    self.resume_blocks.pop(i, None)
+                    self.rplaces[i] = ALLOCATED
+                    check.append(i)
+        if check and check_hashes:
             statusfunc('checking existing file', 0)
         def markgot(piece, pos):
             if self.have[piece]:
@@ -119,50 +198,72 @@ class StorageWrapper(object):
             self.have[piece] = True
             self.amount_left -= self._piecelen(piece)
             self.amount_inactive -= self._piecelen(piece)
-            self.inactive_requests[piece] = None
+            self.numinactive[piece] = 0
             if not fastresume:
                 self.waschecked[piece] = True
             self.stat_numfound += 1
         lastlen = self._piecelen(self.numpieces - 1)
         partials = {}
+        digests = {}
+        if check:
+            if hashchecker is None:
+                hashchecker = HashChecker(0)
+            def progress(fraction):
+                statusfunc(fractionDone = fraction)
+            digests = hashchecker.check(storage.ranges, piece_size,
+                self.total_length, check, lastlen, self.partial_mark,
+                config['download_slice_size'], self.numpieces, flag, progress)
+            if flag.isSet():
+                return
         for i in xrange(self.numpieces):
             if not self._waspre(i):
                 if self.rplaces[i] != UNALLOCATED:
                     raise BTFailure("--check_hashes 0 or fastresume info "
                                     "doesn't match file state (missing data)")
                 continue
-            elif fastresume:
+            elif i in digests:
+                s, sp, partial = digests[i]
+                if s == hashes[i]:
+                    markgot(i, i)
+                elif s in targets and self._piecelen(i) == self._piecelen(targets[s]):
+                    markgot(targets[s], i)
+                elif not self.have[self.numpieces - 1] and sp == hashes[-1] and (i == self.numpieces - 1 or not self._waspre(self.numpieces - 1)):
+                    markgot(self.numpieces - 1, i)
+                elif partial is not None:
+                    partials[partial[0]] = (i, partial[1])
+            else:
                 t = self.rplaces[i]
                 if t >= 0:
                     markgot(t, i)
                     continue
                 if t == UNALLOCATED:
-                    raise BTFailure("Bad fastresume info (files contain more "
-                                    "data)")
+                    if not preallocated:
+                        raise BTFailure("Bad fastresume info (files contain "
+                                        "more data)")
+                    self.rplaces[i] = ALLOCATED
+                    continue
                 if t == ALLOCATED:
                     continue
                 if t!= FASTRESUME_PARTIAL:
                     raise BTFailure("Bad fastresume info (illegal value)")
-                data = self.storage.read(self.piece_size * i,
-                                         self._piecelen(i))
-                self._check_partial(i, partials, data)
-                self.rplaces[i] = ALLOCATED
-            else:
-                data = self.storage.read(piece_size * i, self._piecelen(i))
-                sh = sha(buffer(data, 0, lastlen))
-                sp = sh.digest()
-                sh.update(buffer(data, lastlen))
-                s = sh.digest()
-                if s == hashes[i]:
-                    markgot(i, i)
-                elif s in targets and self._piecelen(i) == self._piecelen(targets[s]):
-                    markgot(targets[s], i)
-                elif not self.have[self.numpieces - 1] and sp == hashes[-1] and (i == self.numpieces - 1 or not self._waspre(self.numpieces - 1)):
-                    markgot(self.numpieces - 1, i)
+                if i in self.resume_blocks:
+                    piece, bitmap = self.resume_blocks[i]
+                    size = self.config['download_slice_size']
+                    parts = [x for x in xrange(0, self._piecelen(piece), size)
+                             if not bitmap[x // size]]
+                    if parts:
+                        partials[piece] = (i, parts)
+                    elif self._piecelen(piece) <= self._piecelen(i) and \
+                             sha(self.storage.read(self.piece_size * i,
+                             self._piecelen(piece))).digest() == hashes[piece]:
+                        # all written but not checked before exiting
+                        markgot(piece, i)
+                        continue
                 else:
+                    data = self.storage.read(self.piece_size * i,
+                                             self._piecelen(i))
                     self._check_partial(i, partials, data)
-                statusfunc(fractionDone = 1 - self.amount_left /
-                           self.total_length)
+                self.rplaces[i] = ALLOCATED
             if flag.isSet():
                 return
         self.amount_left_with_partials = self.amount_left
@@ -187,47 +288,36 @@ class StorageWrapper(object):
         else:
             return self.total_length - piece * self.piece_size
 
+    def _numblocks(self, piece):
+        size = self.config['download_slice_size']
+        return (self._piecelen(piece) + size - 1) // size
+
     def _check_partial(self, pos, partials, data):
-        index = None
-        missing = False
-        marklen = len(self.partial_mark)+4
-        for i in xrange(0, len(data) - marklen,
-                        self.config['download_slice_size']):
-            if data[i:i+marklen-4] == self.partial_mark:
-                ind = toint(data[i+marklen-4:i+marklen])
-                if index is None:
-                    index = ind
-                    parts = []
-                if ind >= self.numpieces or ind != index:
-                    return
-                parts.append(i)
-            else:
-                missing = True
-        if index is not None and missing:
-            i += self.config['download_slice_size']
-            if i < len(data):
-                parts.append(i)
-            partials[index] = (pos, parts)
+        r = find_partial(data, self.partial_mark,
+                         self.config['download_slice_size'], self.numpieces)
+        if r is not None:
+            partials[r[0]] = (pos, r[1])
 
     def _make_partial(self, index, parts):
         length = self._piecelen(index)
-        l = []
-        self.inactive_requests[index] = l
-        x = 0
+        states = array('B', [WRITTEN]) * self._numblocks(index)
+        self.blockstates[index] = states
+        self.nextblock[index] = 0
+        self.numinactive[index] = len(parts)
         self.amount_left_with_partials -= self._piecelen(index)
         self.download_history[index] = {}
         request_size = self.config['download_slice_size']
         for x in xrange(0, self._piecelen(index), request_size):
             partlen = min(request_size, length - x)
             if x in parts:
-                l.append((x, partlen))
+                states[x // request_size] = UNREQUESTED
                 self.amount_left_with_partials += partlen
             else:
                 self.amount_inactive -= partlen
                 self.download_history[index][x] = None
         self.stat_dirty[index] = 1
 
-    def _initalloc(self, pos, piece):
+    def _initalloc(self, pos, piece, mark = True):
         assert self.rplaces[pos] < 0
         assert self.places[piece] == NO_PLACE
         p = self.piece_size * pos
@@ -236,31 +326,65 @@ class StorageWrapper(object):
             self.storage.allocated(p, length)
         self.places[piece] = pos
         self.rplaces[pos] = piece
+        if not mark:
+            # the whole piece is written right after
+            return
         # "if self.rplaces[pos] != ALLOCATED:" to skip extra mark writes
         mark = self.partial_mark + tobinary(piece)
         mark += chr(0xff) * (self.config['download_slice_size'] - len(mark))
         mark *= (length - 1) // len(mark) + 1
-        self.storage.write(p, buffer(mark, 0, length))
+        self._io(self.storage.write, (p, buffer(mark, 0, length)))
 
     def _move_piece(self, oldpos, newpos):
         assert self.rplaces[newpos] < 0
         assert self.rplaces[oldpos] >= 0
-        data = self.storage.read(self.piece_size * oldpos,
-                                 self._piecelen(newpos))
-        self.storage.write(self.piece_size * newpos, data)
         if self.rplaces[newpos] == UNALLOCATED:
-            self.storage.allocated(self.piece_size * newpos, len(data))
+            self.storage.allocated(self.piece_size * newpos,
+                                   self._piecelen(newpos))
         piece = self.rplaces[oldpos]
         self.places[piece] = newpos
         self.rplaces[oldpos] = ALLOCATED
         self.rplaces[newpos] = piece
-        if not self.have[piece]:
+        if self.have[piece]:
+            # uploads must not read the new place before the copy is done
+            self.moving[piece] = self.moving.get(piece, 0) + 1
+            self._io(self._copy_piece, (oldpos, newpos, piece),
+                     lambda r: self._piece_moved(piece))
+        else:
+            self._io(self._copy_piece, (oldpos, newpos, None))
+
+    def _copy_piece(self, oldpos, newpos, piece):
+        # disk thread; piece is given if the data has to be verified
+        data = self.storage.read(self.piece_size * oldpos,
+                                 self._piecelen(newpos))
+        self.storage.write(self.piece_size * newpos, data)
+        if piece is None:
             return
         data = data[:self._piecelen(piece)]
         if sha(data).digest() != self.hashes[piece]:
             raise BTFailure('data corrupted on disk - '
                             'maybe you have two copies running?')
 
+    def _piece_moved(self, piece):
+        self.moving[piece] -= 1
+        if not self.moving[piece]:
+            del self.moving[piece]
+
+    def _io(self, func, args, callback = None, size = 0):
+        if self.diskio is None:
+            r = func(*args)
+            if callback is not None:
+                callback(r)
+        else:
+            self.diskio.submit(self.storage, func, args, callback,
+                               self.context, size)
+
+    def is_backlogged(self):
+        return self.diskio is not None and self.diskio.is_backlogged()
+
+    def notify_when_drained(self, func):
+        self.diskio.notify_when_drained(func, self.context)
+
     def _get_free_place(self):
         while self.rplaces[self.holepos] >= 0:
             self.holepos += 1
@@ -270,35 +394,60 @@ class StorageWrapper(object):
         return self.amount_left
 
     def do_I_have_anything(self):
-        return self.amount_left < self.total_length
+        return self.have.numfalse < self.numpieces
 
     def _make_inactive(self, index):
-        length = self._piecelen(index)
-        l = []
-        x = 0
-        request_size = self.config['download_slice_size']
-        while x + request_size < length:
-            l.append((x, request_size))
-            x += request_size
-        l.append((x, length - x))
-        self.inactive_requests[index] = l
-
-    def _load_fastresume(self, resumefile, typecode):
-        if resumefile is not None:
-            try:
-                r = array(typecode)
-                r.fromfile(resumefile, self.numpieces)
+        states = array('B', [UNREQUESTED]) * self._numblocks(index)
+        self.blockstates[index] = states
+        self.nextblock[index] = 0
+        return states
+
+    def _load_fastresume(self, resume, typecode):
+        if resume is None:
+            return None
+        try:
+            r = fastresume_places(resume, self.numpieces, typecode)
+            # with another block size the bitmaps say nothing, the pieces
+            # are scanned for marks like version 1 partials
+            if resume.get('block size') != \
+                   self.config['download_slice_size']:
                 return r
-            except Exception, e:
-                self.errorfunc(WARNING, "Couldn't read fastresume data: " +
-                               str(e))
+            size = self.config['download_slice_size']
+            for pos, piece, bits in resume.get('partial', []):
+                if not 0 <= pos < self.numpieces or \
+                       not 0 <= piece < self.numpieces or \
+                       r[pos] != FASTRESUME_PARTIAL:
+                    raise ValueError('bad partial piece')
+                n = (self._piecelen(piece) + size - 1) // size
+                self.resume_blocks[pos] = (piece, Bitfield(n, bits))
+            return r
+        except (BTFailure, ValueError, TypeError), e:
+            self.resume_blocks = {}
+            self.errorfunc(WARNING, "Couldn't read fastresume data: " +
+                           str(e))
         return None
 
-    def write_fastresume(self, resumefile):
-        for i in xrange(self.numpieces):
-            if self.rplaces[i] >= 0 and not self.have[self.rplaces[i]]:
-                self.rplaces[i] = FASTRESUME_PARTIAL
-        self.rplaces.tofile(resumefile)
+    def get_fastresume(self):
+        # The places of pieces and, for unfinished pieces, which blocks
+        # are on disk. Blocks still in memory or queued don't count.
+        size = self.config['download_slice_size']
+        places = array(self.rplaces.typecode, self.rplaces)
+        partial = []
+        for pos in xrange(self.numpieces):
+            piece = places[pos]
+            if piece < 0 or self.have[piece]:
+                continue
+            places[pos] = FASTRESUME_PARTIAL
+            states = self.blockstates.get(piece)
+            if states is None or WRITTEN not in states:
+                continue
+            bitmap = Bitfield(len(states))
+            for b in xrange(len(states)):
+                if states[b] == WRITTEN:
+                    bitmap[b] = True
+            partial.append([pos, piece, bitmap.tostring()])
+        return {'places': pack_places(places), 'block size': size,
+                'partial': partial}
 
     def get_have_list(self):
         return self.have.tostring()
@@ -307,111 +456,466 @@ class StorageWrapper(object):
         return self.have[index]
 
     def do_I_have_requests(self, index):
-        return not not self.inactive_requests[index]
+        return self.numinactive[index] > 0 and index not in self.skipped
+
+    def set_skipped(self, pieces):
+        # Skipped pieces don't count as left to download, so the rest alone
+        # gets to endgame and finishes the torrent. Endgame isn't left once
+        # entered; Downloader hands pieces wanted again out through it.
+        skipped = dict.fromkeys(pieces)
+        left = self.amount_left
+        for index in self.skipped:
+            if index not in skipped:
+                self._count_left(index, 1)
+        for index in skipped:
+            if index not in self.skipped:
+                self._count_left(index, -1)
+        self.skipped = skipped
+        if self.amount_inactive == 0 and self.amount_left:
+            self.endgame = True
+        if left and not self.amount_left:
+            self.finished()
+
+    def _count_left(self, index, sign):
+        if self.have[index]:
+            return
+        length = self._piecelen(index)
+        self.amount_left += sign * length
+        states = self.blockstates.get(index)
+        if states is not None:
+            size = self.config['download_slice_size']
+            length = sum([min(size, length - b * size)
+                          for b in xrange(len(states))
+                          if states[b] == UNREQUESTED])
+        self.amount_inactive += sign * length
 
     def new_request(self, index):
-        # returns (begin, length)
-        if self.inactive_requests[index] == 1:
-            self._make_inactive(index)
+        # returns (begin, length) of the first block not requested yet
+        states = self.blockstates.get(index)
+        if states is None:
+            states = self._make_inactive(index)
         self.numactive[index] += 1
         self.stat_active[index] = 1
         if index not in self.stat_dirty:
             self.stat_new[index] = 1
-        rs = self.inactive_requests[index]
-        r = min(rs)
-        rs.remove(r)
-        self.amount_inactive -= r[1]
+        b = self.nextblock[index]
+        while states[b] != UNREQUESTED:
+            b += 1
+        states[b] = REQUESTED
+        self.nextblock[index] = b + 1
+        self.numinactive[index] -= 1
+        size = self.config['download_slice_size']
+        begin = b * size
+        length = min(size, self._piecelen(index) - begin)
+        self.amount_inactive -= length
         if self.amount_inactive == 0:
             self.endgame = True
-        return r
-
-    def piece_came_in(self, index, begin, piece, source = None):
-        if self.places[index] < 0:
-            if self.rplaces[index] == ALLOCATED:
-                self._initalloc(index, index)
+        return (begin, length)
+
+    def requested_blocks(self, index):
+        # (begin, length) of the blocks of index asked for and not in yet
+        states = self.blockstates.get(index)
+        if states is None:
+            return []
+        size = self.config['download_slice_size']
+        piecelen = self._piecelen(index)
+        return [(b * size, min(size, piecelen - b * size))
+                for b in xrange(len(states)) if states[b] == REQUESTED]
+
+    def _place(self, index, mark = True):
+        if self.places[index] >= 0:
+            return
+        if self.config['direct_placement'] or self.skipped:
+            # every piece at its own place, the files are sparse until
+            # done and unfinished blocks are only known from resume data;
+            # filling the files from the start would write into skipped ones
+            if self.rplaces[index] >= 0:
+                self._evacuate(index)
+            self._initalloc(index, index, False)
+            return
+        if self.rplaces[index] == ALLOCATED:
+            self._initalloc(index, index, mark)
+        else:
+            n = self._get_free_place()
+            if self.places[n] >= 0:
+                oldpos = self.places[n]
+                self._move_piece(oldpos, n)
+                n = oldpos
+            if self.rplaces[index] < 0 or index == n:
+                self._initalloc(n, index, mark)
             else:
-                n = self._get_free_place()
-                if self.places[n] >= 0:
-                    oldpos = self.places[n]
-                    self._move_piece(oldpos, n)
-                    n = oldpos
-                if self.rplaces[index] < 0 or index == n:
-                    self._initalloc(n, index)
-                else:
-                    self._move_piece(index, n)
-                    self._initalloc(index, index)
+                self._move_piece(index, n)
+                self._initalloc(index, index, mark)
+
+    def _evacuate(self, pos):
+        # a piece left out of place by relocating placement goes to its own
+        # place if that is free, else to the first free one
+        piece = self.rplaces[pos]
+        if self.rplaces[piece] < 0:
+            self._move_piece(pos, piece)
+        else:
+            self._move_piece(pos, self._get_free_place())
 
-        if index in self.failed_pieces:
-            old = self.storage.read(self.places[index] * self.piece_size +
-                                    begin, len(piece))
-            if old != piece:
-                self.failed_pieces[index][self.download_history[index][begin]]\
-                    = None
+    def piece_came_in(self, index, begin, piece, source = None):
+        # Pieces with nothing on disk yet are put together in memory if
+        # there's room, everything else goes through the disk.
+        size = self.config['download_slice_size']
+        self.blockstates[index][begin // size] = RECEIVED
+        if self.writebudget is not None and (index in self.assembling or
+                                             index not in self.download_history):
+            if self._reserve(index, len(piece)):
+                return self._assemble(index, begin, piece, source)
+
+        self._place(index)
         self.download_history.setdefault(index, {})
+        check = index in self.failed_pieces
+        old = self.download_history[index].get(begin)
         self.download_history[index][begin] = source
+        self._hash_block(index, begin, piece)
+        self._queue_write(index, begin, piece, check, old)
+
+        if self._block_done(index):
+            h = self.hashing.pop(index, None)
+            if h is None:
+                h = (None, 0)
+            self._io(self._check_piece, (index, self.places[index], h[0], h[1]),
+                     lambda r: self._piece_checked(index, *r))
+            # with inline disk I/O the check has already failed or passed
+            return self.have[index] or index in self.blockstates
+        return True
 
-        self.storage.write(self.places[index] * self.piece_size + begin, piece)
+    def _hash_block(self, index, begin, piece):
+        h = self.hashing.get(index)
+        if h is None:
+            if begin != 0:
+                return
+            h = self.hashing[index] = [sha(), 0]
+        if begin == h[1]:
+            h[0].update(piece)
+            h[1] += len(piece)
+            self.stat_hashed_inline += len(piece)
+        elif begin < h[1]:
+            # rewritten after it was hashed, check it all from disk
+            del self.hashing[index]
+
+    def _block_done(self, index):
+        # returns whether that was the last block of the piece
         self.stat_dirty[index] = 1
         self.numactive[index] -= 1
         if self.numactive[index] == 0:
             del self.stat_active[index]
         if index in self.stat_new:
             del self.stat_new[index]
-        if not self.inactive_requests[index] and not self.numactive[index]:
+        if not self.numinactive[index] and not self.numactive[index]:
             del self.stat_dirty[index]
-            if sha(self.storage.read(self.piece_size * self.places[index], self._piecelen(index))).digest() == self.hashes[index]:
-                self.have[index] = True
-                self.storage.downloaded(index * self.piece_size,
-                                        self._piecelen(index))
-                self.inactive_requests[index] = None
-                self.waschecked[index] = True
+            return True
+        return False
+
+    def _reserve(self, index, amount):
+        # makes room by pushing the least recently used pieces to disk
+        while not self.writebudget.reserve(amount):
+            if not self.assembling:
+                return False
+            i = iter(self.assembling).next()
+            self._evict(i)
+            if i == index:
+                return False
+        return True
+
+    def _evict(self, index):
+        s, hashed, blocks = self.assembling.pop(index)
+        self.stat_evicted += 1
+        self.writebudget.release(sum([len(b) for b in blocks.itervalues()]))
+        if hashed:
+            self.hashing[index] = [s, hashed]
+        self._place(index)
+        for begin in sorted(blocks):
+            self._queue_write(index, begin, blocks[begin], False, None)
+
+    def _assemble(self, index, begin, piece, source):
+        if isinstance(piece, memoryview):
+            piece = piece.tobytes()
+        a = self.assembling.pop(index, None)
+        if a is None:
+            a = [sha(), 0, {}]
+            self.download_history[index] = {}
+        self.assembling[index] = a
+        self.download_history[index][begin] = source
+        blocks = a[2]
+        if begin < a[1]:
+            # rewritten after it was hashed
+            a[0] = sha()
+            a[1] = 0
+        blocks[begin] = piece
+        while a[1] in blocks:
+            a[0].update(blocks[a[1]])
+            self.stat_hashed_inline += len(blocks[a[1]])
+            a[1] += len(blocks[a[1]])
+        if not self._block_done(index):
+            return True
+
+        del self.assembling[index]
+        data = ''.join([blocks[b] for b in sorted(blocks)])
+        if a[0].digest() == self.hashes[index]:
+            self.stat_assembled += 1
+            self._place(index, False)
+            self._io(self._write_piece,
+                     (index, self.piece_size * self.places[index], data),
+                     lambda r: self._piece_written(index, data), len(data))
+            return True
+        self.writebudget.release(len(data))
+        self._piece_checked(index, False)
+        if index in self.failed_pieces:
+            # several peers sent parts, keep the data on disk so the next
+            # try can tell which blocks were bad
+            self._place(index)
+            for b in sorted(blocks):
+                self._queue_write(index, b, blocks[b], False, None)
+        else:
+            del self.download_history[index]
+            del self.flunked_pieces[index]
+        return False
+
+    def _write_piece(self, index, pos, data):
+        self.storage.write(pos, data)
+
+    def _piece_written(self, index, data):
+        self.writebudget.release(len(data))
+        if self.readcache is not None and self.readcache.max_size:
+            # likely to be asked for by other peers soon
+            self.readcache.add(self, index, data)
+        self._piece_checked(index, True)
+
+    def _queue_write(self, index, begin, piece, check, source):
+        if self.diskio is not None and self.diskio.threads and \
+               isinstance(piece, memoryview):
+            # the view points into the connection's receive buffer
+            piece = piece.tobytes()
+        # Blocks of a piece that are still waiting for the disk are written
+        # together by whichever of their jobs runs first. The position is
+        # fixed when the batch is started; a later move of the piece is
+        # queued behind it and copies what was written.
+        self.lock.acquire()
+        try:
+            w = self.pending_writes.get(index)
+            if w is None:
+                w = self.pending_writes[index] = (self.places[index], [])
+            w[1].append((begin, piece, check, source))
+        finally:
+            self.lock.release()
+        # the states of a piece that fails meanwhile are dropped with it
+        states = self.blockstates.get(index)
+        callback = lambda changed: self._blocks_written(index, states, begin,
+                                                        changed)
+        self._io(self._write_blocks, (index,), callback, len(piece))
+
+    def _write_blocks(self, index):
+        # disk thread; returns the previous senders of blocks that changed
+        self.lock.acquire()
+        try:
+            w = self.pending_writes.pop(index, None)
+        finally:
+            self.lock.release()
+        changed = []
+        if w is not None:
+            self._write_sorted(w, changed)
+        return changed
+
+    def _write_sorted(self, w, changed):
+        pos, blocks = w
+        pos *= self.piece_size
+        blocks.sort(key = lambda b: b[0])
+        run = []
+        runstart = runend = None
+        for begin, piece, check, source in blocks:
+            if check:
+                old = self.storage.read(pos + begin, len(piece))
+                if old != piece:
+                    changed.append(source)
+            if begin != runend:
+                if run:
+                    self._write_run(pos + runstart, run)
+                run = []
+                runstart = begin
+            run.append(piece)
+            runend = begin + len(piece)
+        if run:
+            self._write_run(pos + runstart, run)
+
+    def _write_run(self, pos, run):
+        if len(run) == 1:
+            self.storage.write(pos, run[0])
+        else:
+            self.storage.write(pos, ''.join(run))
+
+    def _blocks_written(self, index, states, begin, changed):
+        # by this job or an earlier one of the same piece
+        if states is not None:
+            states[begin // self.config['download_slice_size']] = WRITTEN
+        if index in self.failed_pieces:
+            for d in changed:
+                self.failed_pieces[index][d] = None
+
+    def _check_piece(self, index, pos, s, hashed):
+        # disk thread; only the part not hashed on the way in is read back
+        if s is None:
+            s = sha()
+        length = self._piecelen(index) - hashed
+        if length:
+            s.update(self.storage.read(self.piece_size * pos + hashed, length))
+        return s.digest() == self.hashes[index], length
+
+    def _piece_checked(self, index, ok, reread = 0):
+        self.stat_hashed_reread += reread
+        if ok:
+            self.have[index] = True
+            self.storage.downloaded(index * self.piece_size,
+                                    self._piecelen(index))
+            self.numinactive[index] = 0
+            del self.blockstates[index]
+            del self.nextblock[index]
+            self.waschecked[index] = True
+            # skipped pieces were taken off already
+            wanted = index not in self.skipped
+            if wanted:
                 self.amount_left -= self._piecelen(index)
-                self.stat_numdownloaded += 1
-                for d in self.download_history[index].itervalues():
+            self.stat_numdownloaded += 1
+            for d in self.download_history[index].itervalues():
+                if d is not None:
+                    d.good(index)
+            del self.download_history[index]
+            self.flunked_pieces.pop(index, None)
+            if index in self.failed_pieces:
+                for d in self.failed_pieces[index]:
                     if d is not None:
-                        d.good(index)
-                del self.download_history[index]
-                if index in self.failed_pieces:
-                    for d in self.failed_pieces[index]:
-                        if d is not None:
-                            d.bad(index)
-                    del self.failed_pieces[index]
-                if self.amount_left == 0:
-                    self.finished()
-            else:
-                self.data_flunked(self._piecelen(index), index)
-                self.inactive_requests[index] = 1
+                        d.bad(index)
+                del self.failed_pieces[index]
+            if wanted and self.amount_left == 0:
+                self.finished()
+        else:
+            self.data_flunked(self._piecelen(index), index)
+            self.numinactive[index] = self._numblocks(index)
+            del self.blockstates[index]
+            del self.nextblock[index]
+            if index not in self.skipped:
                 self.amount_inactive += self._piecelen(index)
-                self.stat_numflunked += 1
-
-                self.failed_pieces[index] = {}
-                allsenders = {}
-                for d in self.download_history[index].itervalues():
-                    allsenders[d] = None
-                if len(allsenders) == 1:
-                    culprit = allsenders.keys()[0]
-                    if culprit is not None:
-                        culprit.bad(index, bump = True)
-                    del self.failed_pieces[index] # found the culprit already
-                return False
-        return True
+            self.stat_numflunked += 1
+            self.flunked_pieces[index] = None
+
+            self.failed_pieces[index] = {}
+            allsenders = {}
+            for d in self.download_history[index].itervalues():
+                allsenders[d] = None
+            if len(allsenders) == 1:
+                culprit = allsenders.keys()[0]
+                if culprit is not None:
+                    culprit.bad(index, bump = True)
+                del self.failed_pieces[index] # found the culprit already
+        if self.checked_func is not None:
+            self.checked_func(index, ok)
 
     def request_lost(self, index, begin, length):
-        self.inactive_requests[index].append((begin, length))
-        self.amount_inactive += length
+        b = begin // self.config['download_slice_size']
+        self.blockstates[index][b] = UNREQUESTED
+        if b < self.nextblock[index]:
+            self.nextblock[index] = b
+        self.numinactive[index] += 1
+        if index not in self.skipped:
+            self.amount_inactive += length
         self.numactive[index] -= 1
         if not self.numactive[index] and index in self.stat_active:
             del self.stat_active[index]
             if index in self.stat_new:
                 del self.stat_new[index]
 
+    def piece_ready(self, index, func):
+        # Returns whether get_piece() can be answered without waiting for
+        # the disk. If not, the whole piece is read into the cache by a disk
+        # thread and func() is called when it's there.
+        cache = self.readcache
+        if self.diskio is None or not self.diskio.threads or cache is None \
+               or not cache.max_size or self.storage.zero_copy or \
+               not self.have[index]:
+            return True
+        if cache.get(self, index) is not None:
+            return True
+        funcs = self.prefetching.get(index)
+        if funcs is None:
+            funcs = self.prefetching[index] = []
+            self.stat_cache_misses += 1
+            self._io(self._read_piece, (index, self.places[index]),
+                     lambda data: self._piece_read(index, data))
+        if func not in funcs:
+            funcs.append(func)
+        return False
+
+    def _read_piece(self, index, pos):
+        return self.storage.read(self.piece_size * pos, self._piecelen(index))
+
+    def _piece_read(self, index, data):
+        funcs = self.prefetching.pop(index)
+        if not self.waschecked[index]:
+            if sha(data).digest() != self.hashes[index]:
+                raise BTFailure, 'told file complete on start-up, but piece failed hash check'
+            self.waschecked[index] = True
+        self.readcache.add(self, index, data)
+        for func in funcs:
+            func()
+
     def get_piece(self, index, begin, length):
         if not self.have[index]:
             return None
+        if index in self.moving:
+            self.flush()
+        cache = self.readcache
+        # no use keeping a second copy of what a mapping gives for free
+        if cache is not None and (not cache.max_size or
+                                  self.storage.zero_copy):
+            cache = None
+        data = None
         if not self.waschecked[index]:
-            if sha(self.storage.read(self.piece_size * self.places[index], self._piecelen(index))).digest() != self.hashes[index]:
+            data = self.storage.read(self.piece_size * self.places[index],
+                                     self._piecelen(index))
+            if sha(data).digest() != self.hashes[index]:
                 raise BTFailure, 'told file complete on start-up, but piece failed hash check'
             self.waschecked[index] = True
+            if cache is not None:
+                cache.add(self, index, data)
         if begin + length > self._piecelen(index):
             return None
-        return self.storage.read(self.piece_size * self.places[index] + begin, length)
+        if cache is None:
+            if data is not None:
+                return buffer(data, begin, length)
+            return self.storage.read_view(self.piece_size * self.places[index] + begin, length)
+        # Peers usually ask for all blocks of a piece, so read the whole
+        # piece on the first request and serve the rest from memory.
+        if data is None:
+            data = cache.get(self, index)
+            if data is None:
+                self.stat_cache_misses += 1
+                data = self.storage.read(self.piece_size * self.places[index],
+                                         self._piecelen(index))
+                cache.add(self, index, data)
+            else:
+                self.stat_cache_hits += 1
+        return buffer(data, begin, length)
+
+    def flush(self):
+        # waits for the queued disk jobs of this torrent
+        if self.diskio is not None:
+            self.diskio.wait(self.storage)
+
+    def close(self):
+        # partly assembled pieces are written out, so they can be resumed
+        while self.assembling:
+            self._evict(iter(self.assembling).next())
+        self.flush()
+        # Every block received is on disk now. With disk threads the
+        # callbacks saying so come back through RawServer after the
+        # torrent's context is gone, so get_fastresume() is told here.
+        for states in self.blockstates.itervalues():
+            for b in xrange(len(states)):
+                if states[b] == RECEIVED:
+                    states[b] = WRITTEN
+        if self.readcache is not None:
+            self.readcache.remove_owner(self)
@@ -0,0 +1,142 @@
+# coding: utf-8
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+'''
+@note:
+边下边播。定义于BitTorrent/Streamer.py中，--streaming 时由 _SingleTorrent 创建，
+与 Downloader 一一对应。按 stream_rate 模拟一个向前移动的播放位置，位置之后
+stream_window 个块是窗口，按播放到它们的时间定下截止时间，只交给不阻塞我们的
+对方中较快的一半下载；截止时间快到时，已经请求出去的块再向另一个快的对方重复
+请求。窗口以外的块仍由 PiecePicker 按最少优先选取。同时统计首字节时间和卡顿次数。
+对方按速度的排名在有对方阻塞或解除阻塞我们时重算，否则最多每秒一次；要重复请求的
+块直接从 StorageWrapper 按块号记着的已请求块里找。
+'''
+from time import time
+
+# seconds the ranking of peers by rate is kept while nobody chokes us
+RANK_INTERVAL = 1
+
+class Streamer(object):
+
+    def __init__(self, config, storage, downloader, piece_size):
+        self.storage = storage
+        self.downloader = downloader
+        self.numpieces = storage.numpieces
+        # seconds of playback in a piece
+        self.piece_time = piece_size / (config['stream_rate'] * 1024.)
+        self.window = config['stream_window']
+        self.started = time()
+        # the piece being played and when it started playing, None until
+        # the first piece is there
+        self.position = 0
+        self.position_time = None
+        self.first_byte = None
+        # when playback stopped at a missing piece, None while playing
+        self.stalled = None
+        self.stalls = 0
+        # the faster half of the peers not choking us, and when it was
+        # ranked, None to rank them again
+        self.fast = None
+        self.ranked = 0
+        self._advance(self.started)
+
+    def _ready(self, piece):
+        return self.storage.do_I_have(piece) or piece in self.storage.skipped
+
+    def _advance(self, now):
+        # moves the playback position on to now
+        while self.position < self.numpieces:
+            if self.position_time is None or self.stalled is not None:
+                if not self._ready(self.position):
+                    return
+                if self.first_byte is None:
+                    self.first_byte = now - self.started
+                self.position_time = now
+                self.stalled = None
+            due = self.position_time + self.piece_time
+            if due > now:
+                return
+            self.position += 1
+            self.position_time = due
+            if self.position < self.numpieces and \
+                   not self._ready(self.position):
+                self.stalled = due
+                self.stalls += 1
+
+    def piece_done(self):
+        # playback continues the moment a missing piece is there
+        self._advance(time())
+
+    def deadline(self, piece, now):
+        # when playback gets to piece
+        if self.position_time is None or self.stalled is not None:
+            start = now
+        else:
+            start = self.position_time
+        return start + (piece - self.position) * self.piece_time
+
+    def in_window(self, piece):
+        return self.position <= piece < self.position + self.window
+
+    def _window(self):
+        return xrange(self.position, min(self.position + self.window,
+                                         self.numpieces))
+
+    def choked_changed(self):
+        self.fast = None
+
+    def _fast(self, download, now):
+        if self.fast is None or now - self.ranked >= RANK_INTERVAL:
+            # each rate taken once as they change with time
+            rates = [(d.get_rate(), d) for d in self.downloader.downloads
+                     if not d.choked]
+            self.fast = {}
+            if rates:
+                # as fast as the peer in the middle or faster
+                least = sorted([rate for rate, d in rates])[len(rates) // 2]
+                for rate, d in rates:
+                    if rate >= least:
+                        self.fast[d] = None
+            self.ranked = now
+        return download in self.fast
+
+    def next(self, download):
+        # the piece in the window due first that download can be asked for
+        now = time()
+        if not self._fast(download, now):
+            return None
+        self._advance(now)
+        for piece in self._window():
+            if download._want(piece):
+                return piece
+        return None
+
+    def duplicates(self, download):
+        # blocks of pieces due within a piece's playback time that other
+        # peers were asked for and download has
+        now = time()
+        if self.storage.endgame or not self._fast(download, now):
+            return []
+        self._advance(now)
+        r = []
+        duplicates = self.downloader.duplicates
+        mine = download.active_requests
+        for piece in self._window():
+            if self.deadline(piece, now) - now >= self.piece_time:
+                break
+            if not download.have[piece] or self.storage.do_I_have(piece):
+                continue
+            # each of these was asked from one peer, or two if it's in
+            # duplicates already
+            for begin, length in self.storage.requested_blocks(piece):
+                request = (piece, begin, length)
+                if request not in mine and request not in duplicates:
+                    r.append(request)
+        return r
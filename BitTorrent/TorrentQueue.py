@@ -72,6 +72,8 @@ class TorrentInfo(object):
         self.uptotal_old = 0
         self.downtotal = 0
         self.downtotal_old = 0
+        # file_priorities option of this torrent
+        self.priorities = ''
 
 
 class TorrentQueue(Feedback):
@@ -354,7 +356,11 @@ class TorrentQueue(Feedback):
         t.state = RUNNING
         t.finishtime = None
         self.running_torrents.append(infohash)
-        t.dl = self.multitorrent.start_torrent(t.metainfo, self.config, self,
+        config = self.config
+        if t.priorities:
+            config = dict(config)
+            config['file_priorities'] = t.priorities
+        t.dl = self.multitorrent.start_torrent(t.metainfo, config, self,
                                                t.dlpath)
         self._send_state(infohash)
 
@@ -383,6 +389,9 @@ class TorrentQueue(Feedback):
             self.start_new_torrent(data)
         elif action == 'show_error':
             self.global_error(ERROR, data)
+        elif action == 'set_file_priorities':
+            # infohash followed by the priorities, as in --file_priorities
+            self.set_file_priorities(data[:20], data[20:])
         elif action == 'no-op':
             pass
 
@@ -467,6 +476,14 @@ class TorrentQueue(Feedback):
             self.torrents[infohash].dl.set_option(option, value)
         self._dump_config()
 
+    def set_file_priorities(self, infohash, priorities):
+        torrent = self.torrents.get(infohash)
+        if torrent is None:
+            return
+        torrent.priorities = priorities
+        if torrent.state == RUNNING:
+            torrent.dl.set_option('file_priorities', priorities)
+
     def request_status(self, infohash, want_spew, want_fileinfo):
         torrent = self.torrents.get(infohash)
         if torrent is None or torrent.state != RUNNING:
@@ -679,6 +696,6 @@ def _makemethod(methodname):
         self.wrapped.rawserver.external_add_task(f, 0)
     return wrapper
 
-for methodname in "request_status set_config start_torrent start_new_torrent stop_torrent unqueue_torrent remove_torrent set_save_location requeue_running_torrent replace_running_torrent reorder_queue set_zero_running_torrents unset_zero_running_torrents check_completion".split():
+for methodname in "request_status set_config set_file_priorities start_torrent start_new_torrent stop_torrent unqueue_torrent remove_torrent set_save_location requeue_running_torrent replace_running_torrent reorder_queue set_zero_running_torrents unset_zero_running_torrents check_completion".split():
     setattr(ThreadWrappedQueue, methodname, _makemethod(methodname))
 del _makemethod, methodname
@@ -15,6 +15,8 @@
 单一上传。定义于BitTorrent/Downloader.py中，对应于一个连接中的上传。
 和SingleDownload一样，它与Connection一一对应，每次新连接建立时，由Encoder产生。
 '''
+from collections import OrderedDict
+
 from BitTorrent.CurrentRateMeasure import Measure
 
 
@@ -32,7 +34,9 @@ class Upload(object):
         self.choked = True
         self.unchoke_time = None
         self.interested = False
-        self.buffer = []
+        # requests to answer in the order they came, a cancel takes one
+        # out wherever it is
+        self.buffer = OrderedDict()
         self.measure = Measure(max_rate_period, fudge)
         if storage.do_I_have_anything():
             connection.send_bitfield(storage.get_have_list())
@@ -40,7 +44,7 @@ class Upload(object):
     def got_not_interested(self):
         if self.interested:
             self.interested = False
-            del self.buffer[:]
+            self.buffer.clear()
             self.choker.not_interested(self.connection)
 
     def got_interested(self):
@@ -51,7 +55,12 @@ class Upload(object):
     def get_upload_chunk(self):
         if not self.buffer:
             return None
-        index, begin, length = self.buffer.pop(0)
+        request = iter(self.buffer).next()
+        index, begin, length = request
+        if not self.storage.piece_ready(index, self._piece_ready):
+            # taken off the rate limiter until the disk has read the piece
+            return None
+        del self.buffer[request]
         piece = self.storage.get_piece(index, begin, length)
         if piece is None:
             self.connection.close()
@@ -60,21 +69,24 @@ class Upload(object):
         self.totalup.update_rate(len(piece))
         return (index, begin, piece)
 
+    def _piece_ready(self):
+        if self.buffer and not self.connection.closed and \
+               self.connection.next_upload is None and \
+               self.connection.connection.is_flushed():
+            self.ratelimiter.queue(self.connection)
+
     def got_request(self, index, begin, length):
         if not self.interested or length > self.max_slice_length:
             self.connection.close()
             return
         if not self.connection.choke_sent:
-            self.buffer.append((index, begin, length))
+            self.buffer[(index, begin, length)] = None
             if self.connection.next_upload is None and \
                    self.connection.connection.is_flushed():
                 self.ratelimiter.queue(self.connection)
 
     def got_cancel(self, index, begin, length):
-        try:
-            self.buffer.remove((index, begin, length))
-        except ValueError:
-            pass
+        self.buffer.pop((index, begin, length), None)
 
     def choke(self):
         if not self.choked:
@@ -83,7 +95,7 @@ class Upload(object):
 
     def sent_choke(self):
         assert self.choked
-        del self.buffer[:]
+        self.buffer.clear()
 
     def unchoke(self, time):
         if self.choked:
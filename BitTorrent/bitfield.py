@@ -18,70 +18,124 @@ Bitfield：位图对象。定义于BitTorrent/bitfield.py中，用来表示一
 
 @see: StorageWrapper, SingleDownload
 """
+from binascii import hexlify, unhexlify
 
 
+def _toint(s):
+    if not s:
+        return 0
+    return int(hexlify(s), 16)
 
-try:
-    sum([1])
-    negsum = lambda a: len(a)-sum(a)
-except:
-    negsum = lambda a: reduce(lambda x,y: x+(not y), a, 0)
-    
-def _int_to_booleans(x):
-    r = []
-    for i in range(8):
-        r.append(bool(x & 0x80))
-        x <<= 1
-    return tuple(r)
 
-lookup_table = [_int_to_booleans(i) for i in range(256)]
+# the number of set bits of each byte value, as a translate() table
+_bitcounts = ''.join([chr(bin(i).count('1')) for i in xrange(256)])
 
-reverse_lookup_table = {}
-for i in xrange(256):
-    reverse_lookup_table[lookup_table[i]] = chr(i)
+
+def popcount(s):
+    # number of set bits in a string
+    return sum(bytearray(s).translate(_bitcounts))
+
+# offsets of the set bits of each byte value, high bit first
+_positions = [tuple([j for j in xrange(8) if i & (0x80 >> j)])
+              for i in xrange(256)]
 
 
 class Bitfield(object):
+    # Bits are packed 8 to a byte in wire order, so converting from and to
+    # a BITFIELD message is a copy. Operations on whole bitfields are done
+    # on them as long integers.
 
     def __init__(self, length, bitstring = None):
         self.length = length
+        nbytes = (length + 7) // 8
         if bitstring is not None:
-            extra = len(bitstring) * 8 - length
-            if extra < 0 or extra >= 8:
+            if len(bitstring) != nbytes:
+                raise ValueError
+            extra = nbytes * 8 - length
+            if extra and ord(bitstring[-1]) & ((1 << extra) - 1):
                 raise ValueError
-            t = lookup_table
-            r = []
-            for c in bitstring:
-                r.extend(t[ord(c)])
-            if extra > 0:
-                if r[-extra:] != [0] * extra:
-                    raise ValueError
-                del r[-extra:]
-            self.array = r
-            self.numfalse = negsum(r)
+            self.bits = bytearray(bitstring)
+            self.numfalse = length - popcount(bitstring)
         else:
-            self.array = [False] * length
+            self.bits = bytearray(nbytes)
             self.numfalse = length
+        # the bits as a long, None when out of date
+        self._int = None
+
+    def _check_index(self, index):
+        # like a list: negative from the end, IndexError past it
+        if index < 0 and index >= -self.length:
+            return index + self.length
+        raise IndexError('bitfield index out of range')
 
     def __setitem__(self, index, val):
-        val = bool(val)
-        self.numfalse += self.array[index]-val
-        self.array[index] = val
+        if not 0 <= index < self.length:
+            index = self._check_index(index)
+        bits = self.bits
+        byte = index >> 3
+        mask = 0x80 >> (index & 7)
+        if val:
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                self.numfalse -= 1
+                self._int = None
+        elif bits[byte] & mask:
+            bits[byte] ^= mask
+            self.numfalse += 1
+            self._int = None
 
     def __getitem__(self, index):
-        return self.array[index]
+        if not 0 <= index < self.length:
+            index = self._check_index(index)
+        return self.bits[index >> 3] & (0x80 >> (index & 7)) != 0
 
     def __len__(self):
         return self.length
 
+    def _get_array(self):
+        # the bits as a list of bools, slow
+        return [bool(self[i]) for i in xrange(self.length)]
+    array = property(_get_array)
+
+    def _from_int(self, x):
+        r = Bitfield(0)
+        r.length = self.length
+        if self.bits:
+            r.bits = bytearray(unhexlify('%0*x' % (len(self.bits) * 2, x)))
+        r.numfalse = self.length - popcount(r.bits)
+        r._int = x
+        return r
+
+    def toint(self):
+        # piece i is bit len(self.bits) * 8 - 1 - i, kept until a bit changes
+        if self._int is None:
+            self._int = _toint(self.bits)
+        return self._int
+
+    def __and__(self, other):
+        return self._from_int(self.toint() & other.toint())
+
+    def andnot(self, other):
+        # what this one has that other doesn't
+        return self._from_int(self.toint() & ~other.toint())
+
+    def count(self):
+        return self.length - self.numfalse
+
+    def indices(self):
+        # the set bits in order
+        r = []
+        positions = _positions
+        i = 0
+        for b in self.bits:
+            if b:
+                for j in positions[b]:
+                    r.append(i + j)
+            i += 8
+        return r
+
     def tostring(self):
-        booleans = self.array
-        t = reverse_lookup_table
-        s = len(booleans) % 8
-        r = [ t[tuple(booleans[x:x+8])] for x in xrange(0, len(booleans)-s, 8) ]
-        if s:
-            r += t[tuple(booleans[-s:] + ([0] * (8-s)))]
-        return ''.join(r)
+        return str(self.bits)
 
     def complete(self):
         return not self.numfalse
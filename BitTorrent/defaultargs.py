@@ -84,6 +84,52 @@ rare_options = [
      "character encoding used on the local filesystem. If left empty, autodetected. Autodetection doesn't work under python versions older than 2.3"),
     ('enable_bad_libc_workaround', 0,
      'enable workaround for a bug in BSD libc that makes file reads very slow.'),
+    ('read_cache_size', 32,
+     'megabytes of memory used to cache whole pieces read from disk for '
+     'uploading, shared by all torrents. 0 disables the cache'),
+    ('write_cache_size', 32,
+     'megabytes of memory used to put downloaded pieces together before '
+     'they are hash checked and written, shared by all torrents. '
+     '0 writes every block to disk as it arrives'),
+    ('disk_threads', 2,
+     'number of threads doing disk reads and writes in the background. '
+     '0 does all disk I/O in the network thread'),
+    ('max_disk_queue', 16,
+     'megabytes of received data allowed to wait for the disk before '
+     'requesting more from peers is paused'),
+    ('allocation', 'sparse',
+     'how disk space is taken for downloads: "sparse" lets the files grow '
+     'as data is written, "full" reserves all of it before starting and '
+     '"background" reserves it bit by bit while downloading'),
+    ('storage_backend', 'file',
+     '"file" reads data for uploading with ordinary file reads, "mmap" '
+     'maps the files into memory and sends straight from the mapping '
+     'without copying, which suits seeding. The read cache is not used '
+     'for mapped torrents'),
+    ('direct_placement', 1,
+     'write every piece at its own place in the files, leaving holes until '
+     'they are filled. 0 fills the files from the start and moves pieces '
+     'into place later, which costs extra disk reads and writes'),
+    ('resume_interval', 60,
+     'seconds between saves of the resume data while downloading, so that '
+     'a crash does not mean checking all data again. 0 saves only on exit'),
+    ('max_endgame_requests', 4,
+     'once everything left has been requested, how many peers each '
+     'missing block may be asked from at the same time'),
+    ('streaming', 0,
+     'download for playing while downloading: the pieces just ahead of '
+     'the playback position go to the fastest peers first, the rest are '
+     'downloaded rarest first'),
+    ('stream_rate', 256,
+     'playback rate in kB/s when streaming, which sets when pieces are '
+     'needed'),
+    ('stream_window', 20,
+     'number of pieces ahead of the playback position downloaded first '
+     'when streaming'),
+    ('hash_check_processes', 0,
+     'number of processes hash checking existing data when torrents are '
+     'started, shared by all torrents. -1 means one per CPU, 0 checks in '
+     'the starting thread. Only used on POSIX systems'),
     ]
 
 def get_defaults(ui):
@@ -123,6 +169,8 @@ def get_defaults(ui):
              'url to get file from, alternative to responsefile'),
             ('ask_for_save', 0,
              'whether or not to ask for a location to save downloaded files in'),
+            ('file_priorities', '',
+             'comma separated priorities of the files in the torrent, in order: 1 downloads the file before the others, 0 normally and -1 skips it. Files left out are downloaded normally'),
             ])
 
     if ui.startswith('btlaunchmany'):
@@ -138,6 +186,8 @@ def get_defaults(ui):
               "2 = save under name in torrent, 3 = save in directory under torrent name)" ),
             ('display_path', ui == 'btlaunchmany' and 1 or 0,
               "whether to display the full path or the torrent contents for each torrent" ),
+            ('max_hash_checks', 2,
+              "how many torrents may check their existing data at the same time" ),
             ])
 
     if ui.startswith('btlaunchmany') or ui == 'btmaketorrentgui':
@@ -40,7 +40,7 @@ except AttributeError:
 
 from BitTorrent.btformats import check_message
 from BitTorrent.Choker import Choker
-from BitTorrent.Storage import Storage, FilePool
+from BitTorrent.Storage import Storage, FilePool, STORAGE_BACKENDS
 from BitTorrent.StorageWrapper import StorageWrapper
 from BitTorrent.Uploader import Upload
 from BitTorrent.Downloader import Downloader
@@ -51,7 +51,12 @@ from BitTorrent.Rerequester import Rerequester
 from BitTorrent.DownloaderFeedback import DownloaderFeedback
 from BitTorrent.RateMeasure import RateMeasure
 from BitTorrent.CurrentRateMeasure import Measure
-from BitTorrent.PiecePicker import PiecePicker
+from BitTorrent.PiecePicker import PiecePicker, piece_priorities
+from BitTorrent.PiecePicker import SKIP, NORMAL, HIGH
+from BitTorrent.Streamer import Streamer
+from BitTorrent.PieceCache import PieceCache, WriteBudget
+from BitTorrent.DiskIO import DiskIO
+from BitTorrent.HashChecker import HashChecker
 from BitTorrent.ConvertedMetainfo import ConvertedMetainfo, set_filesystem_encoding
 from BitTorrent import version
 from BitTorrent import BTFailure, INFO, WARNING, ERROR, CRITICAL
@@ -79,6 +84,8 @@ class Multitorrent(object):
 
     def __init__(self, config, doneflag, errorfunc, listen_fail_ok=False):
         self.config = dict(config)
+        # forks its workers, so before anything starts a thread
+        self.hashchecker = HashChecker(config['hash_check_processes'])
         self.rawserver = RawServer(doneflag, config['timeout_check_interval'],
                                    config['timeout'], errorfunc=errorfunc,
                                    bindaddr=config['bind'])
@@ -99,6 +106,11 @@ class Multitorrent(object):
                       ". Check your port range settings.")
             listen_port = 0
         self.filepool = FilePool(config['max_files_open'])
+        self.readcache = PieceCache(config['read_cache_size'] * 2 ** 20)
+        self.writebudget = WriteBudget(config['write_cache_size'] * 2 ** 20)
+        self.diskio = DiskIO(config['disk_threads'],
+                             config['max_disk_queue'] * 2 ** 20,
+                             self.rawserver.external_add_task)
         self.ratelimiter = RateLimiter(self.rawserver.add_task)
         self.ratelimiter.set_parameters(config['max_upload_rate'],
                                         config['upload_unit_size'])
@@ -116,7 +128,9 @@ class Multitorrent(object):
 
     def start_torrent(self, metainfo, config, feedback, filename):
         torrent = _SingleTorrent(self.rawserver, self.singleport_listener,
-                                 self.ratelimiter, self.filepool, config)
+                                 self.ratelimiter, self.filepool,
+                                 self.readcache, self.writebudget,
+                                 self.diskio, self.hashchecker, config)
         self.rawserver.add_context(torrent)
         def start():
             torrent.start_download(metainfo, feedback, filename)
@@ -127,11 +141,15 @@ class Multitorrent(object):
         if option not in self.config or self.config[option] == value:
             return
         if option not in 'max_upload_rate upload_unit_size '\
-               'max_files_open'.split():
+               'max_files_open read_cache_size write_cache_size'.split():
             return
         self.config[option] = value
         if option == 'max_files_open':
             self.filepool.set_max_files_open(value)
+        elif option == 'read_cache_size':
+            self.readcache.set_max_size(value * 2 ** 20)
+        elif option == 'write_cache_size':
+            self.writebudget.set_max_size(value * 2 ** 20)
         elif option == 'max_upload_rate':
             self.ratelimiter.set_parameters(value,
                                             self.config['upload_unit_size'])
@@ -164,7 +182,10 @@ class Multitorrent(object):
         except:
             f = None
         try:
-            r = s.check_fastresume(f, filelist, metainfo.piece_length,
+            resume = None
+            if f is not None:
+                resume = s.read_fastresume(f)
+            r = s.check_fastresume(resume, filelist, metainfo.piece_length,
                                    len(metainfo.hashes), myfiles)
         except:
             r = None
@@ -177,14 +198,48 @@ class Multitorrent(object):
         return r / metainfo.total_bytes
 
 
+def parse_priorities(value, numfiles):
+    # '1,0,-1' gives the first file HIGH priority and skips the third,
+    # files left out are NORMAL
+    parts = []
+    if value.strip():
+        parts = value.split(',')
+    try:
+        r = [int(x) for x in parts]
+    except ValueError:
+        raise BTFailure('bad file priorities: ' + value)
+    if len(r) > numfiles or [p for p in r if p not in (SKIP, NORMAL, HIGH)]:
+        raise BTFailure('bad file priorities: ' + value)
+    return r + [NORMAL] * (numfiles - len(r))
+
+
+def _write_atomically(filename, data):
+    # a crash leaves either the old file or the new one
+    tmp = filename + '.tmp'
+    f = file(tmp, 'wb')
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    if sys.platform == 'win32' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp, filename)
+
+
 class _SingleTorrent(object):
 
     def __init__(self, rawserver, singleport_listener, ratelimiter, filepool,
-                 config):
+                 readcache, writebudget, diskio, hashchecker, config):
         self._rawserver = rawserver
         self._singleport_listener = singleport_listener
         self._ratelimiter = ratelimiter
         self._filepool = filepool
+        self._readcache = readcache
+        self._writebudget = writebudget
+        self._diskio = diskio
+        self._hashchecker = hashchecker
         self.config = dict(config)
         self._storage = None
         self._storagewrapper = None
@@ -194,7 +249,11 @@ class _SingleTorrent(object):
         self._encoder = None
         self._rerequest = None
         self._statuscollecter = None
+        self._metainfo = None
+        self._picker = None
+        self._downloader = None
         self._announced = False
+        self._completed_sent = False
         self._listening = False
         self._myfiles = None
         self.started = False
@@ -205,6 +264,7 @@ class _SingleTorrent(object):
         self._doneflag = threading.Event()
         self.finflag = threading.Event()
         self._hashcheck_thread = None
+        self._resume_state = None
         self._contfunc = None
         self._activity = ('Initial startup', 0)
         self.feedback = None
@@ -229,6 +289,7 @@ class _SingleTorrent(object):
 
         self.infohash = metainfo.infohash
         self.total_bytes = metainfo.total_bytes
+        self._metainfo = metainfo
         if not metainfo.reported_errors:
             metainfo.show_encoding_errors(self._error)
 
@@ -246,24 +307,33 @@ class _SingleTorrent(object):
             myfiles = [save_path]
         self._filepool.add_files(myfiles, self)
         self._myfiles = myfiles
-        self._storage = Storage(config, self._filepool, zip(myfiles,
-                                                            metainfo.sizes))
-        resumefile = None
+        priorities = parse_priorities(config.get('file_priorities', ''),
+                                      len(myfiles))
+        backend = STORAGE_BACKENDS.get(config['storage_backend'])
+        if backend is None:
+            raise BTFailure('unknown storage backend ' +
+                            config['storage_backend'])
+        self._storage = backend(config, self._filepool,
+                                zip(myfiles, metainfo.sizes),
+                                skipped = [f for f, p in zip(myfiles,
+                                           priorities) if p == SKIP])
+        resume = None
         if config['data_dir']:
             filename = os.path.join(config['data_dir'], 'resume',
                                     self.infohash.encode('hex'))
             if os.path.exists(filename):
+                resumefile = None
                 try:
                     resumefile = file(filename, 'rb')
-                    if self._storage.check_fastresume(resumefile) == 0:
-                        resumefile.close()
-                        resumefile = None
+                    resume = self._storage.read_fastresume(resumefile)
+                    if self._storage.check_fastresume(resume) == 0:
+                        resume = None
                 except Exception, e:
                     self._error(WARNING, 'Could not load fastresume data: '+
                                 str(e) + '. Will perform full hash check.')
-                    if resumefile is not None:
-                        resumefile.close()
-                    resumefile = None
+                    resume = None
+                if resumefile is not None:
+                    resumefile.close()
         def data_flunked(amount, index):
             self._ratemeasure.data_rejected(amount)
             self._error(INFO, 'piece %d failed hash check, '
@@ -279,10 +349,15 @@ class _SingleTorrent(object):
                     activity = self._activity[0]
                 self._activity = (activity, fractionDone)
             try:
+                if config['allocation'] == 'full':
+                    statusfunc('allocating disk space', 0)
+                    self._storage.preallocate()
                 self._storagewrapper = StorageWrapper(self._storage,
                      config, metainfo.hashes, metainfo.piece_length,
                      self._finished, statusfunc, self._doneflag, data_flunked,
-                     self.infohash, errorfunc, resumefile)
+                     self.infohash, errorfunc, resume, self._readcache,
+                     self._diskio, self, self._writebudget,
+                     self._hashchecker)
             except:
                 backthread_exception.append(sys.exc_info())
             self._contfunc()
@@ -292,8 +367,6 @@ class _SingleTorrent(object):
         thread.start()
         yield None
         self._hashcheck_thread = None
-        if resumefile is not None:
-            resumefile.close()
         if backthread_exception:
             a, b, c = backthread_exception[0]
             raise a, b, c
@@ -322,6 +395,10 @@ class _SingleTorrent(object):
                 picker.complete(i)
         for i in self._storagewrapper.stat_dirty:
             picker.requested(i)
+        self._picker = picker
+        # may have been changed while checking existing data
+        self._set_file_priorities(parse_priorities(
+            config.get('file_priorities', ''), len(myfiles)))
         def kickpeer(connection):
             def kick():
                 connection.close()
@@ -331,6 +408,10 @@ class _SingleTorrent(object):
         downloader = Downloader(config, self._storagewrapper, picker,
             len(metainfo.hashes), downmeasure, self._ratemeasure.data_came_in,
                                 kickpeer, banpeer)
+        self._downloader = downloader
+        if config['streaming']:
+            downloader.streamer = Streamer(config, self._storagewrapper,
+                                           downloader, metainfo.piece_length)
         self._encoder = Encoder(make_upload, downloader, choker,
                      len(metainfo.hashes), self._ratelimiter, self._rawserver,
                      config, myid, schedfunc, self.infohash, self)
@@ -358,6 +439,11 @@ class _SingleTorrent(object):
         if not self.finflag.isSet():
             self._activity = ('downloading', 0)
         self.feedback.started(self)
+        if config['check_hashes'] and config['resume_interval'] > 0:
+            # the first one also marks the loaded resume data as stale
+            self._checkpoint()
+        if config['allocation'] == 'background':
+            self._preallocate()
 
     def got_exception(self, e):
         if isinstance(e, BTFailure):
@@ -396,18 +482,25 @@ class _SingleTorrent(object):
         # read-only mode (when they're possibly reopened). Let exceptions
         # from self._storage.close() kill the torrent since files might not
         # be correct on disk if file.close() failed.
+        self._storagewrapper.flush()
         self._storage.close()
         # If we haven't announced yet, normal first announce done later will
         # tell the tracker about seed status.
         self.is_seed = True
         if self._announced:
-            self._rerequest.announce(1)
+            if self._completed_sent:
+                # finished again after a skipped file was wanted,
+                # the tracker takes 'completed' only once
+                self._rerequest.announce()
+            else:
+                self._rerequest.announce(1)
+                self._completed_sent = True
         self._activity = ('seeding', 1)
         self.feedback.finished(self)
         if self.config['check_hashes']:
             self._save_fastresume(True)
 
-    def _save_fastresume(self, on_finish=False):
+    def _save_fastresume(self, on_finish=False, clean=True):
         if not on_finish and (self.finflag.isSet() or not self.started):
             return
         if not self.config['data_dir']:
@@ -418,16 +511,68 @@ class _SingleTorrent(object):
             amount_done = self.total_bytes - self._ratemeasure.get_size_left()
         filename = os.path.join(self.config['data_dir'], 'resume',
                                 self.infohash.encode('hex'))
-        resumefile = None
         try:
-            resumefile = file(filename, 'wb')
-            self._storage.write_fastresume(resumefile, amount_done)
-            self._storagewrapper.write_fastresume(resumefile)
-            resumefile.close()
+            state = self._storagewrapper.get_fastresume()
         except Exception, e:
             self._error(WARNING, 'Could not write fastresume data: ' + str(e))
-            if resumefile is not None:
-                resumefile.close()
+            return
+        state['clean'] = int(clean)
+        if state == self._resume_state:
+            return
+        self._resume_state = state
+        # The whole file is written again rather than the parts that
+        # changed: it is about 4 bytes a piece, its checksum covers all of
+        # it and only replacing it whole keeps a good copy through a crash.
+        def write():
+            # a checkpoint still queued at close isn't wanted any more
+            if self.closed and not clean:
+                return None
+            try:
+                # stats the files, so it's done here with the write
+                resumefile = StringIO()
+                self._storage.write_fastresume(resumefile, amount_done,
+                                               state)
+                _write_atomically(filename, resumefile.getvalue())
+            except (IOError, OSError), e:
+                return str(e)
+            return None
+        def written(e):
+            if e is not None:
+                self._resume_state = None
+                self._error(WARNING, 'Could not write fastresume data: ' + e)
+        if not clean:
+            self._diskio.submit(self, write, (), written, self)
+            return
+        # after any queued checkpoint, and done before returning
+        r = []
+        self._diskio.submit(self, lambda: r.append(write()))
+        self._diskio.wait(self)
+        if r:
+            written(r[0])
+
+    def _preallocate(self):
+        # reserves the rest of the files a few megabytes at a time while
+        # the disk isn't busy with downloaded data
+        if self.closed or self.finflag.isSet():
+            return
+        if self._storagewrapper.is_backlogged():
+            self._rawserver.add_task(self._preallocate, 1, self)
+            return
+        def allocated(more):
+            if more:
+                self._rawserver.add_task(self._preallocate, 0, self)
+        self._diskio.submit(self._storage, self._storage.preallocate,
+                            (2 ** 22,), allocated, self)
+
+    def _checkpoint(self):
+        # resume data for restarting after a crash, written by a disk
+        # thread when the disk isn't busy and something has changed
+        if self.closed or self.finflag.isSet():
+            return
+        self._rawserver.add_task(self._checkpoint,
+                                 self.config['resume_interval'], self)
+        if not self._storagewrapper.is_backlogged():
+            self._save_fastresume(clean = False)
 
     def shutdown(self):
         if self.closed:
@@ -455,8 +600,12 @@ class _SingleTorrent(object):
             self._singleport_listener.remove_torrent(self.infohash)
         if self._encoder is not None:
             self._encoder.close_connections()
+        if self._storagewrapper is not None:
+            self._storagewrapper.close()
         if self._storage is not None:
             self._storage.close()
+        # a checkpoint being written
+        self._diskio.wait(self)
 
     def get_status(self, spew = False, fileinfo=False):
         if self.started and not self.closed:
@@ -477,12 +626,47 @@ class _SingleTorrent(object):
         if option not in self.config or self.config[option] == value:
             return
         if option not in 'min_uploads max_uploads max_initiate max_allow_in '\
-           'data_dir ip max_upload_rate retaliate_to_garbled_data'.split():
+           'data_dir ip max_upload_rate retaliate_to_garbled_data '\
+           'file_priorities'.split():
+            return
+        if option == 'file_priorities' and self.started:
+            try:
+                priorities = parse_priorities(value, len(self._myfiles))
+            except BTFailure, e:
+                self._error(ERROR, str(e))
+                return
+            self.config[option] = value
+            self._set_file_priorities(priorities)
+            self._downloader.priorities_changed()
             return
         # max_upload_rate doesn't affect upload rate here, just auto uploads
         self.config[option] = value
         self._set_auto_uploads()
 
+    def _set_file_priorities(self, priorities):
+        self._storage.set_skipped([f for f, p in zip(self._myfiles,
+                                                     priorities) if p == SKIP])
+        pieces = piece_priorities(priorities, self._metainfo.sizes,
+                                  self._metainfo.piece_length)
+        left = self._storagewrapper.amount_left
+        # finishes the torrent if only skipped pieces were left
+        self._storagewrapper.set_skipped([i for i, p in enumerate(pieces)
+                                          if p == SKIP])
+        self._ratemeasure.adjust_left(self._storagewrapper.amount_left - left)
+        self._picker.set_priorities(pieces)
+        if self.finflag.isSet() and self._storagewrapper.amount_left:
+            # A skipped file is wanted now. The 'completed' event and
+            # feedback.finished() can't be taken back; the tracker sees
+            # the new amount left and _finished() runs again when done.
+            self.finflag.clear()
+            self.is_seed = False
+            self._activity = ('downloading', 0)
+            if self._announced:
+                self._rerequest.announce()
+            if self.started and self.config['check_hashes'] and \
+                   self.config['resume_interval'] > 0:
+                self._checkpoint()
+
     def _set_auto_uploads(self):
         uploads = self.config['max_uploads']
         rate = self.config['max_upload_rate']
@@ -47,7 +47,9 @@ class LaunchMany(Feedback):
 
             self.hashcheck_queue = []
             self.hashcheck_store = {}
-            self.hashcheck_current = None
+            # torrents currently checking their data, at most
+            # max_hash_checks of them
+            self.hashcheck_active = {}
 
             self.multitorrent = Multitorrent(config, self.doneflag,
                                              self.global_error)
@@ -169,15 +171,16 @@ class LaunchMany(Feedback):
         self.check_hashcheck_queue()
 
     def check_hashcheck_queue(self):
-        if self.hashcheck_current is not None or not self.hashcheck_queue:
-            return
-        self.hashcheck_current = self.hashcheck_queue.pop(0)
-        metainfo = self.hashcheck_store[self.hashcheck_current]
-        del self.hashcheck_store[self.hashcheck_current]
-        filename = self.determine_filename(self.hashcheck_current)
-        self.downloads[self.hashcheck_current] = self.multitorrent. \
-                          start_torrent(ConvertedMetainfo(metainfo),
-                                        self.config, self, filename)
+        while self.hashcheck_queue and len(self.hashcheck_active) < \
+                  max(1, self.config['max_hash_checks']):
+            infohash = self.hashcheck_queue.pop(0)
+            self.hashcheck_active[infohash] = None
+            metainfo = self.hashcheck_store[infohash]
+            del self.hashcheck_store[infohash]
+            filename = self.determine_filename(infohash)
+            self.downloads[infohash] = self.multitorrent. \
+                              start_torrent(ConvertedMetainfo(metainfo),
+                                            self.config, self, filename)
 
     def determine_filename(self, infohash):
         x = self.torrent_cache[infohash]
@@ -206,8 +209,8 @@ class LaunchMany(Feedback):
             pass
         else:
             del self.hashcheck_store[infohash]
-        if self.hashcheck_current == infohash:
-            self.hashcheck_current = None
+        if infohash in self.hashcheck_active:
+            del self.hashcheck_active[infohash]
         self.check_hashcheck_queue()
 
     def global_error(self, level, text):
@@ -238,7 +241,8 @@ class LaunchMany(Feedback):
     # rest are callbacks from torrent instances
 
     def started(self, torrent):
-        self.hashcheck_current = None
+        if torrent.infohash in self.hashcheck_active:
+            del self.hashcheck_active[torrent.infohash]
         self.check_hashcheck_queue()
 
     def failed(self, torrent):
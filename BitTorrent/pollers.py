@@ -0,0 +1,121 @@
+# coding: utf-8
+# The contents of this file are subject to the BitTorrent Open Source License
+# Version 1.0 (the License).  You may not copy or use this file, in either
+# source code or executable form, except in compliance with the License.  You
+# may obtain a copy of the License at http://www.bittorrent.com/license/.
+#
+# Software distributed under the License is distributed on an AS IS basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied.  See the License
+# for the specific language governing rights and limitations under the
+# License.
+'''
+@note:
+RawServer 使用的轮询层。Linux 下使用边沿触发的 epoll，其它平台退回到
+select.poll（或基于 select() 的 selectpoll）。两种实现都记录每个文件描述符
+当前注册的事件掩码，只有掩码真正改变时才会调用系统的注册接口。
+'''
+from types import IntType
+from errno import ENOENT
+
+try:
+    from select import poll, error, POLLIN, POLLOUT, POLLERR, POLLHUP
+    timemult = 1000
+except ImportError:
+    from BitTorrent.selectpoll import poll, error, POLLIN, POLLOUT, POLLERR, POLLHUP
+    timemult = 1
+
+try:
+    from select import epoll, EPOLLET
+except ImportError:
+    epoll = None
+
+# epoll only exists on Linux, where the EPOLL* event bits have the same
+# values as the POLL* ones above, so events can be passed through unchanged.
+
+# epoll.poll() takes seconds but converts to milliseconds in a C int
+MAX_EPOLL_TIMEOUT = 2000000
+
+
+def _fileno(f):
+    if type(f) != IntType:
+        f = f.fileno()
+    return f
+
+
+class PollPoller(object):
+
+    edge_triggered = False
+
+    def __init__(self):
+        self._poll = poll()
+        self.masks = {}
+
+    def register(self, f, mask, edge = False):
+        f = _fileno(f)
+        if self.masks.get(f) == mask:
+            return
+        self._poll.register(f, mask)
+        self.masks[f] = mask
+
+    def unregister(self, f):
+        f = _fileno(f)
+        if f in self.masks:
+            del self.masks[f]
+        self._poll.unregister(f)
+
+    def poll(self, timeout):
+        return self._poll.poll(timeout * timemult)
+
+
+class EpollPoller(object):
+
+    # Sockets registered with edge = True get EPOLLET; the caller must then
+    # read until the socket would block and can leave POLLOUT registered
+    # permanently. Listening sockets and the wakeup pipe stay level-triggered.
+    edge_triggered = True
+
+    def __init__(self):
+        self._epoll = epoll()
+        self.masks = {}
+
+    def register(self, f, mask, edge = False):
+        f = _fileno(f)
+        if edge:
+            mask |= EPOLLET
+        old = self.masks.get(f)
+        if old == mask:
+            return
+        if old is None:
+            self._epoll.register(f, mask)
+        else:
+            try:
+                self._epoll.modify(f, mask)
+            except IOError, e:
+                # the kernel drops closed fds on its own
+                if e.errno != ENOENT:
+                    raise
+                self._epoll.register(f, mask)
+        self.masks[f] = mask
+
+    def unregister(self, f):
+        f = _fileno(f)
+        if f not in self.masks:
+            return
+        del self.masks[f]
+        try:
+            self._epoll.unregister(f)
+        except (IOError, ValueError):
+            pass
+
+    def poll(self, timeout):
+        try:
+            return self._epoll.poll(min(timeout, MAX_EPOLL_TIMEOUT))
+        except IOError, e:
+            # RawServer only knows how to deal with select.error
+            raise error(e.errno, e.strerror)
+
+
+def get_poller():
+    if epoll is not None:
+        return EpollPoller()
+    return PollPoller()
@@ -0,0 +1,113 @@
+# coding: utf-8
+'''
+Disk allocation benchmark.
+
+Writes the pieces of a torrent to temporary files in random order, the way
+they arrive from peers, once for each allocation strategy: sparse files,
+files allocated in full before the download and files allocated a few
+megabytes at a time while it runs. Then drops the files from the page
+cache and reports the time to read them back sequentially, and the number
+of extents the files ended up in if filefrag is available.
+
+usage: benchAllocation.py [megabytes] [directory]
+'''
+import os
+import sys
+import shutil
+import tempfile
+from random import Random
+from time import time
+
+from BitTorrent.defaultargs import get_defaults
+from BitTorrent.Storage import Storage, FilePool, ALLOCATION_STRATEGIES
+
+PIECE_SIZE = 2 ** 18
+READ_SIZE = 2 ** 20
+POSIX_FADV_DONTNEED = 4
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    _fadvise = _libc.posix_fadvise
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                         ctypes.c_int]
+except Exception:
+    _fadvise = None
+
+
+def drop_cache(filename):
+    f = file(filename, 'rb')
+    try:
+        os.fsync(f.fileno())
+        if _fadvise is not None:
+            _fadvise(f.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+        f.close()
+
+
+def extents(filename):
+    p = os.popen('filefrag %s 2>/dev/null' % filename)
+    try:
+        s = p.read()
+    finally:
+        p.close()
+    try:
+        return int(s.split(':')[-1].split()[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def run_once(config, directory, data):
+    d = tempfile.mkdtemp(dir = directory)
+    try:
+        files = [os.path.join(d, 'a'), os.path.join(d, 'b')]
+        sizes = [len(data) // 3, len(data) - len(data) // 3]
+        filepool = FilePool(config['max_files_open'])
+        storage = Storage(config, filepool, zip(files, sizes))
+        order = range(0, len(data), PIECE_SIZE)
+        Random(2).shuffle(order)
+        t = time()
+        if config['allocation'] == 'full':
+            storage.preallocate()
+        for i, pos in enumerate(order):
+            if config['allocation'] == 'background' and i % 16 == 0:
+                storage.preallocate(2 ** 22)
+            storage.write(pos, buffer(data, pos, PIECE_SIZE))
+        storage.close()
+        for f in files:
+            drop_cache(f)
+        written = time() - t
+        t = time()
+        for f in files:
+            h = file(f, 'rb')
+            while h.read(READ_SIZE):
+                pass
+            h.close()
+        read = time() - t
+        e = [extents(f) for f in files]
+        if None in e:
+            e = None
+        else:
+            e = sum(e)
+        return written, read, e
+    finally:
+        shutil.rmtree(d)
+
+
+def run(megabytes = 256, directory = None):
+    config = dict([(name, value) for name, value, doc in
+                   get_defaults('btdownloadheadless')])
+    size = int(megabytes) * 2 ** 20
+    data = os.urandom(size)
+    for allocation in ALLOCATION_STRATEGIES:
+        config['allocation'] = allocation
+        written, read, e = run_once(config, directory, data)
+        print '%s:' % allocation
+        print '%10.2f s to write and flush' % written
+        print '%10.2f MB/s sequential read' % (size / read / 2 ** 20)
+        if e is not None:
+            print '%10d extents' % e
+
+if __name__ == '__main__':
+    run(*sys.argv[1:])
@@ -0,0 +1,120 @@
+# coding: utf-8
+'''
+Bitfield memory and speed benchmark.
+
+Compares the packed Bitfield with the list of bools it replaced, kept
+here as ListBitfield, for a torrent with many pieces: memory per peer,
+parsing and building BITFIELD messages, setting bits as HAVE messages
+come in, and finding the pieces a peer has that we don't.
+
+usage: benchBitfield.py [pieces] [rounds]
+'''
+import sys
+from random import Random
+from time import time
+
+from BitTorrent.bitfield import Bitfield
+
+
+def _int_to_booleans(x):
+    r = []
+    for i in range(8):
+        r.append(bool(x & 0x80))
+        x <<= 1
+    return tuple(r)
+
+lookup_table = [_int_to_booleans(i) for i in range(256)]
+
+reverse_lookup_table = {}
+for i in xrange(256):
+    reverse_lookup_table[lookup_table[i]] = chr(i)
+
+
+class ListBitfield(object):
+
+    def __init__(self, length, bitstring = None):
+        self.length = length
+        if bitstring is not None:
+            extra = len(bitstring) * 8 - length
+            if extra < 0 or extra >= 8:
+                raise ValueError
+            t = lookup_table
+            r = []
+            for c in bitstring:
+                r.extend(t[ord(c)])
+            if extra > 0:
+                if r[-extra:] != [0] * extra:
+                    raise ValueError
+                del r[-extra:]
+            self.array = r
+            self.numfalse = len(r) - sum(r)
+        else:
+            self.array = [False] * length
+            self.numfalse = length
+
+    def __setitem__(self, index, val):
+        val = bool(val)
+        self.numfalse += self.array[index]-val
+        self.array[index] = val
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def tostring(self):
+        booleans = self.array
+        t = reverse_lookup_table
+        s = len(booleans) % 8
+        r = [ t[tuple(booleans[x:x+8])] for x in xrange(0, len(booleans)-s, 8) ]
+        if s:
+            r += t[tuple(booleans[-s:] + ([0] * (8-s)))]
+        return ''.join(r)
+
+
+def timed(func, rounds):
+    t = time()
+    for i in xrange(rounds):
+        func()
+    return (time() - t) / rounds * 1000
+
+
+def run(pieces = 100000, rounds = 10):
+    pieces = int(pieces)
+    rounds = int(rounds)
+    rand = Random(5)
+    theirs = Bitfield(pieces)
+    mine = Bitfield(pieces)
+    for i in xrange(pieces):
+        theirs[i] = rand.random() < 0.5
+        mine[i] = rand.random() < 0.5
+    message = theirs.tostring()
+    order = range(pieces)
+    rand.shuffle(order)
+    for name, cls in (('list of bools', ListBitfield),
+                      ('packed', Bitfield)):
+        b = cls(pieces, message)
+        m = cls(pieces, mine.tostring())
+        if cls is ListBitfield:
+            # the list, its pointers to the shared True and False
+            size = sys.getsizeof(b.array)
+            def missing():
+                return [i for i in xrange(pieces) if b[i] and not m[i]]
+        else:
+            size = sys.getsizeof(b.bits)
+            def missing():
+                return b.andnot(m).indices()
+        def sets():
+            x = cls(pieces)
+            for i in order:
+                x[i] = True
+        print '%s, %d pieces:' % (name, pieces)
+        print '%10d bytes per peer' % size
+        print '%10.2f ms to parse a BITFIELD message' % \
+              timed(lambda: cls(pieces, message), rounds)
+        print '%10.2f ms to build a BITFIELD message' % \
+              timed(b.tostring, rounds)
+        print '%10.2f ms to set every bit' % timed(sets, rounds)
+        print '%10.2f ms to find what a peer has that we need' % \
+              timed(missing, rounds)
+
+if __name__ == '__main__':
+    run(*sys.argv[1:])
@@ -0,0 +1,92 @@
+# coding: utf-8
+'''
+Endgame benchmark.
+
+Puts many peers into endgame mode with many blocks outstanding, each
+peer asking for up to a backlog of them, then lets the blocks come in
+one at a time in random order, cancelling them from the other peers
+that were asked and handing those peers more. Compares the list of all
+requests scanned for every peer, as the Downloader kept before, with the
+EndGame index, which takes the blocks from buckets by how many peers they
+were asked from.
+
+usage: benchEndgame.py [blocks] [peers] [backlog]
+'''
+import sys
+from random import Random, shuffle
+from time import time
+
+from BitTorrent.bitfield import Bitfield
+from BitTorrent.EndGame import EndGame
+
+BLOCKS_PER_PIECE = 16
+
+
+class Peer(object):
+
+    def __init__(self, numpieces):
+        self.have = Bitfield(numpieces)
+        for i in xrange(numpieces):
+            self.have[i] = True
+        self.active_requests = []
+
+
+def list_fix(peer, all_requests, backlog):
+    want = [a for a in all_requests if peer.have[a[0]] and
+            a not in peer.active_requests]
+    shuffle(want)
+    del want[backlog - len(peer.active_requests):]
+    peer.active_requests.extend(want)
+
+
+def run_list(requests, peers, backlog, order):
+    all_requests = list(requests)
+    for p in peers:
+        list_fix(p, all_requests, backlog)
+    for request in order:
+        all_requests.remove(request)
+        for p in peers:
+            try:
+                p.active_requests.remove(request)
+            except ValueError:
+                continue
+            list_fix(p, all_requests, backlog)
+
+
+def run_index(requests, peers, backlog, order, max_requesters):
+    endgame = EndGame(max_requesters)
+    for request in requests:
+        endgame.add(request)
+    for p in peers:
+        p.active_requests.extend(endgame.wanted(p, backlog))
+    for request in order:
+        for p in endgame.received(request):
+            p.active_requests.remove(request)
+            p.active_requests.extend(
+                endgame.wanted(p, backlog - len(p.active_requests)))
+
+
+def run(blocks = 2000, peers = 100, backlog = 50):
+    blocks = int(blocks)
+    numpeers = int(peers)
+    backlog = int(backlog)
+    numpieces = (blocks + BLOCKS_PER_PIECE - 1) // BLOCKS_PER_PIECE
+    requests = [(i // BLOCKS_PER_PIECE, i % BLOCKS_PER_PIECE * 2 ** 14,
+                 2 ** 14) for i in xrange(blocks)]
+    order = list(requests)
+    Random(9).shuffle(order)
+    print '%d blocks outstanding, %d peers, backlog %d:' % (blocks, numpeers,
+                                                           backlog)
+    peers = [Peer(numpieces) for i in xrange(numpeers)]
+    t = time()
+    run_list(requests, peers, backlog, order)
+    print '%10.2f s scanning the list of all requests' % (time() - t)
+    for max_requesters in (4, numpeers):
+        peers = [Peer(numpieces) for i in xrange(numpeers)]
+        t = time()
+        run_index(requests, peers, backlog, order, max_requesters)
+        print '%10.2f s indexed, at most %d peers per block' % (
+            time() - t, max_requesters)
+
+if __name__ == '__main__':
+    run(*sys.argv[1:])
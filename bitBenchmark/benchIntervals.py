@@ -0,0 +1,63 @@
+# coding: utf-8
+'''
+Storage file lookup benchmark.
+
+Builds a Storage over a torrent of many small files (only the layout, no
+files are created) and times looking up the file spans of every 16KB
+block and of every whole piece, as read() and write() and allocated() /
+downloaded() do, with and without the piece index from index_pieces().
+Also runs a torrent of a few large files, where most blocks are in one
+file.
+
+usage: benchIntervals.py [files] [rounds]
+'''
+import sys
+from random import Random
+from time import time
+
+from BitTorrent.Storage import Storage
+
+PIECE_SIZE = 2 ** 18
+BLOCK_SIZE = 2 ** 14
+
+
+def lookups(storage, rounds):
+    total = storage.get_total_length()
+    intervals = storage._intervals
+    t = time()
+    n = 0
+    for i in xrange(rounds):
+        for pos in xrange(0, total, BLOCK_SIZE):
+            intervals(pos, min(BLOCK_SIZE, total - pos))
+            n += 1
+        for pos in xrange(0, total, PIECE_SIZE):
+            intervals(pos, min(PIECE_SIZE, total - pos))
+            n += 1
+    return n, time() - t
+
+
+def run_layout(name, sizes, rounds):
+    files = [('f%d' % i, size) for i, size in enumerate(sizes)]
+    storage = Storage(None, None, files, True)
+    print '%s, %d files, %d MB:' % (name, len(files),
+                                   storage.get_total_length() // 2 ** 20)
+    n, t = lookups(storage, rounds)
+    print '%10d lookups per second searching all files' % (n / t)
+    t = time()
+    storage.index_pieces(PIECE_SIZE)
+    print '%10.3f s to build the piece index' % (time() - t)
+    n, t = lookups(storage, rounds)
+    print '%10d lookups per second with the piece index' % (n / t)
+
+
+def run(files = 100000, rounds = 3):
+    files = int(files)
+    rounds = int(rounds)
+    rand = Random(4)
+    run_layout('small files', [rand.randrange(16384) for i in xrange(files)],
+               rounds)
+    run_layout('large files', [rand.randrange(2 ** 30) for i in xrange(4)],
+               rounds)
+
+if __name__ == '__main__':
+    run(*sys.argv[1:])
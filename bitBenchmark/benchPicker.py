@@ -0,0 +1,76 @@
+# coding: utf-8
+'''
+Peer churn benchmark for PiecePicker.
+
+Connects and disconnects peers with random bitfields, a third of them
+seeds, on a torrent with many pieces, picking a piece after every
+connection the way a new peer's first request would. Availability is
+updated piece by piece with got_have()/lost_have(), as before, and with
+whole bitfields and seed counts.
+
+usage: benchPicker.py [pieces] [peers]
+'''
+import sys
+from random import Random
+from time import time
+
+from BitTorrent.bitfield import Bitfield
+from BitTorrent.PiecePicker import PiecePicker
+
+
+def make_peers(numpieces, numpeers):
+    rand = Random(6)
+    peers = []
+    for i in xrange(numpeers):
+        b = Bitfield(numpieces)
+        if rand.random() < 1 / 3.:
+            chance = 1
+        else:
+            chance = rand.random()
+        for j in xrange(numpieces):
+            b[j] = rand.random() < chance
+        peers.append(b)
+    return peers
+
+
+def churn(picker, peers, batched):
+    rand = Random(7)
+    connected = []
+    t = time()
+    for i in xrange(len(peers) * 2):
+        if connected and (i >= len(peers) or rand.random() < 0.4):
+            b = connected.pop(rand.randrange(len(connected)))
+            if not batched:
+                for j in b.indices():
+                    picker.lost_have(j)
+            elif b.complete():
+                picker.lost_seed()
+            else:
+                picker.lost_have_bitfield(b)
+        elif i < len(peers):
+            b = peers[i]
+            connected.append(b)
+            if not batched:
+                for j in b.indices():
+                    picker.got_have(j)
+            elif b.complete():
+                picker.got_seed()
+            else:
+                picker.got_have_bitfield(b)
+            picker.next(b.__getitem__, b)
+    return time() - t
+
+
+def run(numpieces = 50000, numpeers = 200):
+    numpieces = int(numpieces)
+    numpeers = int(numpeers)
+    peers = make_peers(numpieces, numpeers)
+    config = {'rarest_first_cutoff': 4}
+    for name, batched in (('piece by piece', False), ('batched', True)):
+        picker = PiecePicker(numpieces, config)
+        picker.numgot = 4
+        print '%s, %d pieces, %d peers:' % (name, numpieces, numpeers)
+        print '%10.2f s' % churn(picker, peers, batched)
+
+if __name__ == '__main__':
+    run(*sys.argv[1:])
@@ -0,0 +1,92 @@
+# coding: utf-8
+'''
+PiecePicker.next() benchmark.
+
+Connects many peers to a torrent with many pieces, half of which we
+already have, then times picking the rarest wanted piece for each peer.
+next(), which asks about a sample of the rarest pieces and then ANDs
+bitsets with the peer's bitfield, is compared with walking the pieces
+rarity by rarity and asking the peer about each, as next() did before,
+kept here as walk_next. Peers which have few of the pieces we want are
+timed separately, as that is where the walk was slowest.
+
+usage: benchPickerNext.py [pieces] [peers] [rounds]
+'''
+import sys
+from random import Random
+from time import time
+
+from BitTorrent.bitfield import Bitfield
+from BitTorrent.PiecePicker import PiecePicker
+
+
+def make_bitfield(rand, numpieces, chance, like = None):
+    b = Bitfield(numpieces)
+    for i in xrange(numpieces):
+        if like is not None and rand.random() < chance:
+            b[i] = like[i]
+        else:
+            b[i] = rand.random() < chance
+    return b
+
+
+def make_interests(picker, rand):
+    # numinterests buckets of the pieces we don't have, in random order
+    order = range(picker.numpieces)
+    rand.shuffle(order)
+    interests = [[] for i in xrange(len(picker.levels))]
+    for piece in order:
+        if not picker.have[piece]:
+            interests[picker.get_numinterests(piece)].append(piece)
+    return interests
+
+
+def walk_next(picker, interests, havefunc):
+    for i in xrange(not picker.seeds, len(interests)):
+        for j in interests[i]:
+            if havefunc(j):
+                return j
+    return None
+
+
+def timed(pick, peers, rounds):
+    t = time()
+    for i in xrange(rounds):
+        for b in peers:
+            pick(b)
+    return (time() - t) / rounds / len(peers) * 10 ** 6
+
+
+def run(numpieces = 100000, numpeers = 200, rounds = 3):
+    numpieces = int(numpieces)
+    numpeers = int(numpeers)
+    rounds = int(rounds)
+    rand = Random(8)
+    picker = PiecePicker(numpieces, {'rarest_first_cutoff': 0})
+    mine = make_bitfield(rand, numpieces, 0.5)
+    for i in mine.indices():
+        picker.complete(i)
+    # most peers have a random share of the pieces, the rest mostly
+    # the same pieces as us
+    common = []
+    few = []
+    for i in xrange(numpeers):
+        if i % 4:
+            b = make_bitfield(rand, numpieces, rand.random())
+            common.append(b)
+        else:
+            b = make_bitfield(rand, numpieces, 0.999, mine)
+            few.append(b)
+        picker.got_have_bitfield(b)
+    interests = make_interests(picker, rand)
+    for name, peers in (('peers with many wanted pieces', common),
+                        ('peers with few wanted pieces', few)):
+        print '%s, %d pieces, %d peers:' % (name, numpieces, len(peers))
+        print '%10.1f us per pick walking the rarities' % timed(
+            lambda b: walk_next(picker, interests, b.__getitem__), peers,
+            rounds)
+        print '%10.1f us per pick with next()' % timed(
+            lambda b: picker.next(b.__getitem__, b), peers, rounds)
+
+if __name__ == '__main__':
+    run(*sys.argv[1:])
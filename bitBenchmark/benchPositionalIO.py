@@ -0,0 +1,103 @@
+# coding: utf-8
+'''
+Concurrent disk read benchmark.
+
+Reads random 16KB blocks of two files from several threads at once
+through Storage.read, the way disk threads serving uploads and checking
+hashes do, with pread() and with seek and read under the FilePool lock.
+Reports blocks read per second with the files in the page cache, and with
+the files dropped from it before each run if posix_fadvise is available
+so that the reads wait for the disk.
+
+usage: benchPositionalIO.py [megabytes] [threads] [directory]
+'''
+import os
+import sys
+import shutil
+import tempfile
+from random import Random
+from threading import Thread
+from time import time
+
+from BitTorrent import Storage as StorageModule
+from BitTorrent.defaultargs import get_defaults
+from BitTorrent.Storage import Storage, FilePool
+
+BLOCK_SIZE = 2 ** 14
+# blocks read in each run, split between the threads
+READS = 40000
+POSIX_FADV_DONTNEED = 4
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    _fadvise = _libc.posix_fadvise
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                         ctypes.c_int]
+except Exception:
+    _fadvise = None
+
+
+def drop_cache(files):
+    for filename in files:
+        f = file(filename, 'rb')
+        try:
+            os.fsync(f.fileno())
+            _fadvise(f.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+        finally:
+            f.close()
+
+
+def run_once(config, files, sizes, threads, cold):
+    if cold:
+        drop_cache(files)
+    filepool = FilePool(config['max_files_open'])
+    storage = Storage(config, filepool, zip(files, sizes))
+    total = sum(sizes)
+    def reads(seed):
+        rand = Random(seed)
+        for i in xrange(READS // threads):
+            storage.read(rand.randrange(total // BLOCK_SIZE) * BLOCK_SIZE,
+                         BLOCK_SIZE)
+    workers = [Thread(target = reads, args = (i,)) for i in xrange(threads)]
+    t = time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    t = time() - t
+    storage.close()
+    return READS // threads * threads / t
+
+
+def run(megabytes = 64, threads = 4, directory = None):
+    config = dict([(name, value) for name, value, doc in
+                   get_defaults('btdownloadheadless')])
+    size = int(megabytes) * 2 ** 20
+    d = tempfile.mkdtemp(dir = directory)
+    try:
+        files = [os.path.join(d, 'a'), os.path.join(d, 'b')]
+        sizes = [size // 2, size // 2]
+        for f, s in zip(files, sizes):
+            h = file(f, 'wb')
+            h.write(os.urandom(s))
+            h.close()
+        positional = StorageModule.POSITIONAL_IO
+        try:
+            for name, flag in (('pread', positional),
+                               ('seek and read under the lock', False)):
+                StorageModule.POSITIONAL_IO = flag
+                for cold in (False, True)[:1 + (_fadvise is not None)]:
+                    for n in (1, int(threads)):
+                        print '%s, %d threads%s:' % (name, n,
+                                                    cold and ', cold' or '')
+                        print '%10d blocks per second' % \
+                              run_once(config, files, sizes, n, cold)
+        finally:
+            StorageModule.POSITIONAL_IO = positional
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    run(*sys.argv[1:])
@@ -0,0 +1,139 @@
+# coding: utf-8
+'''
+RawServer event loop microbenchmark.
+
+A child process opens IDLE + ACTIVE loopback connections to this process.
+All accepted sockets are handed to one RawServer running echo handlers; the
+child keeps one small message in flight on each active connection and never
+touches the idle ones. Reported is the number of echoed messages per second
+and the parent's CPU time per message for every available poller.
+
+usage: benchRawServer.py [idle [active [seconds]]]
+'''
+import os
+import sys
+import socket
+import resource
+from threading import Event
+from time import time
+
+from BitTorrent.RawServer import RawServer
+from BitTorrent import pollers
+
+MESSAGE = 'x' * 64
+
+
+class EchoHandler(object):
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    def data_came_in(self, conn, s):
+        self.counter[0] += len(s)
+        conn.write(s)
+
+    def connection_lost(self, conn):
+        pass
+
+    def connection_flushed(self, conn):
+        pass
+
+
+class PingHandler(object):
+
+    def __init__(self):
+        self.received = 0
+
+    def data_came_in(self, conn, s):
+        self.received += len(s)
+        if self.received >= len(MESSAGE):
+            self.received -= len(MESSAGE)
+            conn.write(MESSAGE)
+
+    def connection_lost(self, conn):
+        pass
+
+    def connection_flushed(self, conn):
+        pass
+
+
+def raise_fd_limit(wanted):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    if wanted > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def run_client(port, idle, active, seconds):
+    socks = []
+    for i in xrange(idle + active):
+        socks.append(socket.create_connection(('127.0.0.1', port)))
+    doneflag = Event()
+    rawserver = RawServer(doneflag, 3600, 3600)
+    for sock in socks[idle:]:
+        conn = rawserver.wrap_socket(sock, PingHandler())
+        conn.write(MESSAGE)
+    rawserver.add_task(doneflag.set, seconds + 1)
+    rawserver.listen_forever()
+    os._exit(0)
+
+
+def run_server(poller, idle, active, seconds):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    port = listener.getsockname()[1]
+    pid = os.fork()
+    if pid == 0:
+        listener.close()
+        run_client(port, idle, active, seconds)
+    doneflag = Event()
+    rawserver = RawServer(doneflag, 3600, 3600, poller = poller)
+    counter = [0]
+    for i in xrange(idle + active):
+        sock, addr = listener.accept()
+        rawserver.wrap_socket(sock, EchoHandler(counter))
+    listener.close()
+    marks = []
+    def start():
+        marks.append((time(), cpu_time(), counter[0]))
+    def stop():
+        marks.append((time(), cpu_time(), counter[0]))
+        doneflag.set()
+    # give the child a moment to get all connections going
+    rawserver.add_task(start, 0.5)
+    rawserver.add_task(stop, seconds + 0.5)
+    rawserver.listen_forever()
+    os.waitpid(pid, 0)
+    (t0, cpu0, b0), (t1, cpu1, b1) = marks
+    messages = (b1 - b0) / len(MESSAGE)
+    if messages == 0:
+        return 0, 0
+    return messages / (t1 - t0), (cpu1 - cpu0) / messages * 1e6
+
+
+def run(idle = 10000, active = 500, seconds = 5):
+    limit = raise_fd_limit(idle + active + 100)
+    if idle + active + 100 > limit:
+        idle = max(0, limit - active - 100)
+        print 'fd limit is %d, using %d idle sockets' % (limit, idle)
+    backends = [('poll', pollers.PollPoller)]
+    if pollers.epoll is not None:
+        backends.insert(0, ('epoll', pollers.EpollPoller))
+    print '%d idle + %d active loopback sockets, %ds per backend' % \
+          (idle, active, seconds)
+    for name, cls in backends:
+        rate, cpu = run_server(cls(), idle, active, seconds)
+        print '%-6s %10.0f messages/s %8.1f us cpu/message' % (name, rate, cpu)
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,114 @@
+# coding: utf-8
+'''
+Peer receive path benchmark.
+
+A thread pushes PIECE messages over a loopback TCP connection into a
+RawServer-driven Connection; the payloads are written to /dev/null the way
+StorageWrapper would write them to disk. Reported are bytes/s, CPU time per
+MB and, since python 2 has no tracemalloc, minor page faults per MB as a
+stand-in for fresh allocations on the receive path.
+
+usage: benchReceive.py [megabytes]
+'''
+import os
+import sys
+import socket
+import resource
+from threading import Thread, Event
+from time import time
+
+from BitTorrent.RawServer import RawServer
+from BitTorrent.Connecter import Connection, tobinary, PIECE, protocol_name
+
+BLOCK = 2 ** 14
+
+
+class NullDownload(object):
+
+    def __init__(self, total, doneflag):
+        self.out = open(os.devnull, 'wb')
+        self.received = 0
+        self.total = total
+        self.doneflag = doneflag
+
+    def got_piece(self, index, begin, piece):
+        self.out.write(piece)
+        self.received += len(piece)
+        if self.received >= self.total:
+            self.doneflag.set()
+
+
+class BenchEncoder(object):
+
+    def __init__(self, download):
+        self.download_id = 'i' * 20
+        self.my_id = 'm' * 20
+        self.connections = {}
+        self.complete_connections = {}
+        self.numpieces = 2 ** 20
+        self.config = {'max_message_length': 2 ** 23,
+                       'one_connection_per_ip': 0}
+        self.download = download
+
+    def connection_completed(self, c):
+        self.complete_connections[c] = 1
+        c.download = self.download
+
+    def replace_connection(self):
+        pass
+
+
+def send_all(sock, nblocks):
+    payload = 'x' * BLOCK
+    chunk = []
+    for i in xrange(64):
+        chunk.append(tobinary(BLOCK + 9) + PIECE + tobinary(i) +
+                     tobinary(0) + payload)
+    chunk = ''.join(chunk)
+    sock.sendall(chr(len(protocol_name)) + protocol_name + chr(0) * 8 +
+                 'i' * 20 + 'p' * 20)
+    for i in xrange(0, nblocks, 64):
+        sock.sendall(chunk)
+
+
+def run(megabytes = 512):
+    nblocks = megabytes * 2 ** 20 // BLOCK // 64 * 64
+    total = nblocks * BLOCK
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    sender = socket.create_connection(listener.getsockname())
+    receiver, addr = listener.accept()
+    listener.close()
+
+    doneflag = Event()
+    rawserver = RawServer(doneflag, 3600, 3600)
+    download = NullDownload(total, doneflag)
+    encoder = BenchEncoder(download)
+    conn = rawserver.wrap_socket(receiver, None)
+    c = Connection(encoder, conn, None, False)
+    conn.handler = c
+    encoder.connections[conn] = c
+
+    thread = Thread(target = send_all, args = (sender, nblocks))
+    thread.setDaemon(True)
+    r0 = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time()
+    thread.start()
+    rawserver.listen_forever()
+    t1 = time()
+    r1 = resource.getrusage(resource.RUSAGE_SELF)
+    thread.join()
+    sender.close()
+
+    mb = total / 2. ** 20
+    cpu = (r1.ru_utime + r1.ru_stime) - (r0.ru_utime + r0.ru_stime)
+    print '%d MB received in %.2fs' % (mb, t1 - t0)
+    print '%10.1f MB/s' % (mb / (t1 - t0))
+    print '%10.2f ms cpu/MB (both threads)' % (cpu / mb * 1000)
+    print '%10.2f minor faults/MB' % ((r1.ru_minflt - r0.ru_minflt) / mb)
+    print '%10d KB max rss' % r1.ru_maxrss
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,92 @@
+# coding: utf-8
+'''
+Seeding read path benchmark.
+
+Serves every block of a finished torrent on temporary files through
+StorageWrapper.get_piece, pieces in random order, and sends each block to
+/dev/null the way the connection would send it to a socket. Run with the
+file backend and the read cache, the file backend without cache and the
+mmap backend, and reports blocks served per second.
+
+usage: benchSeed.py [megabytes] [rounds]
+'''
+import os
+import sys
+import shutil
+import tempfile
+from random import Random
+from sha import sha
+from threading import Event
+from time import time
+
+from BitTorrent.defaultargs import get_defaults
+from BitTorrent.Storage import FilePool, STORAGE_BACKENDS
+from BitTorrent.StorageWrapper import StorageWrapper
+from BitTorrent.PieceCache import PieceCache
+
+PIECE_SIZE = 2 ** 18
+BLOCK_SIZE = 2 ** 14
+
+
+def run_once(config, files, sizes, hashes, cache_size, rounds):
+    filepool = FilePool(config['max_files_open'])
+    storage = STORAGE_BACKENDS[config['storage_backend']](
+        config, filepool, zip(files, sizes))
+    def statusfunc(activity = None, fractionDone = 0):
+        pass
+    sw = StorageWrapper(storage, config, hashes, PIECE_SIZE, lambda: None,
+                        statusfunc, Event(), lambda amount, index: None,
+                        'x' * 20, lambda level, text: None, None,
+                        PieceCache(cache_size * 2 ** 20), None, None, None)
+    assert sw.amount_left == 0
+    out = os.open(os.devnull, os.O_WRONLY)
+    order = range(len(hashes)) * rounds
+    Random(3).shuffle(order)
+    n = 0
+    t = time()
+    try:
+        for index in order:
+            length = sw._piecelen(index)
+            for begin in xrange(0, length, BLOCK_SIZE):
+                piece = sw.get_piece(index, begin,
+                                     min(BLOCK_SIZE, length - begin))
+                os.write(out, memoryview(piece))
+                n += 1
+    finally:
+        os.close(out)
+    t = time() - t
+    storage.close()
+    return n, t
+
+
+def run(megabytes = 64, rounds = 4):
+    config = dict([(name, value) for name, value, doc in
+                   get_defaults('btdownloadheadless')])
+    size = int(megabytes) * 2 ** 20
+    data = os.urandom(size)
+    hashes = [sha(data[i:i + PIECE_SIZE]).digest()
+              for i in xrange(0, size, PIECE_SIZE)]
+    d = tempfile.mkdtemp()
+    try:
+        files = [os.path.join(d, 'a'), os.path.join(d, 'b')]
+        sizes = [size // 3, size - size // 3]
+        f = file(files[0], 'wb')
+        f.write(data[:sizes[0]])
+        f.close()
+        f = file(files[1], 'wb')
+        f.write(data[sizes[0]:])
+        f.close()
+        for name, backend, cache in (('file, read cache', 'file', 32),
+                                     ('file, no cache', 'file', 0),
+                                     ('mmap', 'mmap', 32)):
+            config['storage_backend'] = backend
+            n, t = run_once(config, files, sizes, hashes, cache,
+                            int(rounds))
+            print '%s:' % name
+            print '%10.2f s' % t
+            print '%10d blocks per second' % (n / t)
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    run(*sys.argv[1:])
@@ -0,0 +1,112 @@
+# coding: utf-8
+'''
+Download path disk traffic benchmark.
+
+Feeds every block of a torrent to a StorageWrapper on temporary files in
+random piece order, the way Downloader would, and reports the bytes read
+from and written to Storage per byte of payload, how much of that was
+reading pieces back to hash them, and the time taken.
+Run with pieces assembled in memory and with every block written as it
+arrives, each with pieces written straight to their own place and with
+pieces filled in from the start of the files and moved later.
+
+usage: benchStorage.py [megabytes]
+'''
+import os
+import sys
+import shutil
+import tempfile
+from random import Random
+from sha import sha
+from threading import Event
+from time import time
+
+from BitTorrent.defaultargs import get_defaults
+from BitTorrent.Storage import Storage, FilePool
+from BitTorrent.StorageWrapper import StorageWrapper
+from BitTorrent.PieceCache import WriteBudget
+
+PIECE_SIZE = 2 ** 18
+
+
+class CountingStorage(Storage):
+
+    def __init__(self, *args):
+        Storage.__init__(self, *args)
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read(self, pos, amount):
+        self.bytes_read += amount
+        return Storage.read(self, pos, amount)
+
+    def write(self, pos, s):
+        self.bytes_written += len(s)
+        Storage.write(self, pos, s)
+
+
+def run_once(config, data, hashes, writebudget):
+    d = tempfile.mkdtemp()
+    try:
+        files = [os.path.join(d, 'a'), os.path.join(d, 'b')]
+        sizes = [len(data) // 3, len(data) - len(data) // 3]
+        filepool = FilePool(config['max_files_open'])
+        storage = CountingStorage(config, filepool, zip(files, sizes))
+        def statusfunc(activity = None, fractionDone = 0):
+            pass
+        sw = StorageWrapper(storage, config, hashes, PIECE_SIZE,
+                            lambda: None, statusfunc, Event(),
+                            lambda amount, index: None, 'x' * 20,
+                            lambda level, text: None, None, None, None,
+                            None, writebudget)
+        order = range(len(hashes))
+        Random(2).shuffle(order)
+        view = memoryview(data)
+        t = time()
+        # a few pieces in flight at once, blocks interleaved between them
+        while order:
+            active = order[:4]
+            del order[:4]
+            requests = []
+            for index in active:
+                while sw.do_I_have_requests(index):
+                    requests.append((index, sw.new_request(index)))
+            requests.sort(key = lambda r: (r[1], r[0]))
+            for index, (begin, length) in requests:
+                start = index * PIECE_SIZE + begin
+                sw.piece_came_in(index, begin,
+                                 view[start:start + length])
+        sw.close()
+        storage.close()
+        t = time() - t
+        assert sw.amount_left == 0
+        return t, storage.bytes_read, storage.bytes_written, \
+               sw.stat_hashed_reread
+    finally:
+        shutil.rmtree(d)
+
+
+def run(megabytes = 64):
+    config = dict([(name, value) for name, value, doc in
+                   get_defaults('btdownloadheadless')])
+    size = megabytes * 2 ** 20
+    data = os.urandom(size)
+    hashes = [sha(data[i:i + PIECE_SIZE]).digest()
+              for i in xrange(0, size, PIECE_SIZE)]
+    budgets = (('assembled in memory', 32 * 2 ** 20),
+               ('written per block', None))
+    for placement, direct in (('direct placement', 1), ('relocation', 0)):
+        config['direct_placement'] = direct
+        for name, budget in budgets:
+            if budget is not None:
+                budget = WriteBudget(budget)
+            t, r, w, h = run_once(config, data, hashes, budget)
+            print '%s, %s:' % (placement, name)
+            print '%10.2f s' % t
+            print '%10.2f bytes read per payload byte' % (r / float(size))
+            print '%10.2f bytes written per payload byte' % (w / float(size))
+            print '%10.2f bytes read back for hash checks per payload ' \
+                  'byte' % (h / float(size))
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:]])
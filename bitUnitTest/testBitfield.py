@@ -0,0 +1,72 @@
+# coding: utf-8
+'''
+Bitfield tests
+'''
+import unittest
+from random import Random
+
+from BitTorrent.bitfield import Bitfield
+
+
+def random_bits(rand, length):
+    return [rand.random() < 0.3 for i in xrange(length)]
+
+
+def make(bools):
+    b = Bitfield(len(bools))
+    for i, x in enumerate(bools):
+        b[i] = x
+    return b
+
+
+class Test(unittest.TestCase):
+
+    def testWireFormat(self):
+        b = Bitfield(10, '\xa0\x40')
+        self.assertEqual([i for i in xrange(10) if b[i]], [0, 2, 9])
+        self.assertEqual(b.numfalse, 7)
+        self.assertEqual(b.tostring(), '\xa0\x40')
+        b[9] = False
+        b[9] = False
+        b[1] = True
+        self.assertEqual(b.tostring(), '\xe0\x00')
+        self.assertEqual(b.numfalse, 7)
+        self.failIf(b.complete())
+        self.failUnless(Bitfield(9, '\xff\x80').complete())
+        self.assertEqual(Bitfield(0, '').tostring(), '')
+
+    def testIndexing(self):
+        b = Bitfield(10, '\xa0\x40')
+        self.assertEqual([b[i] for i in (0, 1, 9)], [True, False, True])
+        self.assertEqual([b[i] for i in (-1, -9, -10)], [True, False, True])
+        # the pad bits past the end aren't there
+        for i in (10, 15, 16, -11):
+            self.assertRaises(IndexError, b.__getitem__, i)
+            self.assertRaises(IndexError, b.__setitem__, i, True)
+        b[-2] = True
+        self.failUnless(b[8])
+        self.assertEqual(b.numfalse, 6)
+        self.assertRaises(IndexError, Bitfield(0).__getitem__, 0)
+
+    def testBadBitstring(self):
+        # wrong length, or the bits past the end set
+        for length, s in ((10, '\xff'), (10, '\xff\x00\x00'), (10, '\xff\x20'),
+                          (8, '')):
+            self.assertRaises(ValueError, Bitfield, length, s)
+
+    def testOperations(self):
+        rand = Random(1)
+        for length in (1, 7, 8, 9, 1000):
+            a = random_bits(rand, length)
+            b = random_bits(rand, length)
+            x = make(a)
+            y = make(b)
+            both = x & y
+            only = x.andnot(y)
+            self.assertEqual(both.array, [p and q for p, q in zip(a, b)])
+            self.assertEqual(only.array,
+                             [p and not q for p, q in zip(a, b)])
+            self.assertEqual(only.count(), sum(only.array))
+            self.assertEqual(len(only) - only.numfalse, only.count())
+            self.assertEqual(x.indices(), [i for i in xrange(length) if a[i]])
+            self.assertEqual(Bitfield(length, x.tostring()).array, a)
@@ -0,0 +1,156 @@
+# coding: utf-8
+'''
+Connection message framing tests
+'''
+import unittest
+
+from BitTorrent import Connecter
+from BitTorrent.Connecter import Connection, tobinary, protocol_name, PIECE, \
+     HAVE
+
+
+class FakeSocket(object):
+
+    def __init__(self):
+        self.ip = '127.0.0.1'
+        self.written = []
+        self.closed = False
+
+    def write(self, s):
+        if isinstance(s, memoryview):
+            s = s.tobytes()
+        self.written.append(str(s))
+
+    def writev(self, l):
+        for s in l:
+            self.write(s)
+
+    def close(self):
+        self.closed = True
+
+    def is_flushed(self):
+        return True
+
+
+class FakeDownload(object):
+
+    def __init__(self):
+        self.pieces = []
+        self.haves = []
+
+    def got_piece(self, index, begin, piece):
+        # views are only valid during the call
+        self.pieces.append((index, begin, piece.tobytes()))
+
+    def got_have(self, index):
+        self.haves.append(index)
+
+
+class FakeEncoder(object):
+
+    def __init__(self):
+        self.download_id = 'i' * 20
+        self.my_id = 'm' * 20
+        self.connections = {}
+        self.complete_connections = {}
+        self.numpieces = 10
+        self.config = {'max_message_length': 2 ** 23,
+                       'one_connection_per_ip': 0}
+
+    def connection_completed(self, c):
+        self.complete_connections[c] = 1
+        c.download = FakeDownload()
+
+    def replace_connection(self):
+        pass
+
+
+class FakeUpload(object):
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.choked = False
+        self.buffer = []
+
+    def get_upload_chunk(self):
+        if not self.chunks:
+            return None
+        return self.chunks.pop(0)
+
+
+def handshake():
+    return chr(len(protocol_name)) + protocol_name + chr(0) * 8 + \
+           'i' * 20 + 'p' * 20
+
+
+def message(s):
+    return tobinary(len(s)) + s
+
+
+class Test(unittest.TestCase):
+
+    def _feed(self, c, data, chunk):
+        while data:
+            buf = c.get_read_buffer()
+            n = min(len(buf), len(data), chunk)
+            buf[:n] = data[:n]
+            data = data[n:]
+            c.read_buffer_filled(c.connection, n)
+
+    def _run(self, chunk):
+        e = FakeEncoder()
+        sock = FakeSocket()
+        c = Connection(e, sock, None, False)
+        e.connections[sock] = c
+        big = 'x' * (Connecter.RECV_BUFFER_SIZE + 1000)
+        data = handshake() + message(HAVE + tobinary(3)) + \
+               message(PIECE + tobinary(1) + tobinary(0) + 'a' * 16384) + \
+               message(PIECE + tobinary(2) + tobinary(16384) + big) + \
+               message(HAVE + tobinary(4))
+        self._feed(c, data, chunk)
+        self.assertFalse(c.closed)
+        self.assertEqual(c.id, 'p' * 20)
+        d = c.download
+        self.assertEqual(d.haves, [3, 4])
+        self.assertEqual(d.pieces, [(1, 0, 'a' * 16384), (2, 16384, big)])
+        # the oversized buffer is dropped again once it's been consumed
+        self.assertEqual(len(c._rbuf), Connecter.RECV_BUFFER_SIZE)
+
+    def testWholeReads(self):
+        self._run(10 ** 9)
+
+    def testSmallReads(self):
+        self._run(7)
+
+    def testBadHandshake(self):
+        e = FakeEncoder()
+        sock = FakeSocket()
+        c = Connection(e, sock, None, False)
+        e.connections[sock] = c
+        self._feed(c, chr(5) + 'junk', 100)
+        self.assertTrue(c.closed)
+
+    # a PIECE message sent in rate limiter sized slices comes out intact
+    def testSendPartial(self):
+        e = FakeEncoder()
+        sock = FakeSocket()
+        c = Connection(e, sock, None, False)
+        c.choke_sent = False
+        piece = 'abcdefgh' * 100
+        c.upload = FakeUpload([(1, 32, piece)])
+        sent = 0
+        while True:
+            n = c.send_partial(77)
+            if n < 77:
+                break
+            sent += n
+        sent += n
+        data = ''.join(sock.written)
+        self.assertEqual(sent, len(data))
+        self.assertEqual(data, message(PIECE + tobinary(1) + tobinary(32) +
+                                       piece))
+        self.assertEqual(c._partial_message, None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+# coding: utf-8
+'''
+Disk I/O thread pool tests
+'''
+import unittest
+from Queue import Queue, Empty
+from threading import Event
+from time import sleep
+
+from BitTorrent.DiskIO import DiskIO
+
+
+class TaskQueue(object):
+    # stands in for RawServer.external_add_task
+
+    def __init__(self):
+        self.tasks = Queue()
+        self.exceptions = []
+
+    def add_task(self, func, delay, context = None):
+        self.tasks.put((func, context))
+
+    def got_exception(self, e):
+        self.exceptions.append(e)
+
+    def run(self, diskio, keys):
+        # runs callbacks until the disk threads are done with keys
+        while True:
+            for key in keys:
+                diskio.wait(key)
+            try:
+                func, context = self.tasks.get_nowait()
+            except Empty:
+                if not [k for k in keys if k in diskio.queues]:
+                    return
+                continue
+            try:
+                func()
+            except Exception, e:
+                context.got_exception(e)
+
+
+class Test(unittest.TestCase):
+
+    def testInline(self):
+        diskio = DiskIO(0, 100, None)
+        r = []
+        diskio.submit('a', r.append, (1,), r.append)
+        self.assertEqual(r, [1, None])
+
+    # jobs with the same key run in order, results come back in order
+    def testOrder(self):
+        tq = TaskQueue()
+        diskio = DiskIO(4, 2 ** 20, tq.add_task)
+        done = []
+        running = {}
+        def job(key, i):
+            assert key not in running
+            running[key] = 1
+            sleep(.001)
+            del running[key]
+            return i
+        for i in xrange(20):
+            for key in 'abc':
+                diskio.submit(key, job, (key, i),
+                              lambda i, key = key: done.append((key, i)))
+        tq.run(diskio, 'abc')
+        for key in 'abc':
+            self.assertEqual([i for k, i in done if k == key], range(20))
+        self.assertEqual(diskio.get_stats()['jobs'], 60)
+        diskio.close()
+
+    def testBacklog(self):
+        tq = TaskQueue()
+        diskio = DiskIO(1, 1000, tq.add_task)
+        go = Event()
+        diskio.submit('a', go.wait, (), size = 600)
+        diskio.submit('a', lambda: None, (), size = 600)
+        self.assertTrue(diskio.is_backlogged())
+        drained = []
+        diskio.notify_when_drained(lambda: drained.append(1))
+        self.assertEqual(drained, [])
+        go.set()
+        tq.run(diskio, 'a')
+        self.assertFalse(diskio.is_backlogged())
+        self.assertEqual(drained, [1])
+        self.assertEqual(diskio.queued_bytes, 0)
+        diskio.close()
+
+    def testException(self):
+        tq = TaskQueue()
+        diskio = DiskIO(1, 1000, tq.add_task)
+        def fail():
+            raise IOError('disk full')
+        r = []
+        diskio.submit('a', fail, (), r.append, tq)
+        diskio.submit('a', lambda: 2, (), r.append, tq)
+        tq.run(diskio, 'a')
+        self.assertEqual(r, [2])
+        self.assertEqual(len(tq.exceptions), 1)
+        self.assertTrue(isinstance(tq.exceptions[0], IOError))
+        diskio.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
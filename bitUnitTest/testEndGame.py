@@ -0,0 +1,110 @@
+# coding: utf-8
+'''
+EndGame tests
+'''
+import unittest
+from random import Random
+
+from BitTorrent.bitfield import Bitfield
+from BitTorrent.EndGame import EndGame
+
+NUMPIECES = 4
+
+
+class FakeDownload(object):
+
+    def __init__(self, pieces):
+        self.have = Bitfield(NUMPIECES)
+        for i in pieces:
+            self.have[i] = True
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.endgame = EndGame(2)
+        self.a = FakeDownload([0, 1])
+        self.b = FakeDownload([1, 2])
+        self.c = FakeDownload([1])
+        for request in ((0, 0, 10), (1, 0, 10), (1, 10, 5)):
+            self.endgame.add(request, self.a)
+        self.endgame.add((2, 0, 10))
+
+    def testWanted(self):
+        endgame = self.endgame
+        a, b, c = self.a, self.b, self.c
+        self.failIf(endgame.interesting(a))
+        self.assertEqual(endgame.wanted(a, 10), [])
+        # the block nobody was asked for first
+        self.assertEqual(endgame.wanted(b, 1), [(2, 0, 10)])
+        self.assertEqual(sorted(endgame.wanted(b, 10)),
+                         [(1, 0, 10), (1, 10, 5)])
+        # two peers asked for each block of piece 1 already
+        self.failUnless(endgame.interesting(c))
+        self.assertEqual(endgame.wanted(c, 10), [])
+        endgame.lost(a, [(1, 10, 5)])
+        self.assertEqual(endgame.wanted(c, 10), [(1, 10, 5)])
+
+    def testReceived(self):
+        endgame = self.endgame
+        a, b = self.a, self.b
+        endgame.wanted(b, 10)
+        self.assertEqual(sorted(endgame.received((1, 0, 10)).keys()),
+                         sorted([a, b]))
+        self.assertEqual(endgame.received((1, 0, 10)), {})
+        endgame.received((1, 10, 5))
+        self.failIf(1 in endgame.pieces)
+        self.assertEqual(sorted(endgame.blocks.keys()), [(0, 0), (2, 0)])
+
+    def testBuckets(self):
+        # blocks stay bucketed by how many peers they were asked from
+        rand = Random(7)
+        endgame = EndGame(3)
+        downloads = [FakeDownload(rand.sample(range(NUMPIECES), 3))
+                     for i in xrange(6)]
+        requests = [(i, j * 10, 10) for i in xrange(NUMPIECES)
+                    for j in xrange(5)]
+        for request in requests:
+            endgame.add(request)
+        for i in xrange(200):
+            d = rand.choice(downloads)
+            r = rand.random()
+            if r < 0.5:
+                fewest = min([len(endgame.blocks[(index, begin)][1])
+                              for index, begin, length in requests
+                              if (index, begin) in endgame.blocks and
+                              d.have[index] and
+                              d not in endgame.blocks[(index, begin)][1]] +
+                             [3])
+                want = endgame.wanted(d, 2)
+                if want:
+                    self.assertEqual(
+                        len(endgame.blocks[want[0][:2]][1]) - 1, fewest)
+                else:
+                    self.assertEqual(fewest, 3)
+            elif r < 0.8:
+                endgame.lost(d, [rand.choice(requests)])
+            elif r < 0.9:
+                endgame.received(rand.choice(requests))
+            else:
+                endgame.add(rand.choice(requests), d)
+            for n, under in enumerate(endgame.under):
+                for index, begins in under.iteritems():
+                    for begin in begins:
+                        self.assertEqual(
+                            len(endgame.blocks[(index, begin)][1]), n)
+            self.assertEqual(
+                sum([len(begins) for under in endgame.under
+                     for begins in under.itervalues()]),
+                len([b for b in endgame.blocks.itervalues() if len(b[1]) < 3]))
+            for d in downloads:
+                asked = {}
+                for (index, begin), (length, requesters) in \
+                        endgame.blocks.iteritems():
+                    if d in requesters:
+                        asked[index] = asked.get(index, 0) + 1
+                self.assertEqual(endgame.asked.get(d, {}), asked)
+                self.assertEqual(endgame.interesting(d), bool(
+                    [1 for (index, begin), (length, requesters) in
+                     endgame.blocks.iteritems()
+                     if d.have[index] and d not in requesters]))
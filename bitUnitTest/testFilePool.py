@@ -0,0 +1,108 @@
+# coding: utf-8
+'''
+File handle pool tests on temporary files
+'''
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+from BitTorrent.Storage import FilePool
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _files(self, prefix, n):
+        files = [os.path.join(self.dir, '%s%d' % (prefix, i))
+                 for i in xrange(n)]
+        for f in files:
+            file(f, 'wb').close()
+        return files
+
+    def _open(self, pool, files, for_write = False):
+        pool.lock.acquire()
+        try:
+            for f in files:
+                pool.get_handle(f, for_write)
+        finally:
+            pool.lock.release()
+
+    def testLeastRecentlyUsed(self):
+        pool = FilePool(3)
+        files = self._files('a', 4)
+        pool.add_files(files, 'a')
+        self._open(pool, files[:3])
+        self._open(pool, files[:1])
+        self._open(pool, files[3:], True)
+        self.assertEqual(list(pool.handles), [files[2], files[0], files[3]])
+        # read and write through the same handle, opened once
+        self._open(pool, files[2:3], True)
+        self.assertEqual((pool.stat_opens, pool.stat_evictions), (4, 1))
+        pool.close_files(files)
+        self.assertEqual(len(pool.handles), 0)
+        self.assertEqual(pool.stat_closes, 4)
+
+    def testShares(self):
+        pool = FilePool(4)
+        a = self._files('a', 6)
+        b = self._files('b', 2)
+        pool.add_files(a, 'a')
+        pool.add_files(b, 'b')
+        self._open(pool, a[:4])
+        # b takes its share from a, then only evicts its own
+        self._open(pool, b)
+        self.assertEqual(len(pool.owned['a']), 2)
+        self._open(pool, a[4:])
+        self.assertEqual(len(pool.owned['b']), 2)
+        self.assertEqual(list(pool.owned['a']), a[4:])
+        self._open(pool, b[:1])
+        pool.remove_files(b)
+        self.assertEqual(pool.torrents, {'a': 6})
+
+    # a torrent's files are taken out of the pool before it closes them
+    def testCloseAfterRemove(self):
+        pool = FilePool(2)
+        a = self._files('a', 2)
+        b = self._files('b', 1)
+        pool.add_files(a, 'a')
+        pool.add_files(b, 'b')
+        self._open(pool, a)
+        handles = [pool.handles[f] for f in a]
+        pool.remove_files(a)
+        # still counted as a's when b needs a handle
+        self._open(pool, b)
+        self.assertEqual(pool.owned, {'a': dict.fromkeys(a[1:]),
+                                      'b': dict.fromkeys(b)})
+        pool.close_files(a)
+        self.failUnless(handles[0].closed and handles[1].closed)
+        self.assertEqual(list(pool.handles), b)
+        self.assertEqual(pool.owned.keys(), ['b'])
+        self.assertEqual(pool.owners, {b[0]: 'b'})
+
+    # a handle in use outside the lock is closed when it's released
+    def testPinned(self):
+        pool = FilePool(1)
+        files = self._files('a', 2)
+        h = pool.acquire(files[0], True)
+        self._open(pool, files[1:])
+        self.assertEqual(list(pool.handles), files[1:])
+        self.failIf(h.closed)
+        pool.release(h)
+        self.failUnless(h.closed)
+        self.assertEqual((pool.pinned, pool.unclosed), ({}, {}))
+
+    def testReadOnly(self):
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            return   # root can write anyway
+        pool = FilePool(2)
+        files = self._files('a', 1)
+        os.chmod(files[0], stat.S_IRUSR)
+        self._open(pool, files)
+        self.assertRaises(IOError, self._open, pool, files, True)
@@ -0,0 +1,185 @@
+# coding: utf-8
+'''
+PiecePicker tests, availability from whole bitfields and single HAVEs
+'''
+import unittest
+from random import Random
+
+from BitTorrent.bitfield import Bitfield
+from BitTorrent.PiecePicker import PiecePicker
+
+NUMPIECES = 200
+
+
+def trimmed(crosscount):
+    while crosscount and not crosscount[-1]:
+        crosscount = crosscount[:-1]
+    return crosscount
+
+
+def random_bitfield(rand, chance):
+    b = Bitfield(NUMPIECES)
+    for i in xrange(NUMPIECES):
+        b[i] = rand.random() < chance
+    return b
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.picker = PiecePicker(NUMPIECES, {'rarest_first_cutoff': 0})
+        self.reference = PiecePicker(NUMPIECES, {'rarest_first_cutoff': 0})
+
+    def _add(self, b):
+        if b.complete():
+            self.picker.got_seed()
+        else:
+            self.picker.got_have_bitfield(b)
+        for i in b.indices():
+            self.reference.got_have(i)
+
+    def _remove(self, b):
+        if b.complete():
+            self.picker.lost_seed()
+        else:
+            self.picker.lost_have_bitfield(b)
+        for i in b.indices():
+            self.reference.lost_have(i)
+
+    def _check(self):
+        picker = self.picker
+        seeds = picker.seeds
+        self.assertEqual(trimmed(picker.crosscount),
+                         trimmed(self.reference.crosscount))
+        for piece in xrange(NUMPIECES):
+            numint = picker.get_numinterests(piece)
+            self.assertEqual(numint + seeds,
+                             self.reference.get_numinterests(piece))
+            bit = 1 << (picker.nbits - 1 - piece)
+            for i, level in enumerate(picker.levels):
+                self.assertEqual(bool(level & bit), i >= numint)
+        self.assertEqual(picker.levels[-1], picker.all)
+        self.failUnless(len(picker.levels) == 1 or
+                        picker.levels[-2] != picker.all)
+        # rarest piece that anyone has
+        counts = [(picker.get_numinterests(i), i) for i in xrange(NUMPIECES)
+                  if not picker.have[i] and
+                  picker.get_numinterests(i) + seeds]
+        everything = random_bitfield(Random(0), 1)
+        piece = picker.next(lambda i: True, everything)
+        if counts:
+            self.assertEqual(picker.get_numinterests(piece), min(counts)[0])
+        else:
+            self.assertEqual(piece, None)
+
+    def testBitfields(self):
+        rand = Random(3)
+        peers = []
+        for i in xrange(30):
+            if peers and rand.random() < 0.3:
+                self._remove(peers.pop(rand.randrange(len(peers))))
+            else:
+                b = random_bitfield(rand, rand.choice((0.1, 0.5, 1)))
+                peers.append(b)
+                self._add(b)
+            if rand.random() < 0.3:
+                # single HAVE between bitfields
+                piece = rand.randrange(NUMPIECES)
+                self.picker.got_have(piece)
+                self.reference.got_have(piece)
+                peers.append(Bitfield(NUMPIECES))
+                peers[-1][piece] = True
+            if rand.random() < 0.2:
+                piece = rand.randrange(NUMPIECES)
+                if not self.picker.have[piece]:
+                    self.picker.complete(piece)
+                    self.reference.complete(piece)
+            self._check()
+        for b in peers:
+            self._remove(b)
+        self._check()
+        self.assertEqual(self.picker.crosscount[0],
+                         NUMPIECES - self.picker.numgot)
+
+    def testNext(self):
+        # the rarest piece the peer has and we can ask for, bumped ones last
+        rand = Random(4)
+        picker = self.picker
+        for i in xrange(3):
+            self._add(random_bitfield(rand, 0.5))
+        peer = random_bitfield(rand, 0.3)
+        self._add(peer)
+        wanted = dict([(i, None) for i in peer.indices()
+                       if rand.random() < 0.5])
+        rarity = min([picker.get_numinterests(i) for i in wanted])
+        rarest = [i for i in wanted if picker.get_numinterests(i) == rarity]
+        for i in xrange(20):
+            piece = picker.next(wanted.has_key, peer)
+            self.failUnless(piece in rarest)
+        self.failUnless(len(rarest) > 1)
+        picker.bump(rarest[0])
+        for i in xrange(20):
+            self.failUnless(picker.next(wanted.has_key, peer) in rarest[1:])
+        for i in rarest[1:]:
+            del wanted[i]
+        self.assertEqual(picker.next(wanted.has_key, peer), rarest[0])
+        self.assertEqual(picker.next(lambda i: False, peer), None)
+        for i in peer.indices():
+            if not picker.have[i]:
+                picker.complete(i)
+        self.assertEqual(picker.next(lambda i: True, peer), None)
+
+    def testRarestSample(self):
+        # single HAVEs coming and going keep the sample next() asks first
+        # in step with the levels
+        rand = Random(6)
+        picker = self.picker
+        for i in xrange(4):
+            self._add(random_bitfield(rand, 0.5))
+        for i in xrange(300):
+            piece = rand.randrange(NUMPIECES)
+            r = rand.random()
+            if r < 0.5:
+                picker.got_have(piece)
+            elif r < 0.9:
+                if picker.get_numinterests(piece):
+                    picker.lost_have(piece)
+            elif not picker.have[piece]:
+                picker.complete(piece)
+            peer = random_bitfield(rand, rand.choice((0.02, 0.2, 0.8)))
+            wanted = [picker.get_numinterests(j) for j in peer.indices()
+                      if not picker.have[j] and picker.get_numinterests(j)]
+            piece = picker.next(peer.__getitem__, peer)
+            if wanted:
+                self.assertEqual(picker.get_numinterests(piece), min(wanted))
+            else:
+                self.assertEqual(piece, None)
+
+    def testPriorities(self):
+        picker = self.picker
+        peer = random_bitfield(Random(5), 0.5)
+        self._add(peer)
+        priorities = [i % 3 - 1 for i in xrange(NUMPIECES)]
+        picker.set_priorities(priorities)
+        for priority in (1, 0):
+            for i in xrange(20):
+                piece = picker.next(lambda i: True, peer)
+                self.assertEqual(priorities[piece], priority)
+            for i in peer.indices():
+                if priorities[i] == priority:
+                    picker.complete(i)
+        # only skipped pieces left
+        self.assertEqual(picker.next(lambda i: True, peer), None)
+        picker.set_priorities([0] * NUMPIECES)
+        self.assertEqual(priorities[picker.next(lambda i: True, peer)], -1)
+
+    def testAllSkipped(self):
+        picker = self.picker
+        peer = random_bitfield(Random(6), 0.5)
+        self._add(peer)
+        picker.set_priorities([-1] * NUMPIECES)
+        self.assertEqual(picker.next(lambda i: True, peer), None)
+        picker.got_have(peer.indices()[0])
+        self.assertEqual(picker.next(lambda i: True, peer), None)
+        picker.set_priorities([0] * NUMPIECES)
+        self.failIf(picker.next(lambda i: True, peer) is None)
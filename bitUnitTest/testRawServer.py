@@ -0,0 +1,107 @@
+# coding: utf-8
+'''
+RawServer event loop tests
+'''
+import socket
+import unittest
+from threading import Event
+
+from BitTorrent.RawServer import RawServer
+from BitTorrent import pollers
+
+
+class Collector(object):
+
+    def __init__(self):
+        self.data = []
+        self.lost = False
+
+    def data_came_in(self, conn, s):
+        self.data.append(s)
+
+    def connection_lost(self, conn):
+        self.lost = True
+
+    def connection_flushed(self, conn):
+        pass
+
+
+class Test(unittest.TestCase):
+
+    def _poller_classes(self):
+        r = [pollers.PollPoller]
+        if pollers.epoll is not None:
+            r.append(pollers.EpollPoller)
+        return r
+
+    def _run(self, rawserver, doneflag, seconds = 0.2):
+        rawserver.add_task(doneflag.set, seconds)
+        rawserver.listen_forever()
+
+    # a large write gets through in full, whatever the poller
+    def testLargeTransfer(self):
+        for cls in self._poller_classes():
+            doneflag = Event()
+            rawserver = RawServer(doneflag, 60, 60, poller = cls())
+            a, b = socket.socketpair()
+            sender = rawserver.wrap_socket(a, Collector())
+            receiver = Collector()
+            rawserver.wrap_socket(b, receiver)
+            payload = 'abcdefgh' * 200000
+            sender.write(payload)
+            self._run(rawserver, doneflag, 0.5)
+            self.assertEqual(''.join(receiver.data), payload, cls.__name__)
+            self.assertTrue(sender.is_flushed())
+
+    def testRegistrationOnlyOnChange(self):
+        poller = pollers.PollPoller()
+        calls = []
+        class CountingPoll(object):
+            def register(self, f, mask):
+                calls.append((f, mask))
+            def unregister(self, f):
+                pass
+        poller._poll = CountingPoll()
+        poller.register(5, pollers.POLLIN)
+        poller.register(5, pollers.POLLIN)
+        poller.register(5, pollers.POLLIN | pollers.POLLOUT)
+        self.assertEqual(len(calls), 2)
+
+    def testPeerClose(self):
+        for cls in self._poller_classes():
+            doneflag = Event()
+            rawserver = RawServer(doneflag, 60, 60, poller = cls())
+            a, b = socket.socketpair()
+            c = Collector()
+            rawserver.wrap_socket(b, c)
+            a.close()
+            self._run(rawserver, doneflag)
+            self.assertTrue(c.lost, cls.__name__)
+            self.assertEqual(rawserver.single_sockets, {})
+
+    # only sockets that have been quiet for longer than timeout get closed
+    def testIdleTimeout(self):
+        doneflag = Event()
+        rawserver = RawServer(doneflag, 60, 60)
+        quiet = Collector()
+        busy = Collector()
+        a, b = socket.socketpair()
+        c, d = socket.socketpair()
+        sq = rawserver.wrap_socket(b, quiet)
+        sb = rawserver.wrap_socket(d, busy)
+        sq.last_hit -= 1000
+        sb.last_hit -= 1000
+        c.send('x')
+        self._run(rawserver, doneflag)
+        self.assertEqual(list(rawserver.idle_sockets), [sq, sb])
+        rawserver.scan_for_timeouts()
+        self.assertTrue(quiet.lost)
+        self.assertFalse(busy.lost)
+        stats = rawserver.get_idle_stats(True)
+        self.assertEqual(stats['numsockets'], 1)
+        self.assertEqual(sum(stats['histogram']), 1)
+        self.assertEqual(stats['histogram'][-1], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+# coding: utf-8
+'''
+Scheduler tests
+'''
+import unittest
+
+from BitTorrent.Scheduler import Scheduler, COMPACT_THRESHOLD
+
+
+class Test(unittest.TestCase):
+
+    def _run_all(self, s):
+        r = []
+        while True:
+            task = s.pop_due(1e20)
+            if task is None:
+                return r
+            r.append(task.func)
+
+    def testOrder(self):
+        s = Scheduler()
+        s.add('c', 3)
+        s.add('a', 1)
+        s.add('b', 2)
+        s.add('a2', 1)
+        self.assertEqual(self._run_all(s), ['a', 'a2', 'b', 'c'])
+        self.assertEqual(s.get_stats()['run'], 4)
+
+    def testCancel(self):
+        s = Scheduler()
+        s.add('a', 1)
+        t = s.add('b', 2)
+        s.add('c', 3)
+        t.cancel()
+        t.cancel()
+        self.assertEqual(len(s), 2)
+        self.assertEqual(self._run_all(s), ['a', 'c'])
+        self.assertEqual(len(s), 0)
+
+    def testContext(self):
+        s = Scheduler()
+        ctx = object()
+        self.assertEqual(s.add('x', 0, ctx), None)
+        s.add_context(ctx)
+        s.add('x', 0, ctx)
+        s.add('y', 1)
+        s.remove_context(ctx)
+        # an old task must not come back if the context is added again
+        s.add_context(ctx)
+        s.add('z', 2, ctx)
+        self.assertEqual(self._run_all(s), ['y', 'z'])
+
+    def testCompact(self):
+        s = Scheduler()
+        tasks = [s.add(i, i) for i in xrange(COMPACT_THRESHOLD * 2)]
+        for t in tasks[1:]:
+            t.cancel()
+        self.assertTrue(len(s.heap) < COMPACT_THRESHOLD * 2)
+        self.assertEqual(self._run_all(s), [0])
+
+
+if __name__ == "__main__":
+    unittest.main()
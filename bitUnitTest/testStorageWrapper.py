@@ -0,0 +1,637 @@
+# coding: utf-8
+'''
+Storage / StorageWrapper tests on temporary files
+'''
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+from random import Random
+from sha import sha
+from threading import Event, Thread
+
+from BitTorrent.defaultargs import get_defaults
+from BitTorrent.Storage import Storage, FilePool, STORAGE_BACKENDS
+from BitTorrent.StorageWrapper import StorageWrapper, FASTRESUME_PARTIAL, \
+     REQUESTED, RECEIVED, WRITTEN
+from BitTorrent.PieceCache import PieceCache, WriteBudget
+from BitTorrent.DiskIO import DiskIO
+from BitTorrent.HashChecker import HashChecker, make_jobs
+from BitTorrent.PiecePicker import piece_priorities
+from BitTorrent import BTFailure
+from BitTorrent import Storage as StorageModule
+from bitUnitTest.testDiskIO import TaskQueue
+
+PIECE_SIZE = 2 ** 16
+
+
+def make_config(**kws):
+    config = dict([(name, value) for name, value, doc in
+                   get_defaults('btdownloadheadless')])
+    config.update(kws)
+    return config
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rand = Random(1)
+        self.data = ''.join([chr(rand.randrange(256))
+                             for i in xrange(PIECE_SIZE * 5 + 1000)])
+        self.hashes = [sha(self.data[i:i + PIECE_SIZE]).digest()
+                       for i in xrange(0, len(self.data), PIECE_SIZE)]
+        self.sizes = [PIECE_SIZE * 2 + 500, 100, len(self.data) -
+                      PIECE_SIZE * 2 - 600]
+        self.files = [os.path.join(self.dir, 'f%d' % i) for i in range(3)]
+        self.finished = []
+        self.flunked = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _wrapper(self, config = None, readcache = None, diskio = None,
+                 writebudget = None, hashchecker = None, resume = None,
+                 skipped = ()):
+        if config is None:
+            config = make_config()
+        self.filepool = FilePool(config['max_files_open'])
+        self.filepool.add_files(self.files, self)
+        backend = STORAGE_BACKENDS[config['storage_backend']]
+        self.storage = backend(config, self.filepool,
+                               zip(self.files, self.sizes), skipped = skipped)
+        def statusfunc(activity = None, fractionDone = 0):
+            pass
+        def data_flunked(amount, index):
+            self.flunked.append(index)
+        def errorfunc(level, text):
+            pass
+        return StorageWrapper(self.storage, config, self.hashes, PIECE_SIZE,
+                              lambda: self.finished.append(1), statusfunc,
+                              Event(), data_flunked, 'x' * 20, errorfunc,
+                              resume, readcache, diskio, None, writebudget,
+                              hashchecker)
+
+    def _download(self, sw, order = None, corrupt = None):
+        if order is None:
+            order = range(sw.numpieces)
+        for index in order:
+            # a failed piece becomes requestable again, so take the whole
+            # batch before feeding any of it back
+            requests = []
+            while sw.do_I_have_requests(index):
+                requests.append(sw.new_request(index))
+            for begin, length in requests:
+                start = index * PIECE_SIZE + begin
+                piece = self.data[start:start + length]
+                if index == corrupt:
+                    piece = 'x' * length
+                sw.piece_came_in(index, begin, memoryview(piece))
+
+    def _file_contents(self):
+        return ''.join([open(f, 'rb').read() for f in self.files])
+
+    def testDownload(self):
+        sw = self._wrapper()
+        self._download(sw, [3, 0, 5, 1, 4, 2])
+        self.assertEqual(sw.amount_left, 0)
+        self.assertEqual(self.finished, [1])
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    # nothing but the payload is written, each piece once
+    def testDirectPlacement(self):
+        written = []
+        write = Storage.write
+        def counting_write(storage, pos, s):
+            written.append(len(s))
+            write(storage, pos, s)
+        Storage.write = counting_write
+        try:
+            sw = self._wrapper()
+            self._download(sw, [3, 0, 5, 1, 4, 2])
+        finally:
+            Storage.write = write
+        self.assertEqual(list(sw.places), range(sw.numpieces))
+        self.assertEqual(sum(written), len(self.data))
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    def testRelocation(self):
+        sw = self._wrapper(make_config(direct_placement = 0))
+        self._download(sw, [3, 0, 5, 1, 4, 2])
+        self.assertEqual(sw.amount_left, 0)
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    # served from mappings that outlive their place in the file pool
+    def testMmapStorage(self):
+        config = make_config(storage_backend = 'mmap', max_files_open = 1)
+        sw = self._wrapper(config, readcache = PieceCache(2 ** 20))
+        self._download(sw)
+        views = []
+        for index in xrange(sw.numpieces):
+            for begin in xrange(0, sw._piecelen(index), 2 ** 14):
+                length = min(2 ** 14, sw._piecelen(index) - begin)
+                views.append((index * PIECE_SIZE + begin,
+                              sw.get_piece(index, begin, length)))
+        self.assertEqual(sw.readcache.size, 0)
+        self.assertEqual(type(views[0][1]), buffer)
+        self.assertEqual(len(self.filepool.maps), 1)
+        for pos, view in views:
+            self.assertEqual(str(view), self.data[pos:pos + len(view)])
+        self.storage.close()
+        self.assertEqual(self.filepool.maps, {})
+        self.assertEqual(str(views[0][1]), self.data[:len(views[0][1])])
+
+    # threads share the handles of a pool with room for one
+    def testConcurrentIO(self):
+        self.filepool = FilePool(1)
+        self.filepool.add_files(self.files, self)
+        storage = Storage(make_config(), self.filepool,
+                          zip(self.files, self.sizes))
+        blocks = range(0, len(self.data), 1000)
+        failed = []
+        def run(func, blocks):
+            try:
+                for pos in blocks:
+                    func(pos)
+            except Exception, e:
+                failed.append(e)
+        def write(pos):
+            storage.write(pos, buffer(self.data, pos, 1000))
+        def read(pos):
+            if storage.read(pos, len(self.data[pos:pos + 1000])) != \
+                   self.data[pos:pos + 1000]:
+                failed.append(pos)
+        for func in (write, read):
+            threads = [Thread(target = run, args = (func, blocks[i::4]))
+                       for i in xrange(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(failed, [])
+        storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    # pread() and seek and readinto() read across files alike
+    def testReads(self):
+        self.filepool = FilePool(2)
+        self.filepool.add_files(self.files, self)
+        storage = Storage(make_config(), self.filepool,
+                          zip(self.files, self.sizes))
+        storage.write(0, self.data)
+        positional = StorageModule.POSITIONAL_IO
+        try:
+            for flag in set([False, positional]):
+                StorageModule.POSITIONAL_IO = flag
+                for pos, amount in ((0, len(self.data)), (PIECE_SIZE * 2, 700),
+                                    (PIECE_SIZE * 2 + 550, 0)):
+                    s = storage.read(pos, amount)
+                    self.assertEqual(type(s), str)
+                    self.assertEqual(s, self.data[pos:pos + amount])
+                    view = storage.read_view(pos, amount)
+                    self.assertEqual(type(view), buffer)
+                    self.assertEqual(str(view), self.data[pos:pos + amount])
+        finally:
+            StorageModule.POSITIONAL_IO = positional
+        storage.close()
+        file(self.files[2], 'r+b').truncate(10)
+        for flag in set([False, positional]):
+            StorageModule.POSITIONAL_IO = flag
+            try:
+                self.assertRaises(BTFailure, storage.read, 0, len(self.data))
+            finally:
+                StorageModule.POSITIONAL_IO = positional
+        storage.close()
+
+    # the piece index gives what searching all the files does
+    def testIntervalIndex(self):
+        rand = Random(2)
+        files = [('f%d' % i, rand.choice((0, 1, 7, 300, 5000)))
+                 for i in xrange(300)]
+        storage = Storage(None, None, files, True)
+        total = storage.get_total_length()
+        tests = [(pos, rand.randrange(1, 3000))
+                 for pos in [rand.randrange(total) for i in xrange(2000)]]
+        # inside one piece, whole pieces
+        tests += [(pos, rand.randrange(1, 1024 - pos % 1024 + 1))
+                  for pos, amount in tests]
+        tests += [(pos, 1024) for pos in xrange(0, total, 1024)]
+        expected = [storage._intervals(pos, amount)
+                    for pos, amount in tests]
+        storage.index_pieces(1024)
+        self.assertEqual([storage._intervals(pos, amount)
+                          for pos, amount in tests], expected)
+
+    def testPreallocate(self):
+        sw = self._wrapper(make_config(allocation = 'background'))
+        steps = 1
+        while self.storage.preallocate(PIECE_SIZE):
+            steps += 1
+        self.assertEqual(steps, 6)
+        self.assertEqual([os.path.getsize(f) for f in self.files],
+                         self.sizes)
+        self._download(sw, [3, 0, 5, 1, 4, 2])
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    # full size files only have data where the resume data says so
+    def testPreallocatedResume(self):
+        config = make_config(allocation = 'full')
+        sw = self._wrapper(config)
+        self.storage.preallocate()
+        self._download(sw, [4, 1])
+        sw.close()
+        self.storage.close()
+        f = StringIO()
+        self.storage.write_fastresume(f, PIECE_SIZE * 2, sw.get_fastresume())
+        f.seek(0)
+        sw = self._wrapper(config, resume = self.storage.read_fastresume(f))
+        self.assertEqual([i for i in xrange(6) if sw.do_I_have(i)], [1, 4])
+        self._download(sw, [0, 2, 3, 5])
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    # skipped files aren't made or allocated until a piece reaches into them
+    def testSkippedFiles(self):
+        config = make_config(allocation = 'background', direct_placement = 0)
+        sw = self._wrapper(config, skipped = self.files[2:])
+        pieces = piece_priorities([1, 0, -1], self.sizes, PIECE_SIZE)
+        self.assertEqual(pieces, [1, 1, 1, -1, -1, -1])
+        sw.set_skipped([i for i, p in enumerate(pieces) if p < 0])
+        self.failIf(sw.do_I_have_requests(3))
+        while self.storage.preallocate(PIECE_SIZE):
+            pass
+        self.failIf(os.path.exists(self.files[2]))
+        self._download(sw, [1, 0])
+        self.failIf(os.path.exists(self.files[2]))
+        self._download(sw, [2])
+        self.assertEqual(os.path.getsize(self.files[2]),
+                         PIECE_SIZE * 3 - sum(self.sizes[:2]))
+        self.assertEqual(list(sw.places[:3]), [0, 1, 2])
+        self.assertEqual(self.finished, [1])
+        self.storage.set_skipped([])
+        sw.set_skipped([])
+        self.assertEqual(sw.amount_left, len(self.data) - PIECE_SIZE * 3)
+        self._download(sw, [5, 3, 4])
+        self.assertEqual(self.finished, [1, 1])
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    # a file skipped halfway through its pieces, the rest gets to endgame
+    # and finishes without it
+    def testFinishSkipped(self):
+        sw = self._wrapper()
+        self._download(sw, [0, 1, 2])
+        requests = []
+        while sw.do_I_have_requests(3):
+            requests.append(sw.new_request(3))
+        started = [sw.new_request(4) for i in xrange(2)]
+        self.failIf(sw.endgame)
+        sw.set_skipped([4, 5])
+        self.assertEqual(sw.amount_left, PIECE_SIZE)
+        self.assertTrue(sw.endgame)
+        for begin, length in requests:
+            start = 3 * PIECE_SIZE + begin
+            sw.piece_came_in(3, begin, self.data[start:start + length])
+        self.assertEqual(sw.amount_left, 0)
+        self.assertEqual(self.finished, [1])
+        # in flight when skipped
+        sw.request_lost(4, *started[1])
+        start = 4 * PIECE_SIZE
+        sw.piece_came_in(4, 0, self.data[start:start + started[0][1]])
+        sw.set_skipped([5])
+        self.assertEqual(sw.amount_left, PIECE_SIZE)
+        self.assertEqual(sw.amount_inactive, PIECE_SIZE - 2 ** 14)
+        self._download(sw, [4])
+        self.assertEqual(self.finished, [1, 1])
+        sw.set_skipped([])
+        self._download(sw, [5])
+        self.assertEqual(sw.amount_inactive, 0)
+        self.assertEqual(self.finished, [1, 1, 1])
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    def testHashFailure(self):
+        sw = self._wrapper()
+        self._download(sw, [2], corrupt = 2)
+        self.assertEqual(self.flunked, [2])
+        self.assertFalse(sw.do_I_have(2))
+        self.assertTrue(sw.do_I_have_requests(2))
+        self._download(sw, [2])
+        self.assertTrue(sw.do_I_have(2))
+
+    # blocks are handed out first to last, lost ones again before the rest,
+    # and only count for resuming once they are on disk
+    def testBlockStates(self):
+        tq = TaskQueue()
+        diskio = DiskIO(2, 2 ** 20, tq.add_task)
+        sw = self._wrapper(diskio = diskio)
+        begins = [sw.new_request(1)[0] for i in xrange(3)]
+        self.assertEqual(begins, [0, 2 ** 14, 2 ** 15])
+        sw.request_lost(1, 2 ** 14, 2 ** 14)
+        self.assertEqual(sw.new_request(1), (2 ** 14, 2 ** 14))
+        self.assertEqual(sw.new_request(1), (3 * 2 ** 14, 2 ** 14))
+        self.failIf(sw.do_I_have_requests(1))
+        sw.piece_came_in(1, 0, self.data[PIECE_SIZE:PIECE_SIZE + 2 ** 14])
+        self.assertEqual(list(sw.blockstates[1]),
+                         [RECEIVED] + [REQUESTED] * 3)
+        self.assertEqual(sw.get_fastresume()['partial'], [])
+        tq.run(diskio, [self.storage])
+        self.assertEqual(list(sw.blockstates[1]),
+                         [WRITTEN] + [REQUESTED] * 3)
+        self.assertEqual(sw.get_fastresume()['partial'], [[1, 1, '\x80']])
+        diskio.close()
+        self.storage.close()
+
+    def testReadCache(self):
+        cache = PieceCache(PIECE_SIZE * 2)
+        sw = self._wrapper(readcache = cache)
+        self._download(sw)
+        for index in (1, 1, 1, 2, 3, 1):
+            for begin in (0, 2 ** 14, 2 ** 15):
+                piece = sw.get_piece(index, begin, 2 ** 14)
+                start = index * PIECE_SIZE + begin
+                self.assertEqual(str(piece), self.data[start:start + 2 ** 14])
+        self.assertEqual(sw.stat_cache_misses, 4)
+        self.assertEqual(sw.stat_cache_hits, 14)
+        self.assertTrue(cache.size <= PIECE_SIZE * 2)
+        sw.close()
+        self.assertEqual(cache.size, 0)
+
+    def testBackgroundWrites(self):
+        tq = TaskQueue()
+        diskio = DiskIO(2, 2 ** 20, tq.add_task)
+        sw = self._wrapper(diskio = diskio)
+        checked = []
+        sw.checked_func = lambda index, ok: checked.append((index, ok))
+        self._download(sw, [3, 0, 2, 5, 1, 4], corrupt = 2)
+        tq.run(diskio, [self.storage])
+        self.assertEqual(self.flunked, [2])
+        self.assertTrue((2, False) in checked)
+        self._download(sw, [2])
+        tq.run(diskio, [self.storage])
+        self.assertEqual(sw.amount_left, 0)
+        self.assertEqual(self.finished, [1])
+        self.assertEqual(len([i for i, ok in checked if ok]), 6)
+        sw.close()
+        diskio.close()
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    def testAssembly(self):
+        budget = WriteBudget(PIECE_SIZE * 10)
+        sw = self._wrapper(writebudget = budget)
+        self._download(sw, [3, 0, 5, 2, 1, 4], corrupt = 2)
+        self.assertEqual(self.flunked, [2])
+        self.assertEqual(sw.stat_assembled, 5)
+        self._download(sw, [2])
+        self.assertEqual(sw.stat_assembled, 6)
+        self.assertEqual(sw.stat_evicted, 0)
+        self.assertEqual(budget.size, 0)
+        self.assertEqual(self.finished, [1])
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    # blocks of two pieces interleaved with room for only one of them
+    def testEviction(self):
+        budget = WriteBudget(PIECE_SIZE + 2 ** 14)
+        sw = self._wrapper(writebudget = budget)
+        requests = []
+        for index in (0, 1):
+            while sw.do_I_have_requests(index):
+                requests.append((index, sw.new_request(index)))
+        requests.sort(key = lambda r: (r[1], r[0]))
+        for index, (begin, length) in requests:
+            start = index * PIECE_SIZE + begin
+            sw.piece_came_in(index, begin, self.data[start:start + length])
+        self.assertTrue(sw.stat_evicted > 0)
+        self.assertTrue(sw.do_I_have(0))
+        self.assertTrue(sw.do_I_have(1))
+        self._download(sw, [2, 3, 4, 5])
+        self.assertEqual(budget.size, 0)
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    def testIncrementalHash(self):
+        sw = self._wrapper()
+        self._download(sw, [0, 1])
+        self.assertEqual(sw.stat_hashed_inline, PIECE_SIZE * 2)
+        self.assertEqual(sw.stat_hashed_reread, 0)
+        # first block in order, the rest backwards: the last one to arrive
+        # continues the hashed prefix, the two before it are read back
+        requests = []
+        while sw.do_I_have_requests(2):
+            requests.append(sw.new_request(2))
+        requests[1:] = requests[:0:-1]
+        for begin, length in requests:
+            start = 2 * PIECE_SIZE + begin
+            sw.piece_came_in(2, begin, self.data[start:start + length])
+        self.assertTrue(sw.do_I_have(2))
+        self.assertEqual(sw.stat_hashed_inline,
+                         PIECE_SIZE * 2 + 2 * 2 ** 14)
+        self.assertEqual(sw.stat_hashed_reread, PIECE_SIZE - 2 * 2 ** 14)
+
+    def testRecheck(self):
+        sw = self._wrapper()
+        self._download(sw, [1, 0, 4, 5])
+        self.storage.close()
+        sw = self._wrapper()
+        for i in (0, 1, 4, 5):
+            self.assertTrue(sw.do_I_have(i))
+        self.assertFalse(sw.do_I_have(2))
+
+    def _partial_download(self):
+        # pieces 0, 1, 4, 5 and the first two blocks of 3, with marks in
+        # the missing blocks
+        sw = self._wrapper(make_config(direct_placement = 0))
+        self._download(sw, [1, 0, 4, 5])
+        for i in xrange(2):
+            begin, length = sw.new_request(3)
+            start = 3 * PIECE_SIZE + begin
+            sw.piece_came_in(3, begin, self.data[start:start + length])
+        sw.close()
+        self.storage.close()
+        return sw
+
+    # finished pieces and the finished half of piece 3 are found again,
+    # whether checked in this thread or in worker processes
+    def testParallelRecheck(self):
+        self._partial_download()
+        for processes in (0, 2):
+            checker = HashChecker(processes)
+            sw = self._wrapper(hashchecker = checker)
+            checker.close()
+            for i in (0, 1, 4, 5):
+                self.assertTrue(sw.do_I_have(i))
+            self.assertFalse(sw.do_I_have(2))
+            self.assertFalse(sw.do_I_have(3))
+            requests = []
+            while sw.do_I_have_requests(3):
+                requests.append(sw.new_request(3))
+            self.assertEqual(len(requests), 2)
+            self.assertEqual(sw.amount_left, PIECE_SIZE * 2)
+            self.storage.close()
+
+    # each job carries only the files it reads, and once stopped no more
+    # jobs go to the workers
+    def testHashCheckStop(self):
+        sw = self._wrapper()
+        self._download(sw)
+        self.storage.close()
+        args = (self.storage.ranges, PIECE_SIZE, len(self.data), [0, 2, 4],
+                1000, sw.partial_mark, 2 ** 14, 6)
+        self.assertEqual([len(job[0]) for job in make_jobs(*args)],
+                         [1, 3, 1])
+        checker = HashChecker(1)
+        flag = Event()
+        r = checker.check(*(args + (flag, lambda fraction: flag.set())))
+        checker.close()
+        # the second job was queued with the first
+        self.assertEqual(sorted(r), [0, 2])
+        self.assertEqual(r[2][0], self.hashes[2])
+
+    def _resume(self, f):
+        f.seek(0)
+        resume = self.storage.read_fastresume(f)
+        self.assertEqual(self.storage.check_fastresume(resume),
+                         PIECE_SIZE * 3 + 1000)
+        reads = []
+        read = Storage.read
+        def counting_read(storage, pos, amount):
+            reads.append(amount)
+            return read(storage, pos, amount)
+        Storage.read = counting_read
+        try:
+            sw = self._wrapper(resume = resume)
+        finally:
+            Storage.read = read
+        for i in (0, 1, 4, 5):
+            self.assertTrue(sw.do_I_have(i))
+        requests = []
+        while sw.do_I_have_requests(3):
+            requests.append(sw.new_request(3))
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(sw.amount_left, PIECE_SIZE * 2)
+        self.storage.close()
+        return reads
+
+    def testFastresume(self):
+        sw = self._partial_download()
+        f = StringIO()
+        self.storage.write_fastresume(f, PIECE_SIZE * 3 + 1000,
+                                      sw.get_fastresume())
+        # the partial piece isn't read back to find its blocks
+        self.assertEqual(self._resume(f), [])
+        # a damaged file is refused
+        s = f.getvalue()
+        f = StringIO(s[:-3] + 'x' + s[-2:])
+        self.assertRaises(BTFailure, self.storage.read_fastresume, f)
+
+    # with disk threads the write callbacks of blocks flushed at close
+    # never run, their torrent is gone by then
+    def testFastresumeThreaded(self):
+        tq = TaskQueue()
+        diskio = DiskIO(2, 2 ** 20, tq.add_task)
+        sw = self._wrapper(make_config(direct_placement = 0),
+                           diskio = diskio,
+                           writebudget = WriteBudget(PIECE_SIZE * 10))
+        self._download(sw, [1, 0, 4])
+        tq.run(diskio, [self.storage])
+        # piece 5 is written as a whole and piece 3 is still in memory
+        # when closing
+        self._download(sw, [5])
+        for i in xrange(2):
+            begin, length = sw.new_request(3)
+            start = 3 * PIECE_SIZE + begin
+            sw.piece_came_in(3, begin, self.data[start:start + length])
+        self.assertEqual(sw.assembling.keys(), [3])
+        sw.close()
+        diskio.close()
+        self.storage.close()
+        f = StringIO()
+        self.storage.write_fastresume(f, PIECE_SIZE * 3 + 1000,
+                                      sw.get_fastresume())
+        self._resume(f)
+
+    # a partly downloaded piece written by disk threads survives shutting
+    # down and resuming, and the download finishes from there
+    def testResumeThreaded(self):
+        tq = TaskQueue()
+        diskio = DiskIO(2, 2 ** 20, tq.add_task)
+        sw = self._wrapper(make_config(direct_placement = 0), diskio = diskio)
+        self._download(sw, [1, 0, 4, 5])
+        tq.run(diskio, [self.storage])
+        for i in xrange(2):
+            begin, length = sw.new_request(3)
+            start = 3 * PIECE_SIZE + begin
+            sw.piece_came_in(3, begin, self.data[start:start + length])
+        sw.close()
+        self.storage.close()
+        state = sw.get_fastresume()
+        # in the bitmaps, not left to be found by scanning for marks
+        self.assertEqual([p[1] for p in state['partial']], [3])
+        f = StringIO()
+        self.storage.write_fastresume(f, PIECE_SIZE * 4, state)
+        f.seek(0)
+        resume = self.storage.read_fastresume(f)
+        self.assertEqual(self.storage.check_fastresume(resume),
+                         PIECE_SIZE * 4)
+        sw = self._wrapper(resume = resume, diskio = diskio)
+        # only the blocks of piece 3 not written before are asked for
+        self.assertEqual(sw.numinactive[3], 2)
+        self._download(sw, [3, 2])
+        tq.run(diskio, [self.storage])
+        self.assertEqual(sw.amount_left, 0)
+        sw.close()
+        diskio.close()
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+    # old files are still read; their partial pieces are scanned for marks
+    def testFastresumeVersion1(self):
+        sw = self._partial_download()
+        places = sw.rplaces
+        for i in xrange(sw.numpieces):
+            if places[i] >= 0 and not sw.have[places[i]]:
+                places[i] = FASTRESUME_PARTIAL
+        f = StringIO()
+        f.write('BitTorrent resume state file, version 1\n')
+        f.write(str(PIECE_SIZE * 3 + 1000) + '\n')
+        for name in self.files:
+            f.write('%d %s\n' % (os.path.getsize(name),
+                                  str(os.path.getmtime(name))))
+        f.write(places.tostring())
+        self.assertEqual(self._resume(f), [PIECE_SIZE])
+
+
+    # a checkpoint taken while running, then more pieces are placed and
+    # moved before the process dies without saving
+    def testCheckpoint(self):
+        sw = self._wrapper(make_config(direct_placement = 0))
+        self._download(sw, [1, 0, 4])
+        state = sw.get_fastresume()
+        state['clean'] = 0
+        f = StringIO()
+        self.storage.write_fastresume(f, PIECE_SIZE * 3, state)
+        self._download(sw, [5, 2])
+        self.storage.close()
+        f.seek(0)
+        resume = self.storage.read_fastresume(f)
+        self.assertEqual(self.storage.check_fastresume(resume),
+                         PIECE_SIZE * 3)
+        sw = self._wrapper(resume = resume)
+        for i in (0, 1, 2, 4, 5):
+            self.assertTrue(sw.do_I_have(i))
+        self.assertFalse(sw.do_I_have(3))
+        self._download(sw, [3])
+        self.assertEqual(sw.amount_left, 0)
+        self.storage.close()
+        self.assertEqual(self._file_contents(), self.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+# coding: utf-8
+'''
+Streamer tests, playback simulated with a fake clock
+'''
+import unittest
+
+from BitTorrent import Streamer as StreamerModule
+from BitTorrent.bitfield import Bitfield
+from BitTorrent.Streamer import Streamer
+
+NUMPIECES = 10
+
+
+class FakeStorage(object):
+
+    def __init__(self):
+        self.numpieces = NUMPIECES
+        self.have = Bitfield(NUMPIECES)
+        self.requested = {}
+        self.skipped = {}
+        self.endgame = False
+        # {index: [(begin, length)]} asked from peers
+        self.blocks = {}
+
+    def do_I_have(self, index):
+        return self.have[index]
+
+    def do_I_have_requests(self, index):
+        return not self.have[index] and index not in self.requested
+
+    def requested_blocks(self, index):
+        return self.blocks.get(index, [])
+
+
+class FakeDownload(object):
+
+    def __init__(self, storage, rate, pieces):
+        self.storage = storage
+        self.rate = rate
+        self.have = Bitfield(NUMPIECES)
+        for i in pieces:
+            self.have[i] = True
+        self.choked = False
+        self.active_requests = []
+
+    def get_rate(self):
+        return self.rate
+
+    def _want(self, index):
+        return self.have[index] and self.storage.do_I_have_requests(index)
+
+
+class FakeDownloader(object):
+
+    def __init__(self):
+        self.downloads = []
+        self.duplicates = {}
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.time = StreamerModule.time
+        StreamerModule.time = lambda: self.now
+        self.storage = FakeStorage()
+        self.downloader = FakeDownloader()
+        # one second of playback per piece
+        config = {'stream_rate': 1, 'stream_window': 3}
+        self.streamer = Streamer(config, self.storage, self.downloader, 1024)
+
+    def tearDown(self):
+        StreamerModule.time = self.time
+
+    def _arrive(self, piece, when):
+        self.now = when
+        self.storage.have[piece] = True
+        self.streamer.piece_done()
+
+    def testPlayback(self):
+        streamer = self.streamer
+        self.assertEqual(streamer.first_byte, None)
+        self._arrive(0, 102)
+        self.assertEqual(streamer.first_byte, 2)
+        self._arrive(2, 102.5)
+        # piece 1 is missing when piece 0 is done playing
+        self._arrive(5, 103.5)
+        self.assertEqual((streamer.position, streamer.stalls), (1, 1))
+        self.assertEqual(streamer.deadline(3, self.now), 105.5)
+        self._arrive(1, 105)
+        self.assertEqual(streamer.deadline(3, self.now), 107)
+        self._arrive(4, 107.5)
+        self.assertEqual((streamer.position, streamer.stalls), (3, 2))
+        self.assertEqual(streamer.first_byte, 2)
+
+    def testFastPeers(self):
+        storage = self.storage
+        fast = FakeDownload(storage, 50, range(NUMPIECES))
+        slow = FakeDownload(storage, 10, range(NUMPIECES))
+        choking = FakeDownload(storage, 100, range(NUMPIECES))
+        choking.choked = True
+        self.downloader.downloads = [fast, slow, choking]
+        self.assertEqual(self.streamer.next(fast), 0)
+        self.assertEqual(self.streamer.next(slow), None)
+        storage.requested[0] = None
+        self.assertEqual(self.streamer.next(fast), 1)
+        # only the window is handed out
+        storage.requested.update({1: None, 2: None})
+        self.assertEqual(self.streamer.next(fast), None)
+        self.failIf(self.streamer.in_window(3))
+
+    def testRanking(self):
+        storage = self.storage
+        streamer = self.streamer
+        a = FakeDownload(storage, 50, range(NUMPIECES))
+        b = FakeDownload(storage, 40, range(NUMPIECES))
+        c = FakeDownload(storage, 10, range(NUMPIECES))
+        self.downloader.downloads = [a, b, c]
+        self.assertEqual(streamer.next(b), 0)
+        self.assertEqual(streamer.next(c), None)
+        # rates are ranked again after a second
+        c.rate = 60
+        self.assertEqual(streamer.next(c), None)
+        self.now += 1
+        self.assertEqual(streamer.next(c), 0)
+        self.assertEqual(streamer.next(b), None)
+        # or right away when a peer chokes us
+        self.assertEqual(streamer.next(a), 0)
+        a.choked = True
+        streamer.choked_changed()
+        self.assertEqual(streamer.next(a), None)
+
+    def testDuplicates(self):
+        storage = self.storage
+        fast = FakeDownload(storage, 50, range(NUMPIECES))
+        other = FakeDownload(storage, 40, range(NUMPIECES))
+        self.downloader.downloads = [fast, other]
+        other.active_requests = [(0, 0, 512), (0, 512, 512), (2, 0, 1024)]
+        storage.blocks = {0: [(0, 512), (512, 512)], 2: [(0, 1024)]}
+        fast.active_requests = [(0, 512, 512)]
+        # nothing is playing yet, piece 0 is late already
+        self.assertEqual(self.streamer.duplicates(fast), [(0, 0, 512)])
+        self.downloader.duplicates[(0, 0, 512)] = None
+        self.assertEqual(self.streamer.duplicates(fast), [])
+        self._arrive(0, 101)
+        self._arrive(1, 101)
+        # piece 2 plays in 1.5 seconds, there's time
+        self.now = 101.5
+        self.assertEqual(self.streamer.duplicates(fast), [])
+        self.now = 102.1
+        self.assertEqual(self.streamer.duplicates(fast), [(2, 0, 1024)])
+        self.assertEqual(self.streamer.duplicates(other), [])